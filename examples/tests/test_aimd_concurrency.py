@@ -0,0 +1,142 @@
+# -*- coding:utf-8 -*-
+
+
+import asyncio
+from sprite.core.concurrency import AdjustableSemaphore, AIMDController
+
+"""
+自适应并发控制的测试
+    1.耗时平稳、吞吐量没有下降时加性增，不超过最大并发数
+    2.被限流或者失败率超过阈值时乘性减，不低于最小并发数
+    3.平均耗时明显高于历史最低时保持不变
+    4.卡住没有返回的下载当作被限流，只计算一次，定时器在没有下载结束时也会调整
+    5.AdjustableSemaphore调整上限之后，等待的协程按照新的上限获取
+"""
+
+INTERVAL = 0.05
+
+
+def record_window(controller: AIMDController, count: int, latency: float = 0.1, errors: int = 0,
+                  throttled: int = 0):
+    # 把统计周期的开始时间往前移，最后一个样本结束统计周期
+    for i in range(count):
+        if i == count - 1:
+            controller._window_start -= INTERVAL
+        controller.record(latency, error=i < errors, throttled=i < throttled)
+
+
+def test_additive_increase():
+    changes = []
+    controller = AIMDController(initial=4, max_concurrency=6, increase=1, interval=INTERVAL, on_change=changes.append)
+    for _ in range(5):
+        record_window(controller, 10)
+    # 4 -> 5 -> 6，之后不超过最大并发数
+    assert controller.target == 6 and changes == [5, 6], changes
+
+
+def test_multiplicative_decrease():
+    controller = AIMDController(initial=16, min_concurrency=3, decrease=0.5, interval=INTERVAL, error_threshold=0.1)
+    record_window(controller, 10, throttled=1)
+    assert controller.target == 8
+    record_window(controller, 10, errors=2)
+    assert controller.target == 4
+    # 失败率没有超过阈值
+    record_window(controller, 10, errors=1)
+    assert controller.target == 5
+    record_window(controller, 10, throttled=10)
+    record_window(controller, 10, throttled=10)
+    assert controller.target == 3
+
+
+def test_latency_hold():
+    controller = AIMDController(initial=4, interval=INTERVAL, latency_tolerance=0.5)
+    record_window(controller, 10, latency=0.1)
+    assert controller.target == 5
+    record_window(controller, 10, latency=0.3)
+    assert controller.target == 5
+    assert abs(controller.stats()["latency"] - 0.3) < 1e-9
+
+
+def test_stalled_download():
+    controller = AIMDController(initial=8, interval=INTERVAL, latency_target=1)
+    token = controller.begin()
+    controller._in_flight[token] -= 2
+    controller._window_start -= INTERVAL
+    controller._adjust()
+    assert controller.target == 4
+    # 同一个卡住的下载只计算一次
+    controller._window_start -= INTERVAL
+    controller._adjust()
+    assert controller.target == 4
+    # 结束时不会重复记录
+    controller.finish(token)
+    assert not controller._in_flight
+
+
+async def check_timer():
+    controller = AIMDController(initial=8, interval=INTERVAL, latency_target=INTERVAL)
+    controller.start()
+    try:
+        controller.begin()
+        # 没有下载结束，定时器检查到卡住的下载之后减小并发数
+        await asyncio.sleep(INTERVAL * 4)
+        assert controller.target == 4, controller.target
+    finally:
+        controller.close()
+
+
+async def check_semaphore():
+    semaphore = AdjustableSemaphore(2)
+    await semaphore.acquire()
+    await semaphore.acquire()
+    waiters = [asyncio.ensure_future(semaphore.acquire()) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert not any(waiter.done() for waiter in waiters)
+    # 调大上限，唤醒对应数量的等待协程
+    semaphore.set_limit(4)
+    await asyncio.sleep(0)
+    assert sum(waiter.done() for waiter in waiters) == 2 and semaphore.in_use == 4
+    # 调小上限，已经获取的不受影响，释放之后占用数量仍然不低于上限时不唤醒
+    semaphore.set_limit(2)
+    semaphore.release()
+    await asyncio.sleep(0)
+    assert not waiters[2].done() and semaphore.in_use == 3
+    semaphore.release()
+    semaphore.release()
+    await asyncio.sleep(0)
+    assert waiters[2].done() and semaphore.in_use == 2
+
+    # 被唤醒之后取消的协程把机会让给下一个等待的协程
+    first, second = asyncio.ensure_future(semaphore.acquire()), asyncio.ensure_future(semaphore.acquire())
+    await asyncio.sleep(0)
+    semaphore.release()
+    first.cancel()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert first.cancelled() and second.done() and semaphore.in_use == 2
+
+
+def run(coroutine):
+    # 不使用asyncio.run，它会清空当前线程的事件循环，影响之后的测试
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_timer():
+    run(check_timer())
+
+
+def test_semaphore():
+    run(check_semaphore())
+
+
+if __name__ == '__main__':
+    test_additive_increase()
+    test_multiplicative_decrease()
+    test_latency_hold()
+    test_stalled_download()
+    test_timer()
+    test_semaphore()
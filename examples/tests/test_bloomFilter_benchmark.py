@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+
+
+import time
+from sprite.utils.pybloomfilter import ScalableBloomFilter, HASH_SALTED, DEFAULT_HASH_SCHEME
+
+"""
+布隆过滤器的性能测试，对比每秒处理的key数量
+    1.旧的加盐md5/sha哈希，逐个add
+    2.双重哈希，逐个add
+    3.双重哈希，add_many批量加入（需要安装numpy）
+"""
+
+KEY_COUNT = 200000
+BATCH_SIZE = 1000
+
+
+def make_keys(count: int):
+    return [f'http://www.example.com/page/{i}?q={i * 7}' for i in range(count)]
+
+
+def bench_add(hash_scheme: int, keys: list) -> float:
+    bf = ScalableBloomFilter(initial_capacity=100000, error_rate=0.001, hash_scheme=hash_scheme)
+    start = time.perf_counter()
+    for key in keys:
+        bf.add(key)
+    return len(keys) / (time.perf_counter() - start)
+
+
+def bench_add_many(hash_scheme: int, keys: list) -> float:
+    bf = ScalableBloomFilter(initial_capacity=100000, error_rate=0.001, hash_scheme=hash_scheme)
+    start = time.perf_counter()
+    for i in range(0, len(keys), BATCH_SIZE):
+        bf.add_many(keys[i:i + BATCH_SIZE])
+    return len(keys) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    keys = make_keys(KEY_COUNT)
+    print(f'salted hashes, add:        {bench_add(HASH_SALTED, keys):12.0f} keys/s')
+    print(f'double hashing, add:       {bench_add(DEFAULT_HASH_SCHEME, keys):12.0f} keys/s')
+    print(f'double hashing, add_many:  {bench_add_many(DEFAULT_HASH_SCHEME, keys):12.0f} keys/s')
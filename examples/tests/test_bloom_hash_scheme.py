@@ -0,0 +1,93 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+import tempfile
+from sprite import Spider, Settings, Request
+from sprite.core.scheduler import Scheduler
+from sprite.utils import pybloomfilter
+from sprite.utils.pybloomfilter import ScalableBloomFilter, HASH_BLAKE2B, HASH_XXH128, HASH_MMH3, \
+    DEFAULT_HASH_SCHEME
+
+"""
+布隆过滤器哈希方式的测试
+    1.默认使用只依赖标准库的blake2b，和是否安装了xxhash、mmh3无关，长期保存的过滤器在其他机器上也能读取
+    2.明确指定了xxhash、mmh3但是没有安装对应的包时，创建过滤器时抛出的异常中包含缺少的包名
+"""
+
+REQUEST_COUNT = 100
+
+
+class HashSpider(Spider):
+    name = "hash"
+
+    async def parse(self, response):
+        pass
+
+
+def create_scheduler(job_dir: str, values: dict = None) -> Scheduler:
+    settings = {"LONG_SAVE": True, "JOB_DIR": job_dir}
+    settings.update(values or {})
+    return Scheduler.from_settings(Settings(values=settings), HashSpider())
+
+
+def test_default_scheme():
+    assert DEFAULT_HASH_SCHEME == HASH_BLAKE2B
+    with tempfile.TemporaryDirectory() as job_dir:
+        spider = HashSpider()
+        scheduler = create_scheduler(job_dir)
+        assert scheduler._df.hash_scheme == HASH_BLAKE2B
+        for i in range(REQUEST_COUNT):
+            scheduler.enqueue_request(Request(url=f'http://hash.test/{i}', callback=spider.parse))
+        scheduler._df.close()
+
+        # 重新打开时读回同样的哈希方式，之前加入的request都被过滤
+        scheduler = create_scheduler(job_dir)
+        assert all(f.hash_scheme == HASH_BLAKE2B for f in scheduler._df.filters)
+        count = scheduler.enqueue_requests(Request(url=f'http://hash.test/{i}', callback=spider.parse)
+                                           for i in range(REQUEST_COUNT))
+        assert count == 0, count
+        scheduler._df.close()
+
+
+def check_missing_package(name: str, hash_scheme: int):
+    module = getattr(pybloomfilter, name)
+    # 模拟没有安装对应的包
+    setattr(pybloomfilter, name, None)
+    try:
+        try:
+            ScalableBloomFilter(hash_scheme=hash_scheme)
+        except ImportError as e:
+            assert name in str(e), str(e)
+        else:
+            raise AssertionError(f'{name} is not installed, but the filter was created')
+        with tempfile.TemporaryDirectory() as job_dir:
+            try:
+                create_scheduler(job_dir, {"BLOOM_HASH_SCHEME": name})
+            except ImportError as e:
+                assert name in str(e), str(e)
+            else:
+                raise AssertionError(f'{name} is not installed, but the scheduler was created')
+    finally:
+        setattr(pybloomfilter, name, module)
+
+
+def test_missing_package():
+    check_missing_package("xxhash", HASH_XXH128)
+    check_missing_package("mmh3", HASH_MMH3)
+
+
+def test_unknown_scheme():
+    with tempfile.TemporaryDirectory() as job_dir:
+        try:
+            create_scheduler(job_dir, {"BLOOM_HASH_SCHEME": "md5"})
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("unknown hash scheme is accepted")
+
+
+if __name__ == '__main__':
+    test_default_scheme()
+    test_missing_package()
+    test_unknown_scheme()
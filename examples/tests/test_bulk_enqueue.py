@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+
+
+import asyncio
+from sprite import Spider, Settings, Request, PyCoroutinePool
+from sprite.core.engine import Engine
+from sprite.core.scheduler import Scheduler
+from sprite.middlewaremanager import MiddlewareManager
+
+"""
+批量加入调度器的测试
+    1.enqueue_requests与逐个调用enqueue_request的结果一致：重复的request（包括同一批中重复的）被过滤，dont_filter的不过滤
+    2.一批request加入之后，唤醒的等待协程数量与加入的数量相同
+    3.回调函数产生的request缓存到ENQUEUE_BATCH_SIZE之后批量加入，回调结束（包括发生异常）时剩下的也加入调度器
+"""
+
+BATCH_SIZE = 10
+
+
+class BulkSpider(Spider):
+    name = "bulk"
+
+    async def parse(self, response):
+        pass
+
+
+def make_requests(spider: Spider, urls: list) -> list:
+    return [Request(url=f'http://bulk.test/{url}', callback=spider.parse, dont_filter=url.startswith("again"))
+            for url in urls]
+
+
+def drain(scheduler: Scheduler) -> list:
+    urls = []
+    while scheduler.has_pending_requests():
+        urls.append(scheduler.next_request_nowait().url)
+    return urls
+
+
+def test_same_as_enqueue_request():
+    spider = BulkSpider()
+    urls = ["a", "b", "a", "c", "again", "again", "b", "d"]
+    one_by_one = Scheduler.from_settings(Settings(), spider)
+    batched = Scheduler.from_settings(Settings(), spider)
+    one_by_one.enqueue_request(make_requests(spider, ["a"])[0])
+    batched.enqueue_request(make_requests(spider, ["a"])[0])
+    for request in make_requests(spider, urls):
+        one_by_one.enqueue_request(request)
+    # a已经在调度器中，同一批中重复的b也只加入一次，dont_filter的again加入两次
+    assert batched.enqueue_requests(make_requests(spider, urls)) == 5
+    assert drain(batched) == drain(one_by_one)
+    assert batched.enqueue_requests([]) == 0
+
+
+async def check_wakeup():
+    spider = BulkSpider()
+    scheduler = Scheduler.from_settings(Settings(), spider)
+    scheduler.start()
+    getters = [asyncio.ensure_future(scheduler.next_request()) for _ in range(3)]
+    await asyncio.sleep(0)
+    scheduler.enqueue_requests(make_requests(spider, ["a", "b"]))
+    await asyncio.sleep(0)
+    assert sum(getter.done() for getter in getters) == 2
+    scheduler.enqueue_requests(make_requests(spider, ["c"]))
+    results = await asyncio.gather(*getters)
+    assert sorted(request.url for request in results) == [f'http://bulk.test/{url}' for url in "abc"]
+
+
+async def check_callback_batches():
+    spider = BulkSpider()
+    engine = Engine.from_settings(Settings(values={"ENQUEUE_BATCH_SIZE": BATCH_SIZE}), spider, MiddlewareManager(),
+                                  coroutine_pool=PyCoroutinePool())
+    scheduler = engine._scheduler
+    batches = []
+    enqueue_requests = scheduler.enqueue_requests
+
+    def recorded_enqueue_requests(requests):
+        requests = list(requests)
+        batches.append(len(requests))
+        return enqueue_requests(requests)
+
+    scheduler.enqueue_requests = recorded_enqueue_requests
+
+    async def callback(count: int, error: bool = False):
+        for i in range(count):
+            yield Request(url=f'http://bulk.test/{count}/{i}', callback=spider.parse)
+        if error:
+            raise ValueError("callback failed")
+
+    await engine._process_async_callback(callback(25))
+    assert batches == [BATCH_SIZE, BATCH_SIZE, 5], batches
+    assert len(scheduler) == 25
+
+    batches.clear()
+    try:
+        await engine._process_async_callback(callback(13, error=True))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("callback error is swallowed")
+    # 发生异常之前产生的request也加入了调度器
+    assert batches == [BATCH_SIZE, 3], batches
+    assert len(scheduler) == 38
+
+
+def run(coroutine):
+    # 不使用asyncio.run，它会清空当前线程的事件循环，影响之后的测试
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_wakeup():
+    run(check_wakeup())
+
+
+def test_callback_batches():
+    run(check_callback_batches())
+
+
+if __name__ == '__main__':
+    test_same_as_enqueue_request()
+    test_wakeup()
+    test_callback_batches()
@@ -0,0 +1,100 @@
+# -*- coding:utf-8 -*-
+
+
+import time
+import asyncio
+from asyncio import Queue
+from asyncio.locks import Lock
+from sprite.utils.coroutinePool import coroutine_pool, TaskHandle
+
+"""
+协程池提交任务的性能测试，协程数量达到上限（1k、10k、100k个协程都在执行任务）之后，每次提交任务的耗时
+    1.旧的实现：每个协程一个任务队列，每次提交都在锁内按队列长度排序所有协程，取队列最短的协程
+    2.共享任务队列：任务放入所有协程共享的队列，由先空闲下来的协程取走
+"""
+
+WORKER_COUNTS = (1000, 10000, 100000)
+# 每种协程数量下提交的任务数量，旧的实现每次提交都要排序，任务数量少一些
+SUBMIT_COUNT = 20000
+LEGACY_SUBMIT_COUNT = {1000: 2000, 10000: 200, 100000: 20}
+
+
+async def noop():
+    pass
+
+
+class LegacyDispatcher:
+    """
+    旧的实现中选择协程的部分
+    """
+
+    def __init__(self, worker_count: int):
+        self._lock = Lock()
+        self._ready = [Queue() for _ in range(worker_count)]
+
+    async def go(self, task):
+        async with self._lock:
+            # 按照队列长度从小到大排序
+            self._ready = sorted(self._ready, key=lambda x: x.qsize())
+            task_queue = self._ready[0]
+        await task_queue.put(task)
+
+
+async def bench_legacy(worker_count: int, submit_count: int) -> float:
+    dispatcher = LegacyDispatcher(worker_count)
+    tasks = [noop() for _ in range(submit_count)]
+    start = time.perf_counter()
+    for task in tasks:
+        await dispatcher.go(task)
+    elapsed = time.perf_counter() - start
+    for task in tasks:
+        task.close()
+    return elapsed / submit_count
+
+
+async def bench_shared(submit_count: int) -> float:
+    tasks = [noop() for _ in range(submit_count)]
+    start = time.perf_counter()
+    for task in tasks:
+        coroutine_pool._submit(TaskHandle(coroutine_pool, task))
+    return (time.perf_counter() - start) / submit_count
+
+
+async def occupy(release: asyncio.Event):
+    await release.wait()
+
+
+async def fill_workers(worker_count: int, release: asyncio.Event):
+    # 让协程池中正好有worker_count个协程都在执行任务
+    while coroutine_pool.stats()["coroutine_count"] < worker_count:
+        coroutine_pool._submit(TaskHandle(coroutine_pool, occupy(release)))
+    await asyncio.sleep(0)
+
+
+def run_in_pool(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, coroutine_pool.loop).result()
+
+
+async def make_event() -> asyncio.Event:
+    return asyncio.Event()
+
+
+if __name__ == '__main__':
+    coroutine_pool.reset(max_coroutine_amount=max(WORKER_COUNTS))
+    coroutine_pool.start()
+    # 占用协程的任务一直等待该事件
+    release = run_in_pool(make_event())
+    print(f'{"workers":>8} {"legacy us/submit":>18} {"shared us/submit":>18} {"speedup":>10}')
+    for worker_count in WORKER_COUNTS:
+        legacy = run_in_pool(bench_legacy(worker_count, LEGACY_SUBMIT_COUNT[worker_count]))
+        # 协程数量达到上限，新提交的任务只能排队
+        coroutine_pool._max_coroutine_amount = worker_count
+        run_in_pool(fill_workers(worker_count, release))
+        shared = run_in_pool(bench_shared(SUBMIT_COUNT))
+        print(f'{worker_count:>8} {legacy * 1e6:>18.2f} {shared * 1e6:>18.2f} {legacy / shared:>9.0f}x')
+        coroutine_pool._max_coroutine_amount = max(WORKER_COUNTS)
+    coroutine_pool.loop.call_soon_threadsafe(release.set)
+    time.sleep(1)
+    print(coroutine_pool.stats())
+    coroutine_pool.stop()
+    coroutine_pool.is_stopped(waiting=True)
@@ -0,0 +1,106 @@
+# -*- coding:utf-8 -*-
+
+
+import time
+import asyncio
+from sprite.utils.coroutinePool import coroutine_pool
+from sprite.const import *
+
+"""
+协程池关闭的测试
+    1.force_stop：排队中的任务被丢弃，正在执行的任务按照 工作协程、下载任务、后台任务 的顺序取消，
+      每一组取消之后执行该组的关闭回调，吞掉CancelledError的任务最多等待到截止时间
+      吞掉CancelledError的任务被放弃，重新开启协程池之后的关闭不再等待它
+    2.stop：等待已经提交的任务执行完毕之后关闭，超时之后剩下的任务强制取消
+"""
+
+FORCE_STOP_TIMEOUT = 1
+
+
+async def work(order: list, tag: str):
+    try:
+        await asyncio.sleep(100)
+    finally:
+        order.append(tag)
+
+
+async def stubborn(order: list):
+    while True:
+        try:
+            await asyncio.sleep(100)
+        except asyncio.CancelledError:
+            order.append("swallow")
+
+
+async def short(order: list):
+    await asyncio.sleep(0.1)
+    order.append("short")
+
+
+def start_pool(max_coroutine_amount: int):
+    # 每次使用新的事件循环，不依赖其他测试留下的事件循环
+    coroutine_pool.reset(max_coroutine_amount=max_coroutine_amount, force_stop_timeout=FORCE_STOP_TIMEOUT,
+                         loop=asyncio.new_event_loop())
+    coroutine_pool.start()
+
+
+def test_force_stop():
+    order = []
+    # 4个工作协程、2个下载任务和1个吞掉CancelledError的任务正好占满所有协程
+    start_pool(7)
+    workers = coroutine_pool.go_many(work(order, "worker") for _ in range(4))
+    downloads = coroutine_pool.go_many((work(order, "download") for _ in range(2)), group=COROUTINE_GROUP_DOWNLOAD)
+    control = coroutine_pool.go(work(order, "control"), lane=COROUTINE_LANE_CONTROL)
+    coroutine_pool.go(stubborn(order))
+    # 协程数量达到上限，排队的任务
+    queued = coroutine_pool.go_many(work(order, "queued") for _ in range(10))
+    coroutine_pool.add_close_callback(lambda: order.append("close-download"), COROUTINE_GROUP_DOWNLOAD)
+    time.sleep(0.3)
+
+    start_time = time.time()
+    assert coroutine_pool.force_stop(), "pool is not stopped"
+    elapsed = time.time() - start_time
+    print(f'force_stop: {elapsed:.3f}s {order}')
+    assert elapsed < FORCE_STOP_TIMEOUT * 2
+    assert all(handle.cancelled() for handle in workers + downloads + queued + [control])
+    assert "queued" not in order
+    # 吞掉CancelledError的任务不会阻止后面的任务组被取消
+    assert order.index("worker") < order.index("download") < order.index("close-download") < order.index("control")
+
+    # 上一次关闭放弃的任务还在事件循环中，在同一个事件循环上重新开启，不影响之后的关闭
+    coroutine_pool.start()
+    start_time = time.time()
+    coroutine_pool.stop()
+    coroutine_pool.is_stopped(waiting=True)
+    elapsed = time.time() - start_time
+    print(f'stop after restart: {elapsed:.3f}s')
+    assert elapsed < FORCE_STOP_TIMEOUT
+
+
+def test_stop():
+    order = []
+    start_pool(8)
+    handles = coroutine_pool.go_many(short(order) for _ in range(20))
+    coroutine_pool.stop()
+    coroutine_pool.is_stopped(waiting=True)
+    assert order == ["short"] * 20 and all(handle.done() for handle in handles)
+
+    order = []
+    start_pool(8)
+    long = coroutine_pool.go(work(order, "worker"))
+    start_time = time.time()
+    coroutine_pool.stop(timeout=0.3)
+    coroutine_pool.is_stopped(waiting=True)
+    elapsed = time.time() - start_time
+    print(f'stop with timeout: {elapsed:.3f}s {order}')
+    assert long.cancelled() and elapsed < 0.3 + FORCE_STOP_TIMEOUT
+
+
+def teardown_module():
+    # 恢复默认的协程数量上限，之后的测试使用同一个协程池
+    coroutine_pool.reset(loop=asyncio.new_event_loop())
+
+
+if __name__ == '__main__':
+    test_force_stop()
+    test_stop()
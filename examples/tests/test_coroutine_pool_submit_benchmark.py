@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+
+
+import time
+import asyncio
+import threading
+from sprite.utils.coroutinePool import coroutine_pool, TaskHandle
+
+"""
+其他线程向协程池提交任务的性能测试，从第一个任务提交到所有任务执行完毕的耗时
+    1.旧的提交方式：每个任务一次 run_coroutine_threadsafe（一次self-pipe写入、一个future、一个提交任务的task）
+    2.go：待提交的任务合并之后一次唤醒事件循环
+    3.go_many：整批任务一次唤醒事件循环
+"""
+
+TASK_COUNT = 100000
+ROUNDS = 3
+
+
+class Counter:
+    def __init__(self, target: int):
+        self.target = target
+        self.count = 0
+        self.done = threading.Event()
+
+    async def task(self):
+        self.count += 1
+        if self.count == self.target:
+            self.done.set()
+
+
+async def legacy_go(task):
+    coroutine_pool._submit(TaskHandle(coroutine_pool, task))
+
+
+def submit_legacy(counter: Counter):
+    for _ in range(counter.target):
+        asyncio.run_coroutine_threadsafe(legacy_go(counter.task()), coroutine_pool.loop)
+
+
+def submit_go(counter: Counter):
+    for _ in range(counter.target):
+        coroutine_pool.go(counter.task())
+
+
+def submit_go_many(counter: Counter):
+    coroutine_pool.go_many(counter.task() for _ in range(counter.target))
+
+
+def bench(submit) -> float:
+    best = None
+    for _ in range(ROUNDS):
+        counter = Counter(TASK_COUNT)
+        start = time.perf_counter()
+        submit(counter)
+        counter.done.wait()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    coroutine_pool.reset(max_coroutine_amount=1000)
+    coroutine_pool.start()
+    results = [("run_coroutine_threadsafe", bench(submit_legacy)),
+               ("go (coalesced)", bench(submit_go)),
+               ("go_many", bench(submit_go_many))]
+    baseline = results[0][1]
+    for name, elapsed in results:
+        print(f'{name:>26}: {elapsed:6.3f}s  {elapsed / TASK_COUNT * 1e6:6.2f}us/task  {baseline / elapsed:5.1f}x')
+    coroutine_pool.stop()
+    coroutine_pool.is_stopped(waiting=True)
@@ -0,0 +1,137 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+import asyncio
+import threading
+from sprite import Spider, Request, Item, Field, cpu_bound
+from sprite.core.executor import CallbackExecutor, EXECUTOR_PROCESS, EXECUTOR_THREAD
+from sprite.utils.http.response import Response
+
+"""
+CPU密集型回调函数执行器的测试
+    1.标记方式：@cpu_bound装饰、爬虫的cpu_bound属性、request.meta["cpu_bound"]（优先级最高），进程池只能执行爬虫的方法
+    2.线程池：异步生成器、生成器、协程、普通函数的结果都被收集，在其他线程中执行
+    3.进程池：在工作进程中执行，产生的Request发回主进程之后回调函数对应主进程中爬虫的方法，Item原样发回
+"""
+
+
+class PageItem(Item):
+    url = Field()
+    worker = Field()
+
+
+class CpuSpider(Spider):
+    name = "cpu"
+
+    async def parse(self, response):
+        pass
+
+    @cpu_bound
+    async def parse_page(self, response):
+        yield PageItem(url=response.url, worker=os.getpid())
+        for i in range(3):
+            yield Request(url=f'{response.url}/{i}', callback=self.parse, meta={"depth": i})
+
+    def parse_plain(self, response):
+        return PageItem(url=response.url, worker=threading.get_ident())
+
+    def parse_generator(self, response):
+        for i in range(2):
+            yield PageItem(url=f'{response.url}#{i}', worker=threading.get_ident())
+
+    async def parse_coroutine(self, response):
+        return PageItem(url=response.url, worker=threading.get_ident())
+
+
+def make_response(spider: Spider, callback, meta: dict = None) -> Response:
+    request = Request(url="http://cpu.test/page", callback=callback, meta=meta)
+    return Response(url=request.url, body="ok", request=request)
+
+
+def test_is_cpu_bound():
+    spider = CpuSpider()
+    executor = CallbackExecutor(spider, mode=EXECUTOR_PROCESS)
+    assert executor.is_cpu_bound(spider.parse_page, make_response(spider, spider.parse_page))
+    assert not executor.is_cpu_bound(spider.parse, make_response(spider, spider.parse))
+    # meta的优先级最高
+    assert executor.is_cpu_bound(spider.parse, make_response(spider, spider.parse, {"cpu_bound": True}))
+    assert not executor.is_cpu_bound(spider.parse_page, make_response(spider, spider.parse_page,
+                                                                      {"cpu_bound": False}))
+    spider.cpu_bound = True
+    assert executor.is_cpu_bound(spider.parse, make_response(spider, spider.parse))
+
+    # 不是爬虫的方法，进程池中无法按名称调用，在事件循环中执行；线程池中可以执行
+    @cpu_bound
+    async def parse_outside(response):
+        pass
+
+    assert not executor.is_cpu_bound(parse_outside, make_response(spider, parse_outside))
+    assert CallbackExecutor(spider, mode=EXECUTOR_THREAD).is_cpu_bound(parse_outside,
+                                                                       make_response(spider, parse_outside))
+    try:
+        CallbackExecutor(spider, mode="gpu")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("unknown executor mode is accepted")
+
+
+async def collect(executor: CallbackExecutor, callback, response: Response) -> list:
+    return [result async for result in executor.run(callback, response)]
+
+
+async def check_thread_executor():
+    spider = CpuSpider()
+    executor = CallbackExecutor(spider, mode=EXECUTOR_THREAD, max_workers=2)
+    try:
+        main_thread = threading.get_ident()
+        for callback, count in ((spider.parse_page, 4), (spider.parse_plain, 1), (spider.parse_generator, 2),
+                                (spider.parse_coroutine, 1)):
+            results = await collect(executor, callback, make_response(spider, callback))
+            assert len(results) == count, (callback, results)
+            for result in results:
+                if isinstance(result, PageItem) and callback != spider.parse_page:
+                    assert result["worker"] != main_thread
+        assert executor.stats() == {"cpu_bound_callback_count": 4, "cpu_bound_pending_count": 0}
+    finally:
+        executor.close()
+
+
+async def check_process_executor():
+    spider = CpuSpider()
+    executor = CallbackExecutor(spider, mode=EXECUTOR_PROCESS, max_workers=1)
+    try:
+        results = await collect(executor, spider.parse_page, make_response(spider, spider.parse_page))
+        items = [result for result in results if isinstance(result, PageItem)]
+        requests = [result for result in results if isinstance(result, Request)]
+        assert len(items) == 1 and items[0]["worker"] != os.getpid(), items
+        assert [request.url for request in requests] == [f'http://cpu.test/page/{i}' for i in range(3)]
+        # 回调函数对应主进程中的爬虫实例
+        assert all(request.callback == spider.parse for request in requests)
+        assert [request.meta["depth"] for request in requests] == [0, 1, 2]
+    finally:
+        executor.close()
+
+
+def run(coroutine):
+    # 不使用asyncio.run，它会清空当前线程的事件循环，影响之后的测试
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_thread_executor():
+    run(check_thread_executor())
+
+
+def test_process_executor():
+    run(check_process_executor())
+
+
+if __name__ == '__main__':
+    test_is_cpu_bound()
+    test_thread_executor()
+    test_process_executor()
@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+
+
+import asyncio
+from sprite import Spider, Settings, Request
+from sprite.core.scheduler import Scheduler
+from sprite.utils.cuckoofilter import CuckooFilter
+
+"""
+布谷鸟过滤器去重的测试
+    1.通过调度器加入超过容量的request，过滤器满了之后新的request当作已经存在被过滤，不会抛出异常
+    2.删除之后的key可以重新加入
+"""
+
+CAPACITY = 100
+REQUEST_COUNT = 1000
+
+
+class CuckooSpider(Spider):
+    name = "cuckoo"
+
+    async def parse(self, response):
+        pass
+
+
+async def check_fill_past_capacity():
+    spider = CuckooSpider()
+    settings = Settings(values={
+        "DUPEFILTER": "cuckoo",
+        "CUCKOO_CAPACITY": CAPACITY,
+        "CUCKOO_FINGERPRINT_BITS": 32,
+    })
+    scheduler = Scheduler.from_settings(settings, spider)
+    scheduler.start()
+    for i in range(REQUEST_COUNT // 2):
+        scheduler.enqueue_request(Request(url=f'http://cuckoo.test/{i}', callback=spider.parse))
+    scheduler.enqueue_requests(Request(url=f'http://cuckoo.test/{i}', callback=spider.parse)
+                               for i in range(REQUEST_COUNT // 2, REQUEST_COUNT))
+    df = scheduler._df
+    assert isinstance(df, CuckooFilter)
+    stats = scheduler.stats()
+    # 加入队列的request都在过滤器中，其他的被拒绝
+    assert stats["frontier_size"] == len(df) and len(df) <= df.size, stats
+    assert stats["dupefilter_rejected_count"] == REQUEST_COUNT - len(df), stats
+    print(f'{len(df)} requests enqueued, {df.rejected_count} rejected by a full filter of {df.size} slots')
+    scheduler.close()
+
+
+def test_fill_past_capacity():
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(check_fill_past_capacity())
+    finally:
+        loop.close()
+
+
+def test_remove():
+    cuckoo_filter = CuckooFilter(capacity=CAPACITY, fingerprint_bits=32)
+    keys = [f'key-{i}' for i in range(CAPACITY)]
+    assert not any(cuckoo_filter.add(key) for key in keys)
+    assert all(cuckoo_filter.add(key) for key in keys)
+    assert cuckoo_filter.remove(keys[0]) and keys[0] not in cuckoo_filter
+    assert not cuckoo_filter.add(keys[0]) and len(cuckoo_filter) == CAPACITY
+
+
+if __name__ == '__main__':
+    test_fill_past_capacity()
+    test_remove()
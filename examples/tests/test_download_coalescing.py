@@ -0,0 +1,110 @@
+# -*- coding:utf-8 -*-
+
+
+import asyncio
+from sprite import Spider, Settings, Request, PyCoroutinePool
+from sprite.core.engine import Engine
+from sprite.middlewaremanager import MiddlewareManager
+from sprite.utils.http.response import Response
+
+"""
+合并下载（request.meta["coalesce"]）的测试
+    1.指纹相同的request同时下载时只下载一次，所有的request拿到同一个response，下载数量、成功数量只统计一次
+    2.正在下载的request被取消时，等待的request不会跟着被取消，由其中一个重新下载，其他的等待它的结果
+"""
+
+WAITER_COUNT = 4
+
+
+class CoalesceSpider(Spider):
+    name = "coalesce"
+
+    async def parse(self, response):
+        pass
+
+
+class FakeDownloader:
+    # 不访问网络，收到信号之后才返回response
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def request(self, request: Request) -> Response:
+        self.calls += 1
+        await self.release.wait()
+        return Response(url=request.url, body="ok", request=request)
+
+
+def create_engine(spider: Spider) -> (Engine, FakeDownloader):
+    engine = Engine.from_settings(Settings(values={"DELAY": 0}), spider, MiddlewareManager(),
+                                  coroutine_pool=PyCoroutinePool())
+    downloader = FakeDownloader()
+    engine._downloader = downloader
+    return engine, downloader
+
+
+def coalesce_request(spider: Spider) -> Request:
+    return Request(url="http://coalesce.test/shared", callback=spider.parse, dont_filter=True,
+                   meta={"coalesce": True})
+
+
+async def check_coalesce():
+    spider = CoalesceSpider()
+    engine, downloader = create_engine(spider)
+    tasks = [asyncio.ensure_future(engine._download(coalesce_request(spider))) for _ in range(WAITER_COUNT + 1)]
+    await asyncio.sleep(0.01)
+    downloader.release.set()
+    results = await asyncio.gather(*tasks)
+    assert downloader.calls == 1, downloader.calls
+    assert len({id(response) for _, response in results}) == 1
+    stats = engine.get_crawl_stats()
+    assert stats["downloaded_request_count"] == 1, stats
+    assert stats["success_request_count"] == 1, stats
+    assert stats["failed_request_count"] == 0, stats
+    assert stats["coalesced_request_count"] == WAITER_COUNT, stats
+    assert not engine._in_flight_downloads
+
+
+async def check_leader_cancelled():
+    spider = CoalesceSpider()
+    engine, downloader = create_engine(spider)
+    leader = asyncio.ensure_future(engine._download(coalesce_request(spider)))
+    await asyncio.sleep(0.01)
+    waiters = [asyncio.ensure_future(engine._download(coalesce_request(spider))) for _ in range(WAITER_COUNT)]
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    await asyncio.sleep(0.01)
+    # 其中一个等待者重新下载
+    assert downloader.calls == 2, downloader.calls
+    downloader.release.set()
+    results = await asyncio.gather(*waiters)
+    assert leader.cancelled()
+    assert len({id(response) for _, response in results}) == 1
+    stats = engine.get_crawl_stats()
+    # 被取消的request不统计在下载数量中
+    assert stats["downloaded_request_count"] == 1, stats
+    assert stats["success_request_count"] == 1, stats
+    assert stats["coalesced_request_count"] == WAITER_COUNT - 1, stats
+    assert not engine._in_flight_downloads
+
+
+def run(coroutine):
+    # 不使用asyncio.run，它会清空当前线程的事件循环，影响之后的测试
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_coalesce():
+    run(check_coalesce())
+
+
+def test_leader_cancelled():
+    run(check_leader_cancelled())
+
+
+if __name__ == '__main__':
+    test_coalesce()
+    test_leader_cancelled()
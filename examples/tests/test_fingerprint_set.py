@@ -0,0 +1,100 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+import random
+import tempfile
+from sprite.utils.fingerprintset import FingerprintSet, MASK64
+
+"""
+精确去重指纹集合的测试
+    1.加入的结果和python的set一致，合并过程中run的数量保持在O(log n)
+    2.批量加入和逐个加入的结果一致
+    3.保存到文件之后重新打开，之前加入的指纹都存在，没有新的指纹时checkpoint不重写文件
+"""
+
+KEY_COUNT = 20000
+MERGE_SIZE = 64
+
+
+def random_keys(count: int, seed: int) -> list:
+    rand = random.Random(seed)
+    # 有一部分重复的指纹，以及超过64位的指纹（只保留低64位）
+    keys = [rand.getrandbits(64) for _ in range(count)]
+    keys += [rand.choice(keys) for _ in range(count // 4)]
+    keys += [(1 << 64) | key for key in rand.sample(keys, count // 10)]
+    rand.shuffle(keys)
+    return keys
+
+
+def test_merge():
+    keys = random_keys(KEY_COUNT, 1)
+    fingerprints = FingerprintSet(merge_size=MERGE_SIZE)
+    expected = set()
+    max_runs = 0
+    for key in keys:
+        assert fingerprints.add(key) == ((key & MASK64) in expected)
+        expected.add(key & MASK64)
+        max_runs = max(max_runs, len(fingerprints._runs))
+    assert len(fingerprints) == len(expected)
+    # run的长度从大到小，每一个都大于后一个的两倍
+    for left, right in zip(fingerprints._runs, fingerprints._runs[1:]):
+        assert len(left) > 2 * len(right), [len(run) for run in fingerprints._runs]
+    assert max_runs <= (len(expected) // MERGE_SIZE).bit_length() + 1, max_runs
+    for run in fingerprints._runs:
+        assert (run[1:] > run[:-1]).all()
+    assert all(fingerprints.contains_many(list(expected)[:1000]))
+    assert not any(fingerprints.contains_many(random_keys(1000, 2)[:1000]))
+
+    fingerprints.merge()
+    assert len(fingerprints._runs) == 1 and len(fingerprints) == len(expected)
+    assert sorted(expected) == fingerprints._runs[0].tolist()
+    print(f'{len(expected)} fingerprints, at most {max_runs} runs before merging')
+
+
+def test_add_many():
+    keys = random_keys(KEY_COUNT, 3)
+    one_by_one = FingerprintSet(merge_size=MERGE_SIZE)
+    batched = FingerprintSet(merge_size=MERGE_SIZE)
+    expected = [one_by_one.add(key) for key in keys]
+    result = []
+    for i in range(0, len(keys), 500):
+        result.extend(batched.add_many(keys[i:i + 500]))
+    assert result == expected
+    assert len(batched) == len(one_by_one)
+
+
+def test_reopen():
+    keys = random_keys(KEY_COUNT, 4)
+    with tempfile.TemporaryDirectory() as job_dir:
+        path = os.path.join(job_dir, "fingerprints.npy")
+        fingerprints = FingerprintSet(path=path, merge_size=MERGE_SIZE)
+        fingerprints.add_many(keys[:KEY_COUNT // 2])
+        # 加入指纹时只在内存中合并，不写文件
+        assert not os.path.exists(path)
+        fingerprints.checkpoint()
+        assert os.path.exists(path)
+        stat = os.stat(path)
+        fingerprints.checkpoint()
+        assert os.stat(path).st_mtime_ns == stat.st_mtime_ns, "nothing added, file should not be rewritten"
+        fingerprints.add_many(keys[KEY_COUNT // 2:])
+        count = len(fingerprints)
+        fingerprints.close()
+
+        # 重新打开之后，和保存到文件中的run继续合并
+        fingerprints = FingerprintSet(path=path, merge_size=MERGE_SIZE)
+        assert len(fingerprints) == count
+        assert all(fingerprints.add_many(keys))
+        new_keys = random_keys(KEY_COUNT, 5)
+        fingerprints.add_many(new_keys)
+        fingerprints.close()
+        fingerprints = FingerprintSet(path=path, merge_size=MERGE_SIZE)
+        assert all(fingerprints.contains_many(keys + new_keys))
+        assert len(fingerprints) == len({key & MASK64 for key in keys + new_keys})
+        print(f'reopened {len(fingerprints)} fingerprints')
+
+
+if __name__ == '__main__':
+    test_merge()
+    test_add_many()
+    test_reopen()
@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+import time
+import asyncio
+from sprite import Spider, Crawler, Settings, Request, PyCoroutinePool
+from sprite.middlewaremanager import MiddlewareManager
+from sprite.utils.http.response import Response
+
+"""
+调度器上限（FRONTIER_HIGH_WATER）block方式的测试
+    每个页面产生多个子页面，回调函数产生request的速度远大于消耗的速度，
+    所有的工作协程、解析协程都会因为调度器满了而挂起，调度器中的request始终不超过上限，并且所有的页面都被抓取
+"""
+
+PAGE_COUNT = 1000
+CHILD_COUNT = 5
+HIGH_WATER = 20
+CRAWL_TIMEOUT = 60
+
+
+class FanOutSpider(Spider):
+    name = "backpressure"
+
+    def __init__(self):
+        super(FanOutSpider, self).__init__()
+        self.fetched = set()
+
+    async def start_request(self):
+        yield Request(url="http://backpressure.test/0", callback=self.parse)
+
+    async def parse(self, response):
+        page = int(response.request.url.rsplit("/", 1)[1])
+        self.fetched.add(page)
+        for i in range(CHILD_COUNT):
+            child = page * CHILD_COUNT + i + 1
+            if child < PAGE_COUNT:
+                yield Request(url=f'http://backpressure.test/{child}', callback=self.parse)
+
+
+def crawl(values: dict) -> (FanOutSpider, int):
+    spider = FanOutSpider()
+    middlewareManager = MiddlewareManager()
+    max_frontier = [0]
+    crawler = None
+
+    @middlewareManager.add_spider_middleware()
+    async def watch_frontier(spider):
+        # 记录每一次加入request之后调度器中的request数量
+        queue = crawler._engine._scheduler._priorityQueue
+        push = queue.push
+
+        def watched_push(*args, **kwargs):
+            push(*args, **kwargs)
+            max_frontier[0] = max(max_frontier[0], len(queue))
+
+        queue.push = watched_push
+
+    @middlewareManager.add_download_middleware()
+    async def fake_download(request, spider):
+        # 不访问网络，直接返回response
+        await asyncio.sleep(0)
+        return Response(url=request.url, body="ok", request=request)
+
+    settings = {
+        "DELAY": 0,
+        "WORKER_NUM": 8,
+        "FRONTIER_HIGH_WATER": HIGH_WATER,
+        "FRONTIER_OVERFLOW": "block",
+        "ENQUEUE_BATCH_SIZE": 8,
+    }
+    settings.update(values)
+    crawler = Crawler(spider=spider, middlewareManager=middlewareManager, settings=Settings(values=settings),
+                      coroutine_pool=pool)
+    crawler.run()
+    deadline = time.time() + CRAWL_TIMEOUT
+    time.sleep(0.5)
+    while not crawler.is_stopped() and time.time() < deadline:
+        time.sleep(0.1)
+    assert crawler.is_stopped(), "crawl does not finish, workers may wait for each other"
+    return spider, max_frontier[0]
+
+
+def check_crawl(values: dict):
+    spider, max_frontier = crawl(values)
+    print(f'{values}: fetched {len(spider.fetched)} pages, max frontier {max_frontier}')
+    assert spider.fetched == set(range(PAGE_COUNT)), len(spider.fetched)
+    assert 0 < max_frontier <= HIGH_WATER, max_frontier
+
+
+def test_block_inline():
+    check_crawl({})
+
+
+def test_block_staged():
+    check_crawl({"ENGINE_MODE": "staged", "DOWNLOAD_WORKER_NUM": 4, "PARSE_WORKER_NUM": 2})
+
+
+def test_block_host_queue():
+    # 回调函数挂起时不占用域名的并发数
+    check_crawl({"SCHEDULER_QUEUE": "host", "HOST_DELAY": 0, "HOST_MAX_IN_FLIGHT": 2})
+
+
+pool = PyCoroutinePool()
+
+
+def setup_module():
+    pool.reset_after_fork()
+    pool.start()
+
+
+def teardown_module():
+    pool.stop()
+    pool.is_stopped(waiting=True)
+
+
+if __name__ == '__main__':
+    setup_module()
+    try:
+        test_block_inline()
+        test_block_staged()
+        test_block_host_queue()
+    finally:
+        teardown_module()
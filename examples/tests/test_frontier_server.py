@@ -0,0 +1,191 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+import time
+import asyncio
+import threading
+import traceback
+import multiprocessing
+from queue import Empty
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from sprite import Spider, Crawler, Settings, Request, PyCoroutinePool
+from sprite.middlewaremanager import MiddlewareManager
+from sprite.core.frontier import FrontierServer, FrontierClient
+
+"""
+frontier服务的测试，在本机运行
+    1.一个进程运行frontier服务，多个进程各自运行一个Crawler，共享frontier服务中的队列和去重过滤器，
+      所有进程抓取的url合起来正好是全部页面，并且没有重复抓取
+    2.租出的request没有ack，超过租约时间之后重新投递给其他客户端
+"""
+
+PAGE_COUNT = 300
+CHILD_COUNT = 3
+CLIENT_COUNT = 3
+# 所有客户端抓取完毕的最长时间
+CRAWL_TIMEOUT = 60
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class TreeSpider(Spider):
+    name = "frontier_tree"
+
+    def __init__(self, base_url: str, fetched):
+        super(TreeSpider, self).__init__()
+        self.base_url = base_url
+        self.fetched = fetched
+
+    async def start_request(self):
+        # 每个客户端都产生同一个start request，由frontier服务去重
+        yield Request(url=f'{self.base_url}/0', callback=self.parse)
+
+    async def parse(self, response):
+        page = int(response.request.url.rsplit("/", 1)[1])
+        self.fetched.put((os.getpid(), page))
+        for i in range(CHILD_COUNT):
+            child = page * CHILD_COUNT + i + 1
+            if child < PAGE_COUNT:
+                yield Request(url=f'{self.base_url}/{child}', callback=self.parse)
+
+
+def run_server(port_queue):
+    server = FrontierServer(host="127.0.0.1", port=0)
+
+    async def serve():
+        await server.start()
+        port_queue.put(server.port)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(serve())
+    loop.run_forever()
+
+
+def run_client(frontier_port: int, base_url: str, fetched):
+    exitcode = 0
+    try:
+        # fork出来的子进程中重新初始化继承下来的协程池和事件循环
+        pool = PyCoroutinePool()
+        pool.reset_after_fork()
+        pool.start()
+        settings = Settings(values={
+            "FRONTIER_SERVER": f'127.0.0.1:{frontier_port}',
+            "FRONTIER_IDLE_TIMEOUT": 1,
+            "FRONTIER_LEASE_SIZE": 5,
+            "DELAY": 0,
+            "WORKER_NUM": 4,
+        })
+        crawler = Crawler(spider=TreeSpider(base_url, fetched), middlewareManager=MiddlewareManager(),
+                          settings=settings, coroutine_pool=pool)
+        crawler.run()
+        time.sleep(0.5)
+        while not crawler.is_stopped():
+            time.sleep(0.1)
+    except BaseException:
+        traceback.print_exc()
+        exitcode = 1
+    fetched.close()
+    fetched.join_thread()
+    # 协程池的事件循环线程不是守护线程，直接退出，出错时返回非0让父进程知道
+    os._exit(exitcode)
+
+
+def test_shared_crawl():
+    http_server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{http_server.server_address[1]}'
+
+    ctx = multiprocessing.get_context("fork")
+    port_queue = ctx.Queue()
+    fetched = ctx.Queue()
+    server_process = ctx.Process(target=run_server, args=(port_queue,), daemon=True)
+    server_process.start()
+    frontier_port = port_queue.get(timeout=10)
+
+    start_time = time.time()
+    clients = [ctx.Process(target=run_client, args=(frontier_port, base_url, fetched)) for _ in range(CLIENT_COUNT)]
+    for client in clients:
+        client.start()
+    pages = []
+    deadline = start_time + CRAWL_TIMEOUT
+    while (any(client.is_alive() for client in clients) or not fetched.empty()) and time.time() < deadline:
+        try:
+            pages.append(fetched.get(timeout=0.1))
+        except Empty:
+            pass
+    elapsed = time.time() - start_time
+    exitcodes = []
+    for client in clients:
+        client.join(timeout=max(deadline - time.time(), 0.1))
+        if client.is_alive():
+            client.kill()
+            client.join()
+        exitcodes.append(client.exitcode)
+    server_process.terminate()
+    http_server.shutdown()
+    assert exitcodes == [0] * CLIENT_COUNT, f'clients failed or timed out, exit codes: {exitcodes}'
+
+    fetched_pages = [page for _, page in pages]
+    per_client = {}
+    for pid, _ in pages:
+        per_client[pid] = per_client.get(pid, 0) + 1
+    print(f'{len(fetched_pages)} pages fetched by {len(per_client)} clients in {elapsed:.2f}s: {per_client}')
+    assert set(fetched_pages) == set(range(PAGE_COUNT)), "some pages are not fetched"
+    assert len(fetched_pages) == PAGE_COUNT, "some pages are fetched more than once"
+
+
+async def check_redelivery():
+    server = FrontierServer(host="127.0.0.1", port=0, lease_timeout=0.3)
+    await server.start()
+    first = FrontierClient("127.0.0.1", server.port)
+    second = FrontierClient("127.0.0.1", server.port)
+    try:
+        response = await first.enqueue([[1, "http://a:80", 0, "YQ==", False],
+                                        [2, "http://b:80", 0, "Yg==", False],
+                                        [1, "http://a:80", 0, "YQ==", False]])
+        assert response["added"] == 2 and response["queued"] == 2
+        # 第一个客户端租用之后不ack
+        response = await first.lease(10)
+        assert len(response["items"]) == 2 and response["leased"] == 2
+        response = await second.lease(10)
+        assert not response["items"]
+        # 超过租约时间之后重新投递给第二个客户端
+        response = await second.lease(10, wait=2)
+        assert len(response["items"]) == 2, response
+        await second.ack([lease_id for lease_id, _ in response["items"]])
+        stats = await second.stats()
+        assert stats["queued"] == 0 and stats["leased"] == 0, stats
+        assert stats["redelivered_count"] == 2 and stats["duplicate_count"] == 1, stats
+        print(f'redelivery: {stats}')
+    finally:
+        first.close()
+        second.close()
+        server.close()
+        # 等待服务端的连接处理协程退出
+        await asyncio.sleep(0.1)
+
+
+def test_redelivery():
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(check_redelivery())
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    test_redelivery()
+    test_shared_crawl()
@@ -0,0 +1,123 @@
+# -*- coding:utf-8 -*-
+
+
+import time
+import asyncio
+from sprite import Spider, Settings, Request
+from sprite.core.scheduler import Scheduler
+from sprite.utils.queues import HostQueue
+from sprite.utils.request import request_host_key
+
+"""
+按照域名分片的队列（SCHEDULER_QUEUE = "host"）的测试
+    1.同一个域名两次弹出之间至少间隔delay秒，期间其他域名的request不受影响
+    2.同一个域名正在处理中的数量不超过max_in_flight，release之后才能继续弹出
+    3.同一个域名下按照优先级弹出
+    4.调度器的next_request等待域名就绪之后返回
+"""
+
+DELAY = 0.2
+
+
+class HostSpider(Spider):
+    name = "host"
+
+    async def parse(self, response):
+        pass
+
+
+def pop_or_none(queue: HostQueue):
+    try:
+        return queue.pop()[0]
+    except IndexError:
+        return None
+
+
+def test_politeness():
+    queue = HostQueue(key=lambda item: item.split("/")[0], delay=DELAY)
+    for item in ("a/1", "a/2", "b/1"):
+        queue.push(item)
+    first, second = pop_or_none(queue), pop_or_none(queue)
+    assert {first, second} == {"a/1", "b/1"}, (first, second)
+    # a和b都在间隔时间内，不能弹出
+    assert pop_or_none(queue) is None
+    assert 0 < queue.ready_in() <= DELAY
+    time.sleep(queue.ready_in())
+    assert pop_or_none(queue) == "a/2"
+    assert len(queue) == 0 and queue.ready_in() is None
+
+
+def test_max_in_flight():
+    queue = HostQueue(key=lambda item: item.split("/")[0], max_in_flight=2)
+    for i in range(4):
+        queue.push(f'a/{i}')
+    queue.push("b/0")
+    popped = [pop_or_none(queue) for _ in range(3)]
+    assert sorted(popped) == ["a/0", "a/1", "b/0"], popped
+    # a已经有两个正在处理中
+    assert pop_or_none(queue) is None and queue.ready_in() is None
+    queue.release("a/0")
+    assert pop_or_none(queue) == "a/2"
+    assert pop_or_none(queue) is None
+    # 不属于任何正在处理中的元素的release被忽略
+    queue.release("c/0")
+    queue.release("a/1")
+    assert pop_or_none(queue) == "a/3"
+
+
+def test_priority():
+    queue = HostQueue(key=lambda item: item.split("/")[0])
+    queue.push("a/low", 10)
+    queue.push("a/high", -10)
+    queue.push("a/normal", 0)
+    assert [queue.pop() for _ in range(3)] == [("a/high", -10), ("a/normal", 0), ("a/low", 10)]
+
+
+async def check_scheduler_waits():
+    spider = HostSpider()
+    settings = Settings(values={"SCHEDULER_QUEUE": "host", "HOST_DELAY": DELAY, "HOST_MAX_IN_FLIGHT": 1})
+    scheduler = Scheduler.from_settings(settings, spider)
+    assert isinstance(scheduler._priorityQueue, HostQueue)
+    scheduler.start()
+    for i in range(3):
+        scheduler.enqueue_request(Request(url=f'http://a.host.test/{i}', callback=spider.parse))
+    scheduler.enqueue_request(Request(url="http://b.host.test/0", callback=spider.parse))
+
+    start = time.monotonic()
+    first = await scheduler.next_request()
+    second = await scheduler.next_request()
+    assert {request_host_key(first)[1], request_host_key(second)[1]} == {"a.host.test", "b.host.test"}
+    assert time.monotonic() - start < DELAY
+    a_request = first if request_host_key(first)[1] == "a.host.test" else second
+    scheduler.download_done(a_request)
+
+    third = await scheduler.next_request()
+    assert request_host_key(third)[1] == "a.host.test"
+    assert time.monotonic() - start >= DELAY * 0.9
+    # 没有调用download_done，即使过了间隔时间也不会弹出a的下一个request
+    try:
+        await asyncio.wait_for(scheduler.next_request(), DELAY * 2)
+    except asyncio.TimeoutError:
+        pass
+    else:
+        raise AssertionError("host in flight limit is not respected")
+    scheduler.download_done(third)
+    fourth = await asyncio.wait_for(scheduler.next_request(), DELAY * 2)
+    assert request_host_key(fourth)[1] == "a.host.test"
+    scheduler.close()
+
+
+def test_scheduler_waits():
+    # 不使用asyncio.run，它会清空当前线程的事件循环，影响之后的测试
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(check_scheduler_waits())
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    test_politeness()
+    test_max_in_flight()
+    test_priority()
+    test_scheduler_waits()
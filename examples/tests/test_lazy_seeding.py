@@ -0,0 +1,112 @@
+# -*- coding:utf-8 -*-
+
+
+import time
+import asyncio
+from sprite import Spider, Crawler, Settings, Request, PyCoroutinePool
+from sprite.middlewaremanager import MiddlewareManager
+from sprite.utils.http.response import Response
+
+"""
+按需拉取start_requests的测试
+    1.第一批request加入调度器之后工作协程就开始工作，不需要等所有的start_requests都生成完
+    2.调度器中的request不少于START_REQUESTS_LOW_WATER时暂停拉取，调度器中的request不会超过低水位加一批的数量
+    3.所有的start_requests最终都被抓取，拉取过程中调度器暂时为空时工作协程不会提前退出
+"""
+
+SEED_COUNT = 2000
+LOW_WATER = 50
+BATCH_SIZE = 10
+CRAWL_TIMEOUT = 60
+
+
+class SeedSpider(Spider):
+    name = "seed"
+
+    def __init__(self):
+        super(SeedSpider, self).__init__()
+        self.yielded = 0
+        self.yielded_at_first_response = None
+        self.fetched = set()
+
+    async def start_request(self):
+        for i in range(SEED_COUNT):
+            self.yielded += 1
+            yield Request(url=f'http://seed.test/{i}', callback=self.parse)
+            if i % 100 == 0:
+                # 生成种子的过程中有耗时的操作（例如读取文件、数据库）
+                await asyncio.sleep(0)
+
+    async def parse(self, response):
+        if self.yielded_at_first_response is None:
+            self.yielded_at_first_response = self.yielded
+        self.fetched.add(response.request.url)
+
+
+def crawl() -> (SeedSpider, int):
+    spider = SeedSpider()
+    middlewareManager = MiddlewareManager()
+    max_frontier = [0]
+    crawler = None
+
+    @middlewareManager.add_spider_middleware()
+    async def watch_frontier(spider):
+        # 记录每一次加入request之后调度器中的request数量
+        queue = crawler._engine._scheduler._priorityQueue
+        push = queue.push
+
+        def watched_push(*args, **kwargs):
+            push(*args, **kwargs)
+            max_frontier[0] = max(max_frontier[0], len(queue))
+
+        queue.push = watched_push
+
+    @middlewareManager.add_download_middleware()
+    async def fake_download(request, spider):
+        # 不访问网络，直接返回response
+        await asyncio.sleep(0)
+        return Response(url=request.url, body="ok", request=request)
+
+    settings = Settings(values={
+        "DELAY": 0,
+        "WORKER_NUM": 4,
+        "START_REQUESTS_LOW_WATER": LOW_WATER,
+        "ENQUEUE_BATCH_SIZE": BATCH_SIZE,
+    })
+    crawler = Crawler(spider=spider, middlewareManager=middlewareManager, settings=settings, coroutine_pool=pool)
+    crawler.run()
+    deadline = time.time() + CRAWL_TIMEOUT
+    time.sleep(0.5)
+    while not crawler.is_stopped() and time.time() < deadline:
+        time.sleep(0.1)
+    assert crawler.is_stopped(), "crawl does not finish"
+    return spider, max_frontier[0]
+
+
+def test_lazy_seeding():
+    spider, max_frontier = crawl()
+    print(f'{spider.yielded_at_first_response} seeds yielded before the first response, max frontier {max_frontier}')
+    assert len(spider.fetched) == SEED_COUNT, len(spider.fetched)
+    assert spider.yielded_at_first_response <= LOW_WATER + BATCH_SIZE, spider.yielded_at_first_response
+    assert max_frontier < LOW_WATER + BATCH_SIZE, max_frontier
+
+
+pool = PyCoroutinePool()
+
+
+def setup_module():
+    pool.reset_after_fork()
+    pool.start()
+
+
+def teardown_module():
+    pool.stop()
+    pool.is_stopped(waiting=True)
+
+
+if __name__ == '__main__':
+    setup_module()
+    try:
+        test_lazy_seeding()
+    finally:
+        teardown_module()
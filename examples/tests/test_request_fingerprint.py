@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+
+
+from sprite import Request
+from sprite.utils.request import RequestFingerprinter, canonical_url, request_fingerprint, request_host_key
+
+"""
+request去重指纹的测试
+    1.规范化url：域名小写、查询参数排序、去掉锚点、统一百分号编码的大小写、去掉默认端口，等价的url指纹相同
+    2.非默认端口、method、query、formdata不同时指纹不同，指定了请求头时请求头参与计算
+    3.64位、128位的指纹，以及热点url的指纹缓存
+"""
+
+
+async def parse(response):
+    pass
+
+
+def make_request(**kwargs) -> Request:
+    return Request(callback=parse, **kwargs)
+
+
+def test_canonical_url():
+    assert canonical_url("http://Example.COM:80/a%2fb?b=2&a=1#frag") == "http://example.com/a%2Fb?a=1&b=2"
+    assert canonical_url("https://example.com:443/") == "https://example.com/"
+    # 非默认端口，以及http使用443端口时保留端口
+    assert canonical_url("http://example.com:8080/x") == "http://example.com:8080/x"
+    assert canonical_url("http://example.com:443/x") == "http://example.com:443/x"
+
+
+def test_equivalent_requests():
+    same = [
+        make_request(url="http://Example.com:80/page?b=2&a=1#top"),
+        make_request(url="http://example.com/page?a=1&b=2"),
+        make_request(url="http://example.com:80/page?a=1&b=2#bottom"),
+    ]
+    assert len({request_fingerprint(request) for request in same}) == 1
+    assert request_fingerprint(make_request(url="https://example.com:443/page", query={"a": 1, "b": 2})) == \
+        request_fingerprint(make_request(url="https://example.com/page", query={"b": "2", "a": "1"}))
+
+
+def test_different_requests():
+    base = make_request(url="http://example.com/page")
+    different = [
+        make_request(url="http://example.com:8080/page"),
+        make_request(url="https://example.com/page"),
+        make_request(url="http://example.com/page", query={"a": 1}),
+        make_request(url="http://example.com/page", method="POST"),
+        make_request(url="http://example.com/page", method="POST", formdata={"a": 1}),
+    ]
+    fingerprints = {request_fingerprint(request) for request in [base] + different}
+    assert len(fingerprints) == len(different) + 1
+
+
+def test_headers():
+    plain = RequestFingerprinter()
+    with_headers = RequestFingerprinter(include_headers=["Accept-Language"])
+    english = make_request(url="http://example.com/", headers={"accept-language": "en"})
+    chinese = make_request(url="http://example.com/", headers={"Accept-Language": "zh"})
+    assert plain(english) == plain(chinese)
+    assert with_headers(english) != with_headers(chinese)
+    upper = make_request(url="http://example.com/", headers={"ACCEPT-LANGUAGE": "en"})
+    assert with_headers(english) == with_headers(upper)
+
+
+def test_bits_and_cache():
+    request = make_request(url="http://example.com/page")
+    assert 0 <= RequestFingerprinter(bits=64)(request) < 1 << 64
+    fingerprint = RequestFingerprinter(bits=128)(request)
+    assert 0 <= fingerprint < 1 << 128
+    try:
+        RequestFingerprinter(bits=32)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("32 bits fingerprint is accepted")
+
+    fingerprinter = RequestFingerprinter(cache_size=10)
+    for _ in range(3):
+        fingerprinter(request)
+    assert fingerprinter.cache_info().hits == 2
+    assert RequestFingerprinter(cache_size=0).cache_info() is None
+
+
+def test_host_key():
+    assert request_host_key(make_request(url="http://Example.com/a")) == ("http", "example.com", 80)
+    assert request_host_key(make_request(url="https://example.com:443/a")) == ("https", "example.com", 443)
+    assert request_host_key(make_request(url="http://example.com:8080/a")) == ("http", "example.com", 8080)
+
+
+if __name__ == '__main__':
+    test_canonical_url()
+    test_equivalent_requests()
+    test_different_requests()
+    test_headers()
+    test_bits_and_cache()
+    test_host_key()
@@ -0,0 +1,194 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+import asyncio
+import tempfile
+from sprite import Spider, Settings, Request
+from sprite.core.scheduler import Scheduler
+from sprite.core.mq.spill import SpillQueue
+from sprite.core import journal as journal_module
+from sprite.core.journal import RequestJournal
+
+"""
+长期保存时request日志的测试，调度器使用溢出到磁盘的队列
+    1.溢出到磁盘的request读回来之后是新的对象，处理完毕之后日志中的记录也要标记为完成
+    2.关闭时没有处理完的request，恢复之后只回放这些request
+    3.所有的request都处理完毕之后，日志文件被删除
+    4.打开日志时不重写文件，处理完毕的记录超过阈值之后在子线程中压缩，压缩期间追加的记录不会丢失
+    5.末尾写了一半的记录被截断，之后追加的记录可以正常回放
+    6.定时fsync，间隔时间之内不重复fsync
+"""
+
+REQUEST_COUNT = 20
+PROCESS_COUNT = 12
+
+
+class JournalSpider(Spider):
+    name = "journal"
+
+    async def parse(self, response):
+        pass
+
+
+def create_scheduler(job_dir: str) -> Scheduler:
+    settings = Settings(values={
+        "LONG_SAVE": True,
+        "JOB_DIR": job_dir,
+        "SCHEDULER_QUEUE": "disk",
+        # 内存中最多保存5个request，其他的request溢出到磁盘
+        "FRONTIER_MEMORY_COUNT": 5,
+        "FRONTIER_REFILL_SIZE": 5,
+    })
+    scheduler = Scheduler.from_settings(settings, JournalSpider())
+    assert isinstance(scheduler._priorityQueue, SpillQueue)
+    scheduler.start()
+    return scheduler
+
+
+def process(scheduler: Scheduler, count: int) -> list:
+    urls = []
+    for _ in range(count):
+        request = scheduler.next_request_nowait()
+        urls.append(request.url)
+        scheduler.request_done(request)
+    return urls
+
+
+async def check_resume(job_dir: str):
+    spider = JournalSpider()
+    journal_path = os.path.join(job_dir, "requests.journal")
+
+    scheduler = create_scheduler(job_dir)
+    for i in range(REQUEST_COUNT):
+        scheduler.enqueue_request(Request(url=f'http://journal.test/{i}', callback=spider.parse))
+    processed = process(scheduler, PROCESS_COUNT)
+    assert len(scheduler._journal) == REQUEST_COUNT - PROCESS_COUNT, len(scheduler._journal)
+    scheduler.close()
+    assert os.path.exists(journal_path)
+
+    # 恢复之后只回放没有处理完的request
+    scheduler = create_scheduler(job_dir)
+    remaining = []
+    while scheduler.has_pending_requests():
+        remaining.extend(process(scheduler, 1))
+    assert sorted(processed + remaining) == sorted(f'http://journal.test/{i}' for i in range(REQUEST_COUNT))
+    assert len(remaining) == REQUEST_COUNT - PROCESS_COUNT, remaining
+    assert len(scheduler._journal) == 0
+    scheduler.close()
+    assert not os.path.exists(journal_path), "all requests are done, journal should be removed"
+    print(f'processed {len(processed)} requests, resumed {len(remaining)} requests')
+
+
+def test_journal_resume_with_spill_queue():
+    # 不使用asyncio.run，它会清空当前线程的事件循环，影响之后的测试
+    loop = asyncio.new_event_loop()
+    try:
+        with tempfile.TemporaryDirectory() as job_dir:
+            loop.run_until_complete(check_resume(job_dir))
+    finally:
+        loop.close()
+
+
+def test_open_does_not_rewrite():
+    with tempfile.TemporaryDirectory() as job_dir:
+        path = os.path.join(job_dir, "requests.journal")
+        journal = RequestJournal(path, compact_threshold=1000)
+        journal.open()
+        seqs = [journal.append(f'request {i}'.encode()) for i in range(REQUEST_COUNT)]
+        for seq in seqs[:PROCESS_COUNT]:
+            journal.done(seq)
+        journal.close()
+        inode, size = os.stat(path).st_ino, os.path.getsize(path)
+
+        # 处理完毕的记录没有超过阈值，打开时只读取，不重写文件
+        journal = RequestJournal(path, compact_threshold=1000)
+        records = journal.open()
+        assert [seq for seq, _ in records] == seqs[PROCESS_COUNT:], records
+        journal.close()
+        assert (os.stat(path).st_ino, os.path.getsize(path)) == (inode, size)
+
+
+def test_background_compact():
+    with tempfile.TemporaryDirectory() as job_dir:
+        path = os.path.join(job_dir, "requests.journal")
+        # 不自动刷新，压缩完成之后由下面的flush替换旧的日志文件
+        journal = RequestJournal(path, flush_interval=60, compact_threshold=PROCESS_COUNT)
+        journal.open()
+        seqs = [journal.append(f'request {i}'.encode()) for i in range(REQUEST_COUNT)]
+        for seq in seqs[:PROCESS_COUNT]:
+            journal.done(seq)
+        # 超过阈值之后开始在子线程中压缩，压缩期间继续追加、标记完成
+        assert journal.pending
+        seqs.append(journal.append(b'added while compacting'))
+        journal.done(seqs[PROCESS_COUNT])
+        journal._compactor.join()
+        journal.flush()
+        assert journal._compactor is None
+        size = os.path.getsize(path)
+        journal.close()
+        assert os.path.getsize(path) == size
+
+        journal = RequestJournal(path, compact_threshold=PROCESS_COUNT)
+        records = journal.open()
+        assert [seq for seq, _ in records] == seqs[PROCESS_COUNT + 1:], records
+        assert records[-1][1] == b'added while compacting'
+        journal.close()
+
+
+def test_truncated_record():
+    with tempfile.TemporaryDirectory() as job_dir:
+        path = os.path.join(job_dir, "requests.journal")
+        journal = RequestJournal(path)
+        journal.open()
+        seq = journal.append(b'complete')
+        journal.close()
+        # 模拟进程被杀死时只写了一半的记录
+        with open(path, "ab") as f:
+            f.write(b'E\x01\x00')
+
+        journal = RequestJournal(path)
+        assert journal.open() == [(seq, b'complete')]
+        new_seq = journal.append(b'after truncate')
+        journal.close()
+
+        journal = RequestJournal(path)
+        assert journal.open() == [(seq, b'complete'), (new_seq, b'after truncate')]
+        journal.close()
+
+
+def test_sync_interval():
+    fsync = journal_module.os.fsync
+    calls = []
+
+    def counted_fsync(fd):
+        calls.append(fd)
+        fsync(fd)
+
+    journal_module.os.fsync = counted_fsync
+    try:
+        with tempfile.TemporaryDirectory() as job_dir:
+            journal = RequestJournal(os.path.join(job_dir, "requests.journal"), flush_interval=0, sync_interval=60)
+            journal.open()
+            journal.append(b'first')
+            # 刷新到操作系统，间隔时间之内不fsync
+            assert not calls and journal.pending
+            journal.sync()
+            assert len(calls) == 1 and not journal.pending
+            journal.append(b'second')
+            journal.flush()
+            assert len(calls) == 1
+            journal._last_sync_time -= 60
+            journal.flush()
+            assert len(calls) == 2 and not journal.pending
+            journal.close()
+    finally:
+        journal_module.os.fsync = fsync
+
+
+if __name__ == '__main__':
+    test_journal_resume_with_spill_queue()
+    test_open_does_not_rewrite()
+    test_background_compact()
+    test_truncated_record()
+    test_sync_interval()
@@ -0,0 +1,148 @@
+# -*- coding:utf-8 -*-
+
+
+import time
+import asyncio
+import multiprocessing
+from sprite import Spider, Crawler, Settings, Request, PyCoroutinePool
+from sprite.core.shard import ShardRouter, shard_index, merge_shard_stats
+from sprite.middlewaremanager import MiddlewareManager
+from sprite.utils.http.response import Response
+
+"""
+多进程分片爬取（CRAWLER_SHARDS）的测试
+    1.request按域名（scheme, host, port）分配到分片，同一个域名的request总是在同一个分片，默认端口与不写端口等价
+    2.不属于当前分片的request转发到对应分片的收件队列，回调函数对应接收方爬虫的方法
+    3.所有分片都空闲并且没有正在转发的request时才结束，接收转发的request之后分片不再空闲
+    4.多个分片进程一起抓取，所有的页面都被抓取之后所有的分片进程退出，统计信息汇总到父进程
+"""
+
+SHARDS = 2
+HOST_COUNT = 8
+PAGE_COUNT = 200
+CHILD_COUNT = 4
+CRAWL_TIMEOUT = 60
+
+
+def page_url(page: int) -> str:
+    return f'http://host{page % HOST_COUNT}.shard.test/{page}'
+
+
+class ShardSpider(Spider):
+    name = "shard"
+
+    async def start_request(self):
+        yield Request(url=page_url(0), callback=self.parse)
+
+    async def parse(self, response):
+        page = int(response.request.url.rsplit("/", 1)[1])
+        for i in range(CHILD_COUNT):
+            child = page * CHILD_COUNT + i + 1
+            if child < PAGE_COUNT:
+                yield Request(url=page_url(child), callback=self.parse)
+
+
+def test_shard_index():
+    spider = ShardSpider()
+    for host in range(HOST_COUNT):
+        indexes = {shard_index(Request(url=f'http://host{host}.shard.test/{path}', callback=spider.parse), SHARDS)
+                   for path in range(20)}
+        assert len(indexes) == 1, indexes
+    assert shard_index(Request(url="http://a.shard.test/", callback=spider.parse), 7) == \
+        shard_index(Request(url="http://A.shard.test:80/x", callback=spider.parse), 7)
+    used = {shard_index(Request(url=f'http://host{host}.shard.test/', callback=spider.parse), 4)
+            for host in range(64)}
+    assert used == set(range(4)), used
+
+
+def create_routers(spider: Spider) -> list:
+    ctx = multiprocessing.get_context("fork")
+    kwargs = {
+        "shards": SHARDS,
+        "inboxes": [ctx.Queue() for _ in range(SHARDS)],
+        "lock": ctx.Lock(),
+        "outstanding": ctx.Value("q", 0, lock=False),
+        "idle": ctx.Array("b", [0] + [1] * (SHARDS - 1), lock=False),
+        "stop_event": ctx.Event(),
+        "stats_queue": ctx.Queue(),
+    }
+    return [ShardRouter(index=index, spider=spider, **kwargs) for index in range(SHARDS)]
+
+
+def receive(router: ShardRouter, count: int) -> list:
+    # 收件队列由后台线程写入，等待转发的request都到达
+    requests = []
+    deadline = time.time() + 5
+    while len(requests) < count and time.time() < deadline:
+        requests.extend(router._receive())
+        time.sleep(0.01)
+    return requests
+
+
+def test_forward_and_idle():
+    spider = ShardSpider()
+    first, second = create_routers(spider)
+    requests = [Request(url=page_url(page), callback=spider.parse, meta={"page": page}) for page in range(40)]
+    local = first.split(requests)
+    remote = [request for request in requests if not first.is_local(request)]
+    assert local and remote and len(local) + len(remote) == len(requests)
+    assert all(shard_index(request, SHARDS) == 0 for request in local)
+    assert first._outstanding.value == len(remote)
+
+    first.set_idle()
+    # 0号分片空闲了，但是还有转发给1号分片、没有被接收的request
+    assert not first.all_idle()
+    received = receive(second, len(remote))
+    assert sorted(request.meta["page"] for request in received) == sorted(request.meta["page"]
+                                                                          for request in remote)
+    assert all(request.callback == spider.parse for request in received)
+    # 接收之后1号分片不再空闲，处理完之后才能结束
+    assert second._outstanding.value == 0 and not second.all_idle()
+    second.set_idle()
+    assert first.all_idle() and second.all_idle()
+
+
+def test_merge_stats():
+    stats = merge_shard_stats([
+        {"elapsed_time": 2.0, "downloaded_request_count": 10, "latency": 0.1, "name": "a", "stopped": True},
+        {"elapsed_time": 3.0, "downloaded_request_count": 5, "latency": 0.3},
+    ])
+    assert stats["elapsed_time"] == 3.0
+    assert stats["downloaded_request_count"] == 15
+    assert abs(stats["latency"] - 0.2) < 1e-9
+    assert "name" not in stats and "stopped" not in stats
+
+
+def test_sharded_crawl():
+    spider = ShardSpider()
+    middlewareManager = MiddlewareManager()
+
+    @middlewareManager.add_download_middleware()
+    async def fake_download(request, spider):
+        # 不访问网络，直接返回response
+        await asyncio.sleep(0)
+        return Response(url=request.url, body="ok", request=request)
+
+    settings = Settings(values={"DELAY": 0, "WORKER_NUM": 4, "CRAWLER_SHARDS": SHARDS, "SHARD_STATS_INTERVAL": 0.1})
+    crawler = Crawler(spider=spider, middlewareManager=middlewareManager, settings=settings,
+                      coroutine_pool=PyCoroutinePool())
+    crawler.run()
+    deadline = time.time() + CRAWL_TIMEOUT
+    time.sleep(0.5)
+    while not crawler.is_stopped() and time.time() < deadline:
+        time.sleep(0.1)
+    assert crawler.is_stopped(), "shards do not finish, idle detection may be broken"
+    stats = crawler._engine.get_crawl_stats()
+    print({key: value for key, value in stats.items() if key != "shard_stats"})
+    assert stats["shards"] == SHARDS and len(stats["shard_stats"]) == SHARDS
+    assert stats["downloaded_request_count"] == PAGE_COUNT, stats["downloaded_request_count"]
+    # 每个分片都抓取了自己的域名，转发出去的request都被接收了
+    assert all(shard["downloaded_request_count"] > 0 for shard in stats["shard_stats"])
+    assert stats["shard_forwarded_count"] == stats["shard_received_count"] > 0
+
+
+if __name__ == '__main__':
+    test_shard_index()
+    test_forward_and_idle()
+    test_merge_stats()
+    test_sharded_crawl()
@@ -0,0 +1,83 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+import asyncio
+import multiprocessing
+from sprite import Spider, Settings, Request
+from sprite.core.scheduler import Scheduler
+from sprite.utils.pybloomfilter import SharedBloomFilter
+
+"""
+共享内存布隆过滤器的测试
+    1.超过容量之后继续加入（误判率升高），调度器加入request时不会抛出异常
+    2.其他进程连接到同一个过滤器时只读取头部，不会覆盖已经加入的数量
+"""
+
+FILTER_NAME = f'sprite-test-bloom-{os.getpid()}'
+CAPACITY = 100
+PROCESS_COUNT = 4
+KEY_COUNT = 200
+
+
+class BloomSpider(Spider):
+    name = "bloom"
+
+    async def parse(self, response):
+        pass
+
+
+async def check_over_capacity():
+    spider = BloomSpider()
+    settings = Settings(values={
+        "DUPEFILTER": "shared",
+        "SHARED_BLOOM_NAME": FILTER_NAME,
+        "SHARED_BLOOM_CAPACITY": CAPACITY,
+    })
+    scheduler = Scheduler.from_settings(settings, spider)
+    scheduler.start()
+    try:
+        for i in range(CAPACITY * 2):
+            scheduler.enqueue_request(Request(url=f'http://bloom.test/{i}', callback=spider.parse))
+        scheduler.enqueue_requests(Request(url=f'http://bloom.test/batch/{i}', callback=spider.parse)
+                                   for i in range(CAPACITY))
+        assert len(scheduler._df) > CAPACITY, len(scheduler._df)
+        print(f'{len(scheduler._df)} fingerprints in a filter of capacity {CAPACITY}')
+    finally:
+        scheduler._df.unlink()
+
+
+def test_over_capacity():
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(check_over_capacity())
+    finally:
+        loop.close()
+
+
+def add_keys(index: int):
+    # 每个进程反复连接到过滤器，和其他进程同时加入各自的key
+    for i in range(KEY_COUNT):
+        with SharedBloomFilter(FILTER_NAME) as bloom_filter:
+            bloom_filter.add(f'{index}-{i}')
+
+
+def test_attach_keeps_count():
+    bloom_filter = SharedBloomFilter(FILTER_NAME, capacity=PROCESS_COUNT * KEY_COUNT * 10)
+    try:
+        processes = [multiprocessing.Process(target=add_keys, args=(index,)) for index in range(PROCESS_COUNT)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(timeout=30)
+            assert process.exitcode == 0, process.exitcode
+        # 不同的key在容量足够时几乎不会误判，数量就是所有进程加入的key的数量
+        assert PROCESS_COUNT * KEY_COUNT - 5 <= bloom_filter.count <= PROCESS_COUNT * KEY_COUNT, bloom_filter.count
+        print(f'{bloom_filter.count} keys added by {PROCESS_COUNT} processes')
+    finally:
+        bloom_filter.unlink()
+
+
+if __name__ == '__main__':
+    test_over_capacity()
+    test_attach_keeps_count()
@@ -0,0 +1,123 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+import json
+import random
+import tempfile
+from sprite.core.mq.spill import SpillQueue
+from sprite.utils.queues import HeapPriorityQueue
+
+"""
+内存 + 磁盘的混合优先队列的测试
+    1.超过内存限制的消息溢出到磁盘，从磁盘补充到内存之后仍然按照写入顺序弹出
+    2.不同权重按权重从小到大弹出，弹出顺序与HeapPriorityQueue一致
+    3.该权重已经有消息在磁盘中时，即使内存有空间，新的消息也写入磁盘，保证先进先出
+    4.无法还原的消息被丢弃，不影响其他消息
+"""
+
+MEMORY_COUNT = 5
+REFILL_SIZE = 3
+
+
+def serialize(item) -> bytes:
+    return json.dumps(item).encode()
+
+
+def deserialize(data: bytes):
+    return json.loads(data.decode())
+
+
+def create_queue(dir_path: str, **kwargs) -> SpillQueue:
+    kwargs.setdefault("max_memory_count", MEMORY_COUNT)
+    return SpillQueue(serialize, deserialize, dir_path=dir_path, refill_size=REFILL_SIZE, **kwargs)
+
+
+def pop_all(queue) -> list:
+    items = []
+    while queue:
+        items.append(queue.pop())
+    return items
+
+
+def test_refill_order():
+    with tempfile.TemporaryDirectory() as dir_path:
+        queue = create_queue(dir_path)
+        for i in range(20):
+            queue.push(i)
+        assert queue.memory_size == MEMORY_COUNT and queue.disk_size == 20 - MEMORY_COUNT
+        popped = []
+        while queue:
+            popped.append(queue.pop()[0])
+            assert queue.memory_size <= MEMORY_COUNT
+        assert popped == list(range(20)), popped
+        queue.close()
+        assert not os.listdir(dir_path)
+
+
+def test_fifo_after_spill():
+    with tempfile.TemporaryDirectory() as dir_path:
+        queue = create_queue(dir_path)
+        for i in range(MEMORY_COUNT + 2):
+            queue.push(i)
+        # 弹出之后内存有空间，但是磁盘中还有更早的消息，新的消息也要排在它们后面
+        assert queue.pop() == (0, 0)
+        queue.push("new")
+        assert queue.disk_size == 3
+        assert [item for item, _ in pop_all(queue)] == list(range(1, MEMORY_COUNT + 2)) + ["new"]
+        queue.close()
+
+
+def test_same_order_as_heap_queue():
+    rand = random.Random(1)
+    with tempfile.TemporaryDirectory() as dir_path:
+        queue = create_queue(dir_path)
+        heap_queue = HeapPriorityQueue()
+        expected, popped = [], []
+        for i in range(500):
+            priority = rand.randint(-3, 3)
+            queue.push(i, priority)
+            heap_queue.push(i, priority)
+            if rand.random() < 0.3:
+                popped.append(queue.pop())
+                expected.append(heap_queue.pop())
+        assert list(queue) == list(heap_queue)
+        popped.extend(pop_all(queue))
+        expected.extend(pop_all(heap_queue))
+        assert popped == expected
+        queue.close()
+
+
+def test_drop_broken_message():
+    def broken_deserialize(data: bytes):
+        item = deserialize(data)
+        if item == 7:
+            raise ValueError("broken message")
+        return item
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        queue = SpillQueue(serialize, broken_deserialize, dir_path=dir_path, max_memory_count=MEMORY_COUNT,
+                           refill_size=REFILL_SIZE)
+        for i in range(10):
+            queue.push(i)
+        assert [item for item, _ in pop_all(queue)] == [0, 1, 2, 3, 4, 5, 6, 8, 9]
+        assert len(queue) == 0
+        queue.close()
+
+
+def test_memory_bytes():
+    with tempfile.TemporaryDirectory() as dir_path:
+        queue = create_queue(dir_path, max_memory_count=0, max_memory_bytes=30, sizeof=len)
+        for i in range(10):
+            queue.push("x" * 10)
+        assert queue.memory_size == 3 and queue.disk_size == 7
+        assert len(pop_all(queue)) == 10
+        queue.close()
+
+
+if __name__ == '__main__':
+    test_refill_order()
+    test_fifo_after_spill()
+    test_same_order_as_heap_queue()
+    test_drop_broken_message()
+    test_memory_bytes()
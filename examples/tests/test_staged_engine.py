@@ -0,0 +1,115 @@
+# -*- coding:utf-8 -*-
+
+
+import time
+import asyncio
+from sprite import Spider, Crawler, Settings, Request, PyCoroutinePool
+from sprite.middlewaremanager import MiddlewareManager
+from sprite.utils.http.response import Response
+
+"""
+staged模式（ENGINE_MODE = "staged"）的测试
+    1.同时下载的数量不超过DOWNLOAD_WORKER_NUM，同时执行的回调函数不超过PARSE_WORKER_NUM
+    2.解析比下载慢时，下载协程继续下载，下载完成等待解析的response不超过解析队列的长度（加上正在解析、正在放入队列的）
+    3.回调函数产生的request继续被抓取，所有的request处理完之后下载协程、解析协程都退出
+"""
+
+SEED_COUNT = 40
+DOWNLOAD_WORKERS = 6
+PARSE_WORKERS = 2
+PARSE_QUEUE_SIZE = 5
+CRAWL_TIMEOUT = 60
+
+
+class StagedSpider(Spider):
+    name = "staged"
+
+    def __init__(self):
+        super(StagedSpider, self).__init__()
+        self.parsing = 0
+        self.max_parsing = 0
+        self.downloaded = 0
+        self.parsed = set()
+        self.max_backlog = 0
+
+    async def start_request(self):
+        for i in range(SEED_COUNT):
+            yield Request(url=f'http://staged.test/seed/{i}', callback=self.parse)
+
+    async def parse(self, response):
+        self.parsing += 1
+        self.max_parsing = max(self.max_parsing, self.parsing)
+        try:
+            # 解析比下载慢
+            await asyncio.sleep(0.01)
+        finally:
+            self.parsing -= 1
+        self.parsed.add(response.request.url)
+        if "/seed/" in response.request.url:
+            yield Request(url=response.request.url.replace("/seed/", "/child/"), callback=self.parse)
+
+
+def crawl() -> (StagedSpider, dict):
+    spider = StagedSpider()
+    middlewareManager = MiddlewareManager()
+    downloads = {"current": 0, "max": 0}
+
+    @middlewareManager.add_download_middleware()
+    async def fake_download(request, spider):
+        # 不访问网络，直接返回response
+        downloads["current"] += 1
+        downloads["max"] = max(downloads["max"], downloads["current"])
+        try:
+            await asyncio.sleep(0.001)
+        finally:
+            downloads["current"] -= 1
+        spider.downloaded += 1
+        spider.max_backlog = max(spider.max_backlog, spider.downloaded - len(spider.parsed) - spider.parsing)
+        return Response(url=request.url, body="ok", request=request)
+
+    settings = Settings(values={
+        "DELAY": 0,
+        "ENGINE_MODE": "staged",
+        "DOWNLOAD_WORKER_NUM": DOWNLOAD_WORKERS,
+        "PARSE_WORKER_NUM": PARSE_WORKERS,
+        "PARSE_QUEUE_SIZE": PARSE_QUEUE_SIZE,
+    })
+    crawler = Crawler(spider=spider, middlewareManager=middlewareManager, settings=settings, coroutine_pool=pool)
+    crawler.run()
+    deadline = time.time() + CRAWL_TIMEOUT
+    time.sleep(0.5)
+    while not crawler.is_stopped() and time.time() < deadline:
+        time.sleep(0.1)
+    assert crawler.is_stopped(), "crawl does not finish"
+    return spider, downloads
+
+
+def test_staged_engine():
+    spider, downloads = crawl()
+    print(f'max downloads {downloads["max"]}, max parsing {spider.max_parsing}, max backlog {spider.max_backlog}')
+    assert len(spider.parsed) == SEED_COUNT * 2, len(spider.parsed)
+    assert 1 < downloads["max"] <= DOWNLOAD_WORKERS, downloads["max"]
+    assert spider.max_parsing == PARSE_WORKERS, spider.max_parsing
+    # 下载没有被解析拖住，等待解析的response最多是解析队列加上阻塞在放入队列上的下载协程
+    assert PARSE_WORKERS < spider.max_backlog <= PARSE_QUEUE_SIZE + DOWNLOAD_WORKERS, spider.max_backlog
+
+
+pool = PyCoroutinePool()
+
+
+def setup_module():
+    pool.reset_after_fork()
+    pool.start()
+
+
+def teardown_module():
+    pool.stop()
+    pool.is_stopped(waiting=True)
+
+
+if __name__ == '__main__':
+    setup_module()
+    try:
+        test_staged_engine()
+    finally:
+        teardown_module()
@@ -10,6 +10,7 @@ from .settings import Settings
 from .spider import Spider
 from .crawl import Crawler, CrawlerRunner, CrawlerManager
 from .core.download import Downloader
-from .utils.coroutinePool import PyCoroutinePool, coroutine_pool
+from .core.executor import cpu_bound
+from .utils.coroutinePool import PyCoroutinePool, TaskHandle, coroutine_pool
 
 __version__ = "0.2.0"
@@ -22,6 +22,21 @@ COROUTINE_POOL_STATE_STOPPING = 2
 # 协程池关闭
 COROUTINE_POOL_STATE_STOPPED = 3
 
+# 协程池的control通道：引擎的启动、关闭等控制任务
+COROUTINE_LANE_CONTROL = "control"
+
+# 协程池的bulk通道：爬取任务
+COROUTINE_LANE_BULK = "bulk"
+
+# 协程池关闭时第一个取消的任务组：引擎的工作协程
+COROUTINE_GROUP_WORKER = 0
+
+# 第二个取消的任务组：下载任务
+COROUTINE_GROUP_DOWNLOAD = 1
+
+# 最后取消的任务组：引擎的启动、关闭、状态检测等后台任务
+COROUTINE_GROUP_HOUSEKEEPING = 2
+
 # 引擎运行
 ENGINE_STATE_RUNNING = 1
 
@@ -31,6 +46,15 @@ ENGINE_STATE_STOPPING = 2
 # 引擎关闭
 ENGINE_STATE_STOPPED = 3
 
+# 长期保存时，request在日志中的序号保存在meta的这个键中，溢出到磁盘或者序列化之后也能找到
+REQUEST_META_JOURNAL_SEQ = "_journal_seq"
+
+# 引擎模式：每个工作协程下载之后直接执行回调
+ENGINE_MODE_INLINE = "inline"
+
+# 引擎模式：下载协程和解析协程分开，通过有界队列连接
+ENGINE_MODE_STAGED = "staged"
+
 # 开发环境
 ENV_DEV = "dev"
 
@@ -0,0 +1,223 @@
+# -*- coding:utf-8 -*-
+
+
+import time
+import asyncio
+from collections import deque
+from typing import Callable, Optional
+from sprite.utils.log import get_logger
+
+logger = get_logger()
+
+"""
+自适应并发控制（AIMD：加性增、乘性减）
+    1.每个下载请求结束之后记录一个样本：耗时、是否失败、是否被限流（超时、429、503）
+    2.每隔一个统计周期（下载结束时检查，同时有定时器定期检查，下载卡住没有返回时也能调整）计算吞吐量（每秒完成的请求数）、平均耗时和失败率
+        正在下载、已经超过目标耗时的请求也当作被限流，每个请求只计算一次
+        被限流或者失败率超过阈值：目标并发数乘以减小系数（乘性减）
+        平均耗时没有明显高于历史最低的平均耗时，且吞吐量没有下降：目标并发数加上增加步长（加性增）
+        其他情况保持不变
+    3.目标并发数通过 AdjustableSemaphore 控制同时工作的协程数量以及同时下载的数量
+"""
+
+
+class AdjustableSemaphore:
+    """
+    上限可以在运行中调整的信号量，调小上限时已经获取的不受影响，之后的获取需要等待占用数量降到上限以下
+    """
+
+    def __init__(self, limit: int):
+        self._limit = max(limit, 1)
+        self._in_use = 0
+        self._waiters = deque()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    def set_limit(self, limit: int):
+        self._limit = max(limit, 1)
+        self._wakeup()
+
+    def locked(self) -> bool:
+        return self._in_use >= self._limit
+
+    async def acquire(self):
+        while self._in_use >= self._limit:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+                # 被唤醒了但是取消了，把机会让给下一个等待的协程
+                self._wakeup()
+                raise
+        self._in_use += 1
+        return True
+
+    def release(self):
+        self._in_use -= 1
+        self._wakeup()
+
+    def _wakeup(self):
+        free = self._limit - self._in_use
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AIMDController:
+    def __init__(self, initial: int, min_concurrency: int = 1, max_concurrency: int = 64, increase: int = 1,
+                 decrease: float = 0.5, interval: float = 5, error_threshold: float = 0.1,
+                 latency_tolerance: float = 0.5, latency_target: float = 0,
+                 on_change: Optional[Callable[[int], None]] = None):
+        self._min = max(min_concurrency, 1)
+        self._max = max(max_concurrency, self._min)
+        # 当前的目标并发数
+        self._target = min(max(initial, self._min), self._max)
+        self._increase = max(increase, 1)
+        self._decrease = decrease
+        # 统计周期（秒）
+        self._interval = interval
+        # 失败率超过该值时减小并发数
+        self._error_threshold = error_threshold
+        # 平均耗时超过历史最低平均耗时的 (1 + latency_tolerance) 倍时不再增加并发数
+        self._latency_tolerance = latency_tolerance
+        # 正在下载的请求超过该耗时之后当作被限流，为0时使用统计周期
+        self._latency_target = latency_target
+        self._on_change = on_change
+        # 正在下载的请求：序号 -> 开始时间
+        self._in_flight = {}
+        self._in_flight_seq = 0
+        # 定期检查统计周期的定时器
+        self._timer = None
+
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._window_errors = 0
+        self._window_throttled = 0
+        self._window_latency = 0.0
+        self._last_throughput = 0.0
+        self._base_latency = None
+        self._last_latency = None
+        self._last_error_rate = 0.0
+
+    @property
+    def target(self) -> int:
+        return self._target
+
+    # 在事件循环中启动定时器
+    def start(self):
+        if self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self._interval, self._tick)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _tick(self):
+        self._timer = None
+        if time.monotonic() - self._window_start >= self._interval:
+            self._adjust()
+        self.start()
+
+    def begin(self) -> int:
+        """
+        一个下载请求开始，返回的序号在结束时传给record
+        """
+        self._in_flight_seq += 1
+        self._in_flight[self._in_flight_seq] = time.monotonic()
+        return self._in_flight_seq
+
+    # 下载请求结束但是不记录结果（合并下载的请求、下载过程中抛出异常）
+    def finish(self, token: int):
+        self._in_flight.pop(token, None)
+
+    def record(self, latency: float, error: bool = False, throttled: bool = False, token: Optional[int] = None):
+        """
+        记录一个下载请求的结果，throttled表示超时或者被服务端限流（429、503）
+        """
+        if token is not None:
+            self._in_flight.pop(token, None)
+        self._window_count += 1
+        self._window_latency += latency
+        if error:
+            self._window_errors += 1
+        if throttled:
+            self._window_throttled += 1
+        if time.monotonic() - self._window_start >= self._interval:
+            self._adjust()
+
+    # 取出已经超过目标耗时的正在下载的请求，之后不再计算
+    def _take_stalled(self, now: float) -> int:
+        latency_target = self._latency_target or self._interval
+        stalled = [token for token, start in self._in_flight.items() if now - start > latency_target]
+        for token in stalled:
+            del self._in_flight[token]
+        return len(stalled)
+
+    def _adjust(self):
+        now = time.monotonic()
+        stalled = self._take_stalled(now)
+        count = self._window_count
+        if not count and not stalled:
+            # 统计周期内没有下载结束，也没有卡住的请求，继续统计
+            return
+        elapsed = max(now - self._window_start, 1e-6)
+        throughput = count / elapsed
+        latency = self._window_latency / count if count else 0.0
+        error_rate = self._window_errors / count if count else 0.0
+        throttled = self._window_throttled + stalled
+
+        target = self._target
+        if throttled or error_rate > self._error_threshold:
+            # 乘性减
+            target = max(self._min, int(target * self._decrease))
+        elif count:
+            if self._base_latency is None or latency < self._base_latency:
+                self._base_latency = latency
+            latency_flat = latency <= self._base_latency * (1 + self._latency_tolerance)
+            if latency_flat and throughput >= self._last_throughput * 0.95:
+                # 加性增
+                target = min(self._max, target + self._increase)
+
+        self._last_throughput = throughput
+        if count:
+            self._last_latency = latency
+        self._last_error_rate = error_rate
+        self._window_start = now
+        self._window_count = self._window_errors = self._window_throttled = 0
+        self._window_latency = 0.0
+
+        if target != self._target:
+            logger.info(f'adjust concurrency {self._target} -> {target}, throughput: {throughput:.2f}/s, '
+                        f'latency: {latency:.3f}s, error rate: {error_rate:.2%}, throttled: {throttled}')
+            self._target = target
+            if self._on_change is not None:
+                self._on_change(target)
+
+    def stats(self) -> dict:
+        return {
+            "target_concurrency": self._target,
+            "throughput": self._last_throughput,
+            "latency": self._last_latency,
+            "error_rate": self._last_error_rate,
+        }
@@ -16,6 +16,8 @@ from sprite.utils.coroutinePool import PyCoroutinePool
 from .session import ClientDefaults, Session
 from sprite.settings import Settings
 from sprite.utils.log import get_logger
+from sprite.core.concurrency import AdjustableSemaphore
+from sprite.const import COROUTINE_GROUP_DOWNLOAD
 from .limits import RequestRate
 
 logger = get_logger()
@@ -32,12 +34,13 @@ class Downloader:
                  stream: bool = False, decode: bin = True, ssl=None, keep_alive: bool = True,
                  prefix: str = '', timeout: Union[int, float] = ClientDefaults.TIMEOUT,
                  retries: RetryStrategy = None, limits: List[RequestRate] = None):
-        self._sem = asyncio.Semaphore(max_download_num)
+        # 同时下载数量的上限可以在运行中调整（自适应并发）
+        self._sem = AdjustableSemaphore(max_download_num)
         self._delay = delay
         self._no_complete_task = 0
         # 协程池
         self._coroutine_pool = coroutine_pool
-        assert self._coroutine_pool is None, "coroutine_pool not init"
+        assert self._coroutine_pool is not None, "coroutine_pool not init"
         self._session = Session(loop=self._coroutine_pool.loop, headers=headers, follow_redirects=follow_redirects,
                                 max_redirects=max_redirects,
                                 stream=stream, decode=decode, ssl=ssl, keep_alive=keep_alive, prefix=prefix,
@@ -46,11 +49,14 @@ class Downloader:
         # 自带的缓冲队列
         self._downloaded_response = Queue()
 
+    def set_concurrency(self, max_download_num: int):
+        self._sem.set_limit(max_download_num)
+
     # 添加下载任务
     def addTask(self, request: Request):
         task = self.request(request)
-        # 添加到协程池中执行
-        self._coroutine_pool.go(task=task)
+        # 添加到协程池中执行，协程池关闭时在工作协程之后取消
+        self._coroutine_pool.go(task=task, group=COROUTINE_GROUP_DOWNLOAD)
         self._no_complete_task += 1
 
     def getResponse(self) -> Union[Response, Exception]:
@@ -131,6 +137,9 @@ class Downloader:
         timeout = settings.get("TIMEOUT")
         limits = settings.get("LIMITS")
         delay = settings.getint("DELAY")
+        if settings.get("SCHEDULER_QUEUE") == "host":
+            # 按照域名分片的调度器会控制每一个域名的请求间隔
+            delay = 0
 
         obj = cls(max_download_num=max_download_num, coroutine_pool=coroutine_pool,
                   headers=headers, follow_redirects=follow_redirects, max_redirects=max_redirects, delay=delay,
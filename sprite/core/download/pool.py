@@ -99,6 +99,8 @@ class ConnectionPool:
             self.connections.discard(connection)
 
     def close(self):
-        # 关闭域名下的所有链接
+        # 关闭域名下的所有链接，包括正在使用的链接
         for connection in self.connections:
             connection.close()
+        self.connections.clear()
+        self.available_connections.clear()
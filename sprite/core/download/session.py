@@ -140,6 +140,7 @@ class HTTPEngine:
         # 关闭所有的链接池
         for pool in self.pools.values():
             pool.close()
+        self.pools.clear()
 
 
 class Session:
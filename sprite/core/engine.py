@@ -3,14 +3,17 @@ __author__ = 'liyong'
 __date__ = '2019/8/16 19:45'
 
 import time
-import traceback
 import asyncio
-from asyncio import Event
+import traceback
+from asyncio import Event, TimeoutError
 from threading import Lock
-from typing import Callable, Coroutine
-from types import AsyncGeneratorType
+from typing import Callable, Coroutine, AsyncIterator, Optional, Tuple
+from types import AsyncGeneratorType, GeneratorType
 from sprite.core.scheduler import Slot, Scheduler
+from sprite.core.frontier import RemoteScheduler
 from sprite.core.download import Downloader
+from sprite.core.concurrency import AdjustableSemaphore, AIMDController
+from sprite.core.executor import CallbackExecutor
 from sprite.utils.coroutinePool import PyCoroutinePool
 from sprite.middlewaremanager import MiddlewareManager
 from sprite.settings import Settings
@@ -19,9 +22,7 @@ from sprite.utils.http.request import Request
 from sprite.utils.http.response import Response
 from sprite.utils.log import get_logger
 from sprite.item import Item
-from sprite.utils.request import Counter
-from sprite.utils.asyncHandler import detailCallable
-from sprite.exceptions import SchedulerEmptyException
+from sprite.utils.request import Counter, RequestFingerprinter
 from sprite.const import *
 
 logger = get_logger()
@@ -29,7 +30,8 @@ logger = get_logger()
 
 class Engine:
     def __init__(self, scheduler: Scheduler, downloader: Downloader, middlewareManager: MiddlewareManager,
-                 spider: Spider, settings: Settings, coroutine_pool: PyCoroutinePool = None):
+                 spider: Spider, settings: Settings, coroutine_pool: PyCoroutinePool = None,
+                 callback_executor: CallbackExecutor = None):
 
         self._slot = Slot()
         self._scheduler = scheduler
@@ -38,19 +40,76 @@ class Engine:
         self._middlewareManager = middlewareManager
         self._spider = spider
         self._settings = settings
+        # CPU密集型回调函数的执行器
+        self._callback_executor = callback_executor
 
         self._state_lock = Lock()
         self._state = ENGINE_STATE_STOPPED
         self._state_signal = Event()
         self._request_added = Event()
+        # 调度器、下载器等资源是否已经释放
+        self._resources_closed = False
+        # 引擎停止信号，工作协程检测到之后退出
+        self._stop_signal = Event()
+        # 所有工作协程都退出的信号
+        self._workers_stopped = Event()
 
         self._unfinished_workers = 0
+        # 因为调度器中的request达到上限而挂起的工作协程数量
+        self._blocked_workers = 0
+        # 所有工作协程都挂起时临时启动的工作协程数量
+        self._relief_workers = 0
+        # 是否正在从start_requests中拉取request，拉取过程中调度器为空也不能让工作协程退出
+        self._seeding = False
+        # 调度器中的request少于该数量时才继续拉取start_requests
+        self._seed_low_water = max(settings.getint("START_REQUESTS_LOW_WATER"), 1)
 
         self._start_time = time.time()
         self._downloaded_request_count = 0
         self._success_request_count = 0
         self._failed_request_count = 0
 
+        # 自适应并发：控制器根据吞吐量、耗时和失败率调整目标并发数，工作协程和下载器都按目标并发数限流
+        self._concurrency = None
+        self._controller = None
+        if settings.getbool("CONCURRENCY_ADAPTIVE"):
+            initial = settings.getint("WORKER_NUM")
+            self._controller = AIMDController(initial=initial,
+                                              min_concurrency=settings.getint("CONCURRENCY_MIN"),
+                                              max_concurrency=settings.getint("CONCURRENCY_MAX"),
+                                              increase=settings.getint("CONCURRENCY_INCREASE"),
+                                              decrease=settings.getfloat("CONCURRENCY_DECREASE"),
+                                              interval=settings.getfloat("CONCURRENCY_ADJUST_INTERVAL"),
+                                              error_threshold=settings.getfloat("CONCURRENCY_ERROR_THRESHOLD"),
+                                              latency_target=settings.getfloat("CONCURRENCY_LATENCY_TARGET"),
+                                              on_change=self._set_concurrency)
+            self._concurrency = AdjustableSemaphore(self._controller.target)
+            self._downloader.set_concurrency(self._controller.target)
+        # 引擎模式，staged模式下载和解析分成两个阶段，通过有界的解析队列连接，各自有独立的并发数
+        self._mode = settings.get("ENGINE_MODE", ENGINE_MODE_INLINE)
+        if self._mode not in (ENGINE_MODE_INLINE, ENGINE_MODE_STAGED):
+            raise ValueError(f'unknown ENGINE_MODE: {self._mode}')
+        self._parse_queue_size = max(settings.getint("PARSE_QUEUE_SIZE"), 1)
+        # 下载完成等待解析的 (request, response)，在协程池的事件循环中创建
+        self._parse_queue = None
+        self._unfinished_parsers = 0
+        # 正在下载、正在解析的协程数量，用于判断哪个阶段是瓶颈
+        self._busy_downloaders = 0
+        self._busy_parsers = 0
+        # 分片运行时的路由，转发不属于当前分片的request，判断所有分片是否都处理完毕
+        self._router = None
+        # 被当作限流的响应状态码
+        self._throttle_status = set(int(status) for status in settings.getlist("CONCURRENCY_THROTTLE_STATUS"))
+        # 回调函数产生的request缓存到该数量之后批量加入调度器
+        self._enqueue_batch_size = max(settings.getint("ENQUEUE_BATCH_SIZE"), 1)
+        # 合并下载：request.meta["coalesce"]为True时，指纹相同的request正在下载则等待它的response，不再重复下载
+        # 指纹 -> 正在下载的response（future）
+        self._in_flight_downloads = {}
+        self._coalesced_request_count = 0
+        self._fingerprinter = RequestFingerprinter(include_headers=settings.getlist("FINGERPRINT_HEADERS"),
+                                                   bits=settings.getint("FINGERPRINT_BITS"),
+                                                   cache_size=settings.getint("FINGERPRINT_CACHE_SIZE"))
+
         self._item_counter = Counter(unit=settings.getint("ITEM_COUNTER_UNIT"))
         self._response_counter = Counter(
             unit=settings.getint("RESPONSE_COUNTER_UNIT"))
@@ -81,7 +140,7 @@ class Engine:
         with self._state_lock:
             if self._state != ENGINE_STATE_STOPPED:
                 return False
-        self._coroutine_pool.go(self._init())
+        self._coroutine_pool.go(self._init(), lane=COROUTINE_LANE_CONTROL)
         logger.info(f'启动engine')
         return True
 
@@ -90,127 +149,370 @@ class Engine:
             self._state = ENGINE_STATE_RUNNING
             self._state_signal.clear()
             self._request_added.clear()
+            self._stop_signal.clear()
+            self._workers_stopped.clear()
+        self._resources_closed = False
+        # 协程池被强制关闭时：下载任务取消之后关闭所有连接，后台任务（包括关闭流程）取消之后把引擎标记为停止
+        self._coroutine_pool.add_close_callback(self._downloader.close, COROUTINE_GROUP_DOWNLOAD)
+        self._coroutine_pool.add_close_callback(self._on_pool_closed, COROUTINE_GROUP_HOUSEKEEPING)
         # 启动调度器
         self._scheduler.start()
+        if self._controller is not None:
+            # 定期调整并发数，下载卡住没有返回时也能减小并发数
+            self._controller.start()
         # 注入start_requests
         self._coroutine_pool.go(self._get_start_requests())
 
         # 查询调度器中是否填充了request，如果没有直接退出程序
         await self._request_added.wait()
-        if not self._scheduler.has_pending_requests():
+        if self._router is not None:
+            # 分片运行时，request可能都转发给了其他分片，或者之后由其他分片转发过来
+            self._coroutine_pool.go(self._router.run(self), lane=COROUTINE_LANE_CONTROL)
+        elif not self._scheduler.has_pending_requests():
             logger.error(
                 "scheduler 为空，没有构造start request或者填充start request失败, 关闭程序")
             self.close()
             return
-        # 设定工作协程的数量
-        self._unfinished_workers = self._settings.getint("WORKER_NUM")
+        # 设定工作协程的数量，自适应并发时启动最大数量的工作协程，由目标并发数控制同时工作的数量
+        if self._controller is not None:
+            self._unfinished_workers = self._settings.getint("CONCURRENCY_MAX")
+        elif self._mode == ENGINE_MODE_STAGED and self._settings.getint("DOWNLOAD_WORKER_NUM") > 0:
+            self._unfinished_workers = self._settings.getint("DOWNLOAD_WORKER_NUM")
+        else:
+            self._unfinished_workers = self._settings.getint("WORKER_NUM")
 
         # 检测工作协程是否都退出
-        self._coroutine_pool.go(self._status_check())
+        self._coroutine_pool.go(self._status_check(), lane=COROUTINE_LANE_CONTROL)
+        if self._mode == ENGINE_MODE_STAGED:
+            # 启动解析协程和下载协程
+            self._parse_queue = asyncio.Queue(maxsize=self._parse_queue_size)
+            self._unfinished_parsers = max(self._settings.getint("PARSE_WORKER_NUM"), 1)
+            self._coroutine_pool.go_many(self._doParse() for _ in range(self._unfinished_parsers))
+            self._coroutine_pool.go_many(self._doDownload() for _ in range(self._unfinished_workers))
+            return
         # 启动所有的工作协程
-        for _ in range(self._unfinished_workers):
-            self._coroutine_pool.go(self._doSomething())
+        self._coroutine_pool.go_many(self._doSomething() for _ in range(self._unfinished_workers))
+        if self._router is not None:
+            # 没有分到request的分片标记为空闲
+            self._check_idle()
 
+    # 按需拉取start_requests：第一个request加入调度器之后工作协程就开始工作，
+    # 之后只有调度器中的request少于START_REQUESTS_LOW_WATER时才继续拉取
     async def _get_start_requests(self):
         # 执行爬虫中间件
         await self._middlewareManager.process_spider_start(self._spider)
-        if not self._scheduler.has_pending_requests():
+        # 分片运行时只有0号分片拉取start_requests
+        seed = self._router is None or self._router.index == 0
+        if seed and not self._scheduler.has_pending_requests():
             # 检测非断点续爬
+            self._seeding = True
+            requests = []
             try:
-                if self._spider.start_requests is not None:
-                    for url in self._spider.start_requests:
-                        request = Request(url=url, headers=self._settings.getdict(
-                            "HEADERS"), callback=self._spider.parse)
-                        self._scheduler.enqueue_request(request)
-                else:
-                    # async for request in self._spider.start_request():
-                    #     self._scheduler.enqueue_request(request)
-                    await detailCallable(self._spider.start_request, self._scheduler.enqueue_request)
+                async for request in self._iter_start_requests():
+                    if self._stop_signal.is_set():
+                        break
+                    requests.append(request)
+                    # 缓存满了，或者调度器已经空了（工作协程在等待），批量加入调度器
+                    if len(requests) >= self._enqueue_batch_size or not self._scheduler.has_pending_requests():
+                        await self._flush_start_requests(requests)
+                    if len(self._scheduler) >= self._seed_low_water:
+                        await self._scheduler.wait_below(self._seed_low_water)
+                await self._flush_start_requests(requests)
             except Exception as e:
                 logger.info(
                     f'填充start request 过程中发生错误: \n{traceback.format_exc()}')
+            finally:
+                self._seeding = False
         with self._state_lock:
             self._request_added.set()
+        if self._unfinished_workers > 0:
+            # start_requests拉取完毕，所有的request可能都已经处理完了
+            self._check_idle()
+
+    async def _flush_start_requests(self, requests: list):
+        if requests:
+            await self._scheduler.put_requests(requests, self._seed_waiting)
+            requests.clear()
+            if self._scheduler.has_pending_requests():
+                # 第一批request加入调度器，启动工作协程
+                with self._state_lock:
+                    self._request_added.set()
+
+    # 调度器满了，拉取start_requests的协程开始等待时，先启动工作协程消耗调度器中的request
+    def _seed_waiting(self, blocked: bool):
+        if blocked:
+            with self._state_lock:
+                self._request_added.set()
 
-    # 不断检测所有的工作协程是否都结束，如果都结束的化，则启动关闭引擎的流程
+    # 把 start_requests（url列表）或者 start_request() 的结果（异步生成器、生成器、协程）统一成request的异步迭代器
+    async def _iter_start_requests(self) -> AsyncIterator[Request]:
+        if self._spider.start_requests is not None:
+            headers = self._settings.getdict("HEADERS")
+            for url in self._spider.start_requests:
+                yield Request(url=url, headers=headers, callback=self._spider.parse)
+            return
+        results = self._spider.start_request()
+        if isinstance(results, AsyncGeneratorType):
+            async for result in results:
+                if isinstance(result, Request):
+                    yield result
+        elif isinstance(results, GeneratorType):
+            for result in results:
+                if isinstance(result, Request):
+                    yield result
+        else:
+            if isinstance(results, Coroutine):
+                results = await results
+            if isinstance(results, Request):
+                yield results
+
+    # 等待所有的工作协程都结束，之后启动关闭引擎的流程
     async def _status_check(self):
-        while True:
-            if self._unfinished_workers <= 0 and self._settings.getbool('ENGINE_MOST_STOP'):
-                self.close()
-                break
-            await asyncio.sleep(COROUTINE_SLEEP_TIME)
+        await self._workers_stopped.wait()
+        if self._settings.getbool('ENGINE_MOST_STOP'):
+            self.close()
 
     async def _doSomething(self):
+        await self._run_worker(self._work_once)
+        self._unfinished_workers -= 1
+        if self._unfinished_workers <= 0:
+            self._workers_stopped.set()
+
+    # staged模式的下载协程，下载协程都退出之后通知解析协程退出
+    async def _doDownload(self):
+        await self._run_worker(self._download_once)
+        self._unfinished_workers -= 1
+        if self._unfinished_workers <= 0:
+            for _ in range(self._unfinished_parsers):
+                await self._parse_queue.put(None)
+
+    # staged模式的解析协程，处理完解析队列中所有的response之后才退出
+    async def _doParse(self):
         while True:
-            # 1.首先判断spider非close
-            with self._state_lock:
-                state = self._state
-            if state == ENGINE_STATE_RUNNING:
-                # 2.再尝试从调度器里面提取request
-                try:
-                    # 获取到request之后，开始处理请求,先将request放入正在处理队列记录一下
-                    self._slot.addRequest(self._scheduler.next_request())
-                except SchedulerEmptyException:
-                    if self._slot.has_pending_request():
-                        await asyncio.sleep(COROUTINE_SLEEP_TIME)
-                        continue
-                    else:
-                        self._unfinished_workers -= 1
-                        break
-                # 再取出
-                request = self._slot.getRequest()
-                try:
-                    await self._doCrawl(request)
-                except Exception:
-                    logger.error(f'find one error: \n{traceback.format_exc()}')
-                # 处理完一个request，打一个标记
-                self._slot.toDone()
-                self._downloaded_request_count += 1
-            else:
-                self._unfinished_workers -= 1
+            item = await self._parse_queue.get()
+            if item is None:
                 break
+            request, response = item
+            self._busy_parsers += 1
+            try:
+                await self._handle_request_callback(request.callback, response)
+            except Exception:
+                logger.error(f'find one error: \n{traceback.format_exc()}')
+            finally:
+                self._busy_parsers -= 1
+            self._request_finished()
+        self._unfinished_parsers -= 1
+        if self._unfinished_parsers <= 0:
+            self._workers_stopped.set()
+
+    async def _run_worker(self, work_once: Callable):
+        # 1.首先判断引擎没有发出停止信号
+        while not self._stop_signal.is_set():
+            # 自适应并发时，先获取并发许可，同时工作的协程数量不超过目标并发数
+            if self._concurrency is not None:
+                await self._concurrency.acquire()
+            try:
+                if not await work_once():
+                    break
+            finally:
+                if self._concurrency is not None:
+                    self._concurrency.release()
+
+    # 处理一个request，调度器为空且没有正在处理的request时返回False
+    async def _work_once(self) -> bool:
+        # 2.再从调度器里面提取request，调度器为空时挂起等待
+        request = await self._scheduler.next_request()
+        if request is None:
+            # 调度器为空，且没有正在处理的request
+            return False
+        # 获取到request之后，开始处理请求,先将request放入正在处理队列记录一下
+        self._slot.addRequest(request)
+        # 再取出
+        request = self._slot.getRequest()
+        try:
+            await self._doCrawl(request)
+        except Exception:
+            logger.error(f'find one error: \n{traceback.format_exc()}')
+        # 处理完一个request，打一个标记（下载完成时已经释放了该域名的并发数）
+        self._scheduler.request_done(request, release=False)
+        self._request_finished()
+        return True
+
+    # staged模式下载一个request，下载完成之后放入解析队列，解析队列满了时挂起等待
+    async def _download_once(self) -> bool:
+        request = await self._scheduler.next_request()
+        if request is None:
+            return False
+        self._slot.addRequest(request)
+        request = self._slot.getRequest()
+        result = None
+        self._busy_downloaders += 1
+        try:
+            result = await self._download(request)
+        except Exception:
+            logger.error(f'find one error: \n{traceback.format_exc()}')
+        finally:
+            self._busy_downloaders -= 1
+        # 下载完成就通知调度器（下载完成时已经释放了该域名的并发数）
+        self._scheduler.request_done(request, release=False)
+        if result is None:
+            self._request_finished()
+        else:
+            await self._parse_queue.put(result)
+        return True
+
+    # request的回调执行完毕（或者不需要执行回调）
+    def _request_finished(self):
+        self._slot.toDone()
+        self._check_idle()
+
+    def _set_concurrency(self, concurrency: int):
+        self._concurrency.set_limit(concurrency)
+        self._downloader.set_concurrency(concurrency)
+
+    # 没有正在处理的request且调度器为空，并且start_requests已经拉取完毕时，唤醒所有等待的工作协程退出
+    def _check_idle(self):
+        if self._seeding:
+            return
+        if self.is_local_idle():
+            if self._router is not None:
+                # 其他分片还可能转发request过来，由路由判断所有分片都空闲之后再唤醒
+                self._router.set_idle()
+            else:
+                self._scheduler.release_waiters()
+
+    def is_local_idle(self) -> bool:
+        return not self._seeding and not self._slot.has_pending_request() and \
+               not self._scheduler.has_pending_requests()
+
+    def set_router(self, router: "ShardRouter"):
+        self._router = router
+        self._scheduler.set_router(router)
+
+    # 加入其他分片转发过来的request
+    def enqueue_forwarded(self, requests: list):
+        self._scheduler.enqueue_requests(requests)
+        # 转发过来的request可能都是重复的
+        self._check_idle()
+
+    # 唤醒所有等待request的工作协程退出
+    def release_workers(self):
+        self._scheduler.release_waiters()
 
     # 获取到request之后，开始处理请求
     async def _doCrawl(self, request: Request):
+        result = await self._download(request)
+        if result is not None:
+            request, response = result
+            # 4.调用request的回调函数，对response进行处理
+            await self._handle_request_callback(request.callback, response)
+
+    # 下载request，返回需要执行回调的 (request, response)，response被下载中间件转换成新的request时返回None
+    async def _download(self, request: Request) -> Optional[Tuple[Request, Response]]:
         response = None
-        # 1.首先调用下载中间件
-        result = await self._middlewareManager.process_request(request, spider=self._spider)
-        if result:
-            if isinstance(result, Request):
-                request = result
-            elif isinstance(result, Response):
-                response = result
-        if response is None:
-            # 2.调用下载器下载request
-            logger.debug(f'downloading request: {request.url} {request.query}')
-            response = await self._downloader.request(request=request)
-            if response.error:
-                logger.debug(
-                    f'downloaded request failure: {request.url} {request.query}')
-            else:
-                logger.debug(
-                    f'downloaded request: {request.url}[{response.status}]'
-                )
-                unit_speed, unit_count = self._response_counter.dot()
-                if unit_speed or unit_count:
-                    logger.info(
-                        f'目前获取response的速度：{unit_speed}/s   每{self._item_counter.unit}s获取{unit_count}个response')
-                self._success_request_count += 1
+        # 下载完成（包括失败）就释放该域名的并发数，之后处理response时不再占用
+        popped = request
+        # 是否统计在下载数量中：合并的request没有重复下载，被取消的request没有下载完成
+        counted = True
+        try:
+            # 1.首先调用下载中间件
+            result = await self._middlewareManager.process_request(request, spider=self._spider)
+            if result:
+                if isinstance(result, Request):
+                    request = result
+                elif isinstance(result, Response):
+                    response = result
+            if response is None:
+                # 2.调用下载器下载request
+                logger.debug(f'downloading request: {request.url} {request.query}')
+                download_start = time.monotonic()
+                token = self._controller.begin() if self._controller is not None else None
+                try:
+                    response, coalesced = await self._fetch(request)
+                    counted = not coalesced
+                except BaseException:
+                    if token is not None:
+                        self._controller.finish(token)
+                    raise
+                if self._controller is not None:
+                    if coalesced:
+                        self._controller.finish(token)
+                    else:
+                        self._controller.record(time.monotonic() - download_start, error=response.error is not None,
+                                                throttled=isinstance(response.error, TimeoutError) or
+                                                          response.status in self._throttle_status, token=token)
+                if response.error:
+                    logger.debug(
+                        f'downloaded request failure: {request.url} {request.query}')
+                else:
+                    logger.debug(
+                        f'downloaded request: {request.url}[{response.status}]'
+                    )
+                    unit_speed, unit_count = self._response_counter.dot()
+                    if unit_speed or unit_count:
+                        logger.info(
+                            f'目前获取response的速度：{unit_speed}/s   每{self._item_counter.unit}s获取{unit_count}个response')
+                    if not coalesced:
+                        self._success_request_count += 1
+        except asyncio.CancelledError:
+            counted = False
+            raise
+        finally:
+            self._scheduler.download_done(popped)
+            if counted:
+                self._downloaded_request_count += 1
         # 3.调用下载中间件处理response
         result = await self._middlewareManager.process_response(response, self._spider)
         if result:
             if isinstance(result, Request):
                 # 丢入调度器中
                 request = result
-                self._scheduler.enqueue_request(request)
-                return
+                await self._scheduler.put_request(request, self._worker_waiting)
+                return None
             elif isinstance(result, Response):
                 response = result
-        # 4.调用request的回调函数，对response进行处理
-        await self._handle_request_callback(request.callback, response)
+        return request, response
+
+    # 调用下载器下载request，返回 (response, 是否等待了相同request的下载结果)
+    # 合并的request拿到的是同一个response对象，response.request是第一个request，回调函数使用各自request的回调
+    async def _fetch(self, request: Request) -> Tuple[Response, bool]:
+        if not (request._meta and request._meta.get("coalesce")):
+            return await self._downloader.request(request=request), False
+        fingerprint = self._fingerprinter(request)
+        future = self._in_flight_downloads.get(fingerprint)
+        while future is not None:
+            # 等待的request被取消时不影响正在下载的request
+            response = await asyncio.shield(future)
+            if response is not None:
+                self._coalesced_request_count += 1
+                return response, True
+            # 正在下载的request被取消，第一个被唤醒的等待者重新下载，其他的等待者等待它的结果
+            future = self._in_flight_downloads.get(fingerprint)
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight_downloads[fingerprint] = future
+        try:
+            response = await self._downloader.request(request=request)
+        except Exception as e:
+            future.set_exception(e)
+            # 没有等待的request时，避免产生异常未被获取的警告
+            future.exception()
+            raise
+        except BaseException:
+            # 下载被取消，等待的request不能跟着被取消，通知它们重新下载
+            future.set_result(None)
+            raise
+        else:
+            future.set_result(response)
+            return response, False
+        finally:
+            del self._in_flight_downloads[fingerprint]
 
     async def _handle_request_callback(self, callback: Callable, response: Response):
         # 传入resposne，调用回调函数进行处理
+        if self._callback_executor is not None and self._callback_executor.is_cpu_bound(callback, response):
+            # CPU密集型的回调函数在进程池（线程池）中执行，产生的Request和Item按异步生成器的方式处理
+            await self._process_async_callback(self._callback_executor.run(callback, response))
+            return
         # 调用回调函数
         callback_results = callback(response)
         if isinstance(callback_results, AsyncGeneratorType):
@@ -221,21 +523,76 @@ class Engine:
             await self._handle_coroutine_callback(callback_results)
 
     # 处理回调（以协程的方式）
-    async def _process_async_callback(self, callback_results: AsyncGeneratorType):
-        async for callback_result in callback_results:  # AsyncGeneratorType对象 协程生成器对象
-            # yield 的返回结果类型
-            if isinstance(callback_result, AsyncGeneratorType):
-                # 继续递归
-                await self._process_async_callback(callback_result)
-            elif isinstance(callback_result, (Request, Item)):
-                # yield 的返回值是Request or Item类型
-                if callback_result:
-                    if isinstance(callback_result, Request):
-                        await self._handle_request_result(callback_result)
-                    elif isinstance(callback_result, Item):
-                        await self._handle_item_result(callback_result)
-            elif isinstance(callback_result, Coroutine):
-                await self._handle_coroutine_callback(callback_result)
+    # 回调产生的request先缓存在requests中，达到批量大小或者回调结束时批量加入调度器
+    async def _process_async_callback(self, callback_results: AsyncGeneratorType, requests: list = None):
+        flush = requests is None
+        if requests is None:
+            requests = []
+        try:
+            async for callback_result in callback_results:  # AsyncGeneratorType对象 协程生成器对象
+                # yield 的返回结果类型
+                if isinstance(callback_result, AsyncGeneratorType):
+                    # 继续递归，共用同一个缓存
+                    await self._process_async_callback(callback_result, requests)
+                elif isinstance(callback_result, (Request, Item)):
+                    # yield 的返回值是Request or Item类型
+                    if callback_result:
+                        if isinstance(callback_result, Request):
+                            requests.append(callback_result)
+                            if len(requests) >= self._enqueue_batch_size:
+                                await self._enqueue_callback_requests(requests)
+                        elif isinstance(callback_result, Item):
+                            await self._handle_item_result(callback_result)
+                elif isinstance(callback_result, Coroutine):
+                    await self._handle_coroutine_callback(callback_result)
+        finally:
+            # 回调结束（包括发生异常）时，已经产生的request都加入调度器
+            if flush:
+                await self._enqueue_callback_requests(requests)
+
+    # 回调产生的request加入调度器，调度器中的request达到上限时挂起当前的回调函数，等待调度器中的request被消耗
+    async def _enqueue_callback_requests(self, requests: list):
+        if requests:
+            await self._scheduler.put_requests(requests, self._worker_waiting)
+            requests.clear()
+
+    # 工作协程因为调度器中的request达到上限开始（blocked为True）或者结束等待
+    def _worker_waiting(self, blocked: bool):
+        if blocked:
+            self._blocked_workers += 1
+            self._relieve()
+        else:
+            self._blocked_workers -= 1
+
+    # 能够消耗调度器中request的协程都在等待时，临时启动一个工作协程处理request，
+    # 避免所有的工作协程互相等待，调度器中的request也不会超过上限
+    def _relieve(self):
+        if self._stop_signal.is_set():
+            return
+        if self._blocked_workers >= self._frontier_consumers() + self._relief_workers:
+            self._relief_workers += 1
+            self._coroutine_pool.go(self._doRelief())
+
+    # 能够消耗调度器中request的工作协程数量
+    def _frontier_consumers(self) -> int:
+        if self._mode == ENGINE_MODE_STAGED:
+            # staged模式回调函数在解析协程中执行，解析协程都在等待时，下载协程也会因为解析队列满了而停下
+            return self._unfinished_parsers
+        workers = self._unfinished_workers
+        if self._concurrency is not None:
+            # 挂起的工作协程仍然占用并发许可
+            workers = min(workers, self._concurrency.limit)
+        return workers
+
+    # 临时的工作协程处理一个request之后退出，其他的协程仍然都在等待时再启动下一个
+    async def _doRelief(self):
+        try:
+            await self._work_once()
+        except Exception:
+            logger.error(f'find one error: \n{traceback.format_exc()}')
+        finally:
+            self._relief_workers -= 1
+        self._relieve()
 
     async def _handle_coroutine_callback(self, aws_callback: Coroutine):
         result = await aws_callback
@@ -246,7 +603,7 @@ class Engine:
                 await self._handle_item_result(result)
 
     async def _handle_request_result(self, request: 'Request'):
-        self._scheduler.enqueue_request(request)
+        await self._scheduler.put_request(request, self._worker_waiting)
 
     async def _handle_item_result(self, item: 'Item'):
         logger.debug(
@@ -262,6 +619,33 @@ class Engine:
     def get_download_staticate(self) -> [int, int, int]:
         return self._failed_request_count, self._success_request_count, self._downloaded_request_count
 
+    # 爬取过程的统计信息
+    def get_crawl_stats(self) -> dict:
+        stats = {
+            "elapsed_time": time.time() - self._start_time,
+            "downloaded_request_count": self._downloaded_request_count,
+            "success_request_count": self._success_request_count,
+            "failed_request_count": self._downloaded_request_count - self._success_request_count,
+            "coalesced_request_count": self._coalesced_request_count,
+        }
+        if self._controller is not None:
+            stats.update(self._controller.stats())
+            stats["active_workers"] = self._concurrency.in_use
+        if self._callback_executor is not None:
+            stats.update(self._callback_executor.stats())
+        if self._mode == ENGINE_MODE_STAGED:
+            # 解析队列接近上限说明解析是瓶颈，接近0且下载协程都在工作说明下载是瓶颈
+            stats.update({
+                "download_workers": self._unfinished_workers,
+                "busy_download_workers": self._busy_downloaders,
+                "parse_workers": self._unfinished_parsers,
+                "busy_parse_workers": self._busy_parsers,
+                "parse_queue_size": self._parse_queue.qsize() if self._parse_queue is not None else 0,
+                "parse_queue_max_size": self._parse_queue_size,
+            })
+        stats.update(self._scheduler.stats())
+        return stats
+
     # 对外的接口，用于关闭引擎
     def close(self) -> bool:
         with self._state_lock:
@@ -270,24 +654,51 @@ class Engine:
             # 1. 首先关发出关闭信号，
             self._state = ENGINE_STATE_STOPPING
         # 2.在协程中执行关闭流程
-        self._coroutine_pool.go(self._close())
+        self._coroutine_pool.go(self._close(), lane=COROUTINE_LANE_CONTROL)
         return True
 
     async def _close(self):
         # 关闭引擎的步骤
-        # 1.首先关闭调度器
-        self._scheduler.close()
+        # 1.首先发出停止信号，唤醒所有等待request的工作协程
+        self._stop_signal.set()
+        self._scheduler.release_waiters()
         # 2.等待正在执行的reques执行结束
         await self._slot.join()
         logger.info("正在处理的request处理完毕！")
+        if self._controller is not None:
+            self._controller.close()
+        if self._callback_executor is not None:
+            self._callback_executor.close()
+        # 3.关闭调度器，保存未处理的request
+        self._scheduler.close()
         logger.info(f'一共耗时：{time.time() - self._start_time}s')
         logger.info(
             f'下载情况统计： 一共发送请求：{self._downloaded_request_count}    成功请求数量：{self._success_request_count}    失败请求数量：{self._downloaded_request_count - self._success_request_count}')
-        # 3.关闭所有的tcp连接
+        # 4.关闭所有的tcp连接
         self._downloader.close()
-        # 4.执行爬虫中间件
+        self._resources_closed = True
+        # 5.执行爬虫中间件
         await self._middlewareManager.process_spider_close(self._spider)
-        # 5.然后关闭协程池
+        self._coroutine_pool.remove_close_callback(self._downloader.close, COROUTINE_GROUP_DOWNLOAD)
+        self._coroutine_pool.remove_close_callback(self._on_pool_closed, COROUTINE_GROUP_HOUSEKEEPING)
+        # 6.然后关闭协程池
+        with self._state_lock:
+            self._state_signal.set()
+            self._state = ENGINE_STATE_STOPPED
+
+    # 协程池关闭时引擎还没有关闭完成，工作协程和关闭流程都已经被取消，在事件循环中同步释放资源
+    def _on_pool_closed(self):
+        self._stop_signal.set()
+        if self._controller is not None:
+            self._controller.close()
+        if not self._resources_closed:
+            self._resources_closed = True
+            if self._callback_executor is not None:
+                self._callback_executor.close()
+            # 保存未处理的request
+            self._scheduler.close()
+            self._downloader.close()
+        logger.info("协程池已经关闭，引擎被强制停止")
         with self._state_lock:
             self._state_signal.set()
             self._state = ENGINE_STATE_STOPPED
@@ -299,12 +710,18 @@ class Engine:
             middlewareManager = MiddlewareManager()
         if coroutine_pool is None:
             coroutine_pool = PyCoroutinePool.from_setting(settings)
+        if settings.get("FRONTIER_SERVER"):
+            # 多个节点共享一个frontier服务
+            scheduler = RemoteScheduler.from_settings(settings, spider)
+        else:
+            scheduler = Scheduler.from_settings(settings, spider)
         obj = cls(
-            scheduler=Scheduler.from_settings(settings, spider),
+            scheduler=scheduler,
             downloader=Downloader.from_settings(settings, coroutine_pool),
             coroutine_pool=coroutine_pool,
             spider=spider,
             settings=settings,
             middlewareManager=middlewareManager,
+            callback_executor=CallbackExecutor.from_settings(settings, spider),
         )
         return obj
@@ -0,0 +1,166 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from types import AsyncGeneratorType, GeneratorType
+from typing import Callable, Coroutine, AsyncIterator, List
+from sprite.settings import Settings
+from sprite.spider import Spider
+from sprite.item import Item
+from sprite.utils.http.request import Request
+from sprite.utils.http.response import Response
+from sprite.utils.request import request_to_dict, request_from_dict, response_to_dict, response_from_dict
+from sprite.utils.log import get_logger
+
+logger = get_logger()
+
+"""
+CPU密集型的回调函数放到进程池（线程池）中执行，不阻塞协程池的事件循环
+    1.标记方式：回调函数使用 @cpu_bound 装饰、爬虫设置 cpu_bound = True（所有回调）、request.meta["cpu_bound"]（优先级最高）
+    2.进程池：工作进程启动时收到一份爬虫实例，response序列化之后发送到工作进程，
+      回调函数产生的Request序列化之后（回调函数按名称对应爬虫的方法）和Item一起发回主进程，再由引擎加入调度器、交给管道处理
+      回调函数对爬虫实例的修改只在工作进程中生效
+    3.线程池：不需要序列化，适合解析时会释放GIL的库
+    回调函数可以是异步生成器、协程、生成器或者普通函数，在工作进程（线程）中用独立的事件循环执行完毕，收集所有的结果
+"""
+
+EXECUTOR_PROCESS = "process"
+EXECUTOR_THREAD = "thread"
+
+RESULT_REQUEST = "request"
+RESULT_ITEM = "item"
+
+# 工作进程中的爬虫实例
+_worker_spider = None
+# 每个工作线程各自的事件循环
+_local = threading.local()
+
+
+def cpu_bound(func: Callable) -> Callable:
+    """
+    标记回调函数为CPU密集型，引擎会在进程池（线程池）中执行该回调函数
+    """
+    func.cpu_bound = True
+    return func
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    loop = getattr(_local, "loop", None)
+    if loop is None:
+        loop = _local.loop = asyncio.new_event_loop()
+    return loop
+
+
+async def _drain(results, collected: list):
+    if isinstance(results, (Request, Item)):
+        collected.append(results)
+    elif isinstance(results, AsyncGeneratorType):
+        async for result in results:
+            await _drain(result, collected)
+    elif isinstance(results, GeneratorType):
+        for result in results:
+            await _drain(result, collected)
+    elif isinstance(results, Coroutine):
+        await _drain(await results, collected)
+
+
+# 执行回调函数，收集产生的所有Request和Item
+def _collect(results) -> list:
+    collected = []
+    _get_loop().run_until_complete(_drain(results, collected))
+    return collected
+
+
+def _init_worker(spider: Spider):
+    global _worker_spider
+    _worker_spider = spider
+
+
+def _run_in_process(callback_name: str, response_data: dict) -> List[tuple]:
+    spider = _worker_spider
+    response = response_from_dict(spider, response_data)
+    results = []
+    for result in _collect(getattr(spider, callback_name)(response)):
+        if isinstance(result, Request):
+            results.append((RESULT_REQUEST, request_to_dict(result)))
+        else:
+            results.append((RESULT_ITEM, result))
+    return results
+
+
+def _run_in_thread(callback: Callable, response: Response) -> list:
+    return _collect(callback(response))
+
+
+class CallbackExecutor:
+    def __init__(self, spider: Spider, mode: str = EXECUTOR_PROCESS, max_workers: int = 0):
+        if mode not in (EXECUTOR_PROCESS, EXECUTOR_THREAD):
+            raise ValueError(f'unknown CPU_BOUND_EXECUTOR: {mode}')
+        self._spider = spider
+        self._mode = mode
+        self._max_workers = max_workers or os.cpu_count() or 1
+        # 第一次使用时才创建进程池（线程池）
+        self._executor = None
+        self._submitted_count = 0
+        self._pending_count = 0
+
+    def is_cpu_bound(self, callback: Callable, response: Response) -> bool:
+        request = response.request
+        if request is not None and request._meta and "cpu_bound" in request._meta:
+            cpu_bound = bool(request._meta["cpu_bound"])
+        else:
+            cpu_bound = getattr(callback, "cpu_bound", False) or getattr(self._spider, "cpu_bound", False)
+        if cpu_bound and self._mode == EXECUTOR_PROCESS and getattr(callback, "__self__", None) is not self._spider:
+            # 进程池中只能按名称调用爬虫的方法
+            logger.debug(f'callback {callback} is not a method of the spider, run it in the event loop')
+            return False
+        return cpu_bound
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self._mode == EXECUTOR_PROCESS:
+                self._executor = ProcessPoolExecutor(max_workers=self._max_workers, initializer=_init_worker,
+                                                     initargs=(self._spider,))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers,
+                                                    thread_name_prefix="sprite-callback")
+        return self._executor
+
+    async def run(self, callback: Callable, response: Response) -> AsyncIterator:
+        """
+        在进程池（线程池）中执行回调函数，返回回调函数产生的Request和Item
+        """
+        loop = asyncio.get_event_loop()
+        self._submitted_count += 1
+        self._pending_count += 1
+        try:
+            if self._mode == EXECUTOR_THREAD:
+                results = await loop.run_in_executor(self._get_executor(), _run_in_thread, callback, response)
+            else:
+                data = await loop.run_in_executor(self._get_executor(), _run_in_process, callback.__name__,
+                                                  response_to_dict(response))
+                results = [request_from_dict(self._spider, value) if kind == RESULT_REQUEST else value
+                           for kind, value in data]
+        finally:
+            self._pending_count -= 1
+        for result in results:
+            yield result
+
+    def stats(self) -> dict:
+        return {
+            "cpu_bound_callback_count": self._submitted_count,
+            "cpu_bound_pending_count": self._pending_count,
+        }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    @classmethod
+    def from_settings(cls, settings: Settings, spider: Spider):
+        return cls(spider, mode=settings.get("CPU_BOUND_EXECUTOR", EXECUTOR_PROCESS),
+                   max_workers=settings.getint("CPU_BOUND_WORKERS"))
@@ -0,0 +1,595 @@
+# -*- coding:utf-8 -*-
+
+
+import json
+import time
+import heapq
+import base64
+import pickle
+import struct
+import asyncio
+import itertools
+import traceback
+from collections import deque, OrderedDict
+from typing import List, Optional, Iterable, Callable
+from sprite.core.mq.base import BaseMQ
+from sprite.core.scheduler import Scheduler
+from sprite.settings import Settings
+from sprite.spider import Spider
+from sprite.utils.http.request import Request
+from sprite.utils.request import request_to_dict, request_from_dict, request_host_key, RequestFingerprinter
+from sprite.utils.log import get_logger
+from sprite.exceptions import FrontierException
+
+logger = get_logger()
+
+"""
+多个节点共享的frontier服务
+    服务端（FrontierServer）
+        1.保存所有节点共享的队列和去重过滤器，队列按域名分区（HostPartitionedMQ），租用时在各个域名之间轮转
+        2.enqueue：批量加入request（指纹、域名、优先级、序列化之后的request），按指纹去重
+        3.lease：批量租用request，队列为空时最多挂起wait秒，租出的request在lease_timeout秒之内没有ack则重新投递（至少一次）
+        4.ack：确认租出的request已经处理完毕
+        request由客户端序列化，服务端只保存字节，不反序列化
+    协议
+        TCP长连接，每一帧：4字节长度（大端） + utf-8编码的json，请求带有id，响应带有相同的id，同一个连接上的请求并发处理
+    客户端（RemoteScheduler）
+        1.与调度器的接口一致，设置FRONTIER_SERVER之后引擎使用RemoteScheduler，每个节点都执行start_requests，由服务端去重
+        2.回调产生的request和ack缓存在本地，定时批量发送
+        3.本地缓存的request被取完之后批量租用
+        4.服务端没有排队和租出的request，并且本地没有未发送的request，持续FRONTIER_IDLE_TIMEOUT秒之后认为整个爬取结束
+"""
+
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[dict]:
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError:
+        # 连接关闭
+        return None
+    length, = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise FrontierException(f'frame too large: {length}')
+    body = await reader.readexactly(length)
+    return json.loads(body.decode("utf-8"))
+
+
+def write_frame(writer: asyncio.StreamWriter, message: dict):
+    body = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    writer.write(FRAME_HEADER.pack(len(body)) + body)
+
+
+class HostPartitionedMQ(BaseMQ):
+    """
+    按域名分区的消息队列，每个分区内按优先级（从小到大）先进先出，push时在有消息的分区之间轮转
+    """
+
+    def __init__(self):
+        self._partitions = {}
+        # 有消息的分区，按轮转顺序排列
+        self._ready = deque()
+        self._seq = itertools.count()
+        self._count = 0
+
+    def put(self, data: bytes, key: str = "", priority: int = 0):
+        heap = self._partitions.get(key)
+        if heap is None:
+            heap = self._partitions[key] = []
+            self._ready.append(key)
+        heapq.heappush(heap, (priority, next(self._seq), data))
+        self._count += 1
+
+    def push(self) -> bytes:
+        return self.push_entry()[2]
+
+    def push_entry(self):
+        # 返回 (分区, 优先级, 消息)
+        if not self._ready:
+            raise IndexError("push from an empty queue")
+        key = self._ready.popleft()
+        heap = self._partitions[key]
+        priority, _, data = heapq.heappop(heap)
+        if heap:
+            self._ready.append(key)
+        else:
+            del self._partitions[key]
+        self._count -= 1
+        return key, priority, data
+
+    @property
+    def partition_count(self) -> int:
+        return len(self._partitions)
+
+    def __len__(self):
+        return self._count
+
+
+class FrontierServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8090, df=None, lease_timeout: float = 60,
+                 max_wait: float = 5):
+        self._host = host
+        self._port = port
+        self._mq = HostPartitionedMQ()
+        self._df = df if df is not None else Scheduler._create_df(Settings(), None)
+        # 租出的request超过该时间没有ack则重新投递
+        self._lease_timeout = lease_timeout
+        # lease请求最多挂起的时间
+        self._max_wait = max_wait
+        # 租约id -> (到期时间, 分区, 优先级, 消息)，租约的时长相同，按插入顺序即按到期时间排列
+        self._leases = OrderedDict()
+        self._lease_ids = itertools.count(1)
+        self._server = None
+        self._sweep_task = None
+        self._not_empty = None
+        self._clients = 0
+        self._enqueued_count = 0
+        self._duplicate_count = 0
+        self._leased_count = 0
+        self._acked_count = 0
+        self._redelivered_count = 0
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    async def start(self):
+        self._not_empty = asyncio.Event()
+        self._server = await asyncio.start_server(self._handle_connection, self._host, self._port)
+        # 端口为0时使用系统分配的端口
+        self._port = self._server.sockets[0].getsockname()[1]
+        self._sweep_task = asyncio.ensure_future(self._sweep())
+        logger.info(f'frontier server listening on {self._host}:{self._port}')
+
+    async def serve_forever(self):
+        await self.start()
+        await self._server.wait_closed()
+
+    # 在当前线程中运行frontier服务，直到调用close
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.serve_forever())
+        finally:
+            loop.close()
+
+    def close(self):
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+        if self._server is not None:
+            self._server.close()
+        close_df = getattr(self._df, "close", None)
+        if close_df is not None:
+            close_df()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._clients += 1
+        # 正在处理的请求，关闭连接之前等待它们写完响应
+        responses = set()
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                # 同一个连接上的请求并发处理，挂起的lease不阻塞enqueue和ack
+                response = asyncio.ensure_future(self._respond(message, writer))
+                responses.add(response)
+                response.add_done_callback(responses.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.info(f'frontier connection find one error: \n{traceback.format_exc()}')
+        finally:
+            self._clients -= 1
+            try:
+                if responses:
+                    await asyncio.gather(*responses, return_exceptions=True)
+            finally:
+                writer.close()
+
+    async def _respond(self, message: dict, writer: asyncio.StreamWriter):
+        try:
+            response = await self._dispatch(message)
+        except Exception as e:
+            logger.info(f'frontier request find one error: \n{traceback.format_exc()}')
+            response = {"error": f'{type(e).__name__}: {e}'}
+        response["id"] = message.get("id")
+        try:
+            write_frame(writer, response)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _dispatch(self, message: dict) -> dict:
+        op = message.get("op")
+        if op == "enqueue":
+            return self._enqueue(message.get("items", []))
+        elif op == "lease":
+            return await self._lease(int(message.get("max", 1)), float(message.get("wait", 0)))
+        elif op == "ack":
+            return self._ack(message.get("ids", []))
+        elif op == "stats":
+            return self.stats()
+        raise FrontierException(f'unknown op: {op}')
+
+    def _counts(self) -> dict:
+        return {"queued": len(self._mq), "leased": len(self._leases)}
+
+    def _enqueue(self, items: List[list]) -> dict:
+        added = 0
+        for fingerprint, key, priority, payload, dont_filter in items:
+            if self._df.add(fingerprint) and not dont_filter:
+                self._duplicate_count += 1
+                continue
+            self._mq.put(base64.b64decode(payload), key, priority)
+            added += 1
+        self._enqueued_count += added
+        if added:
+            self._not_empty.set()
+        response = self._counts()
+        response["added"] = added
+        return response
+
+    async def _lease(self, max_count: int, wait: float) -> dict:
+        wait = min(max(wait, 0), self._max_wait)
+        deadline = time.monotonic() + wait
+        while not len(self._mq):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._not_empty.clear()
+            try:
+                await asyncio.wait_for(self._not_empty.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        items = []
+        expire_at = time.monotonic() + self._lease_timeout
+        for _ in range(min(max_count, len(self._mq))):
+            key, priority, data = self._mq.push_entry()
+            lease_id = next(self._lease_ids)
+            self._leases[lease_id] = (expire_at, key, priority, data)
+            items.append([lease_id, base64.b64encode(data).decode("ascii")])
+        self._leased_count += len(items)
+        response = self._counts()
+        response["items"] = items
+        return response
+
+    def _ack(self, lease_ids: Iterable[int]) -> dict:
+        for lease_id in lease_ids:
+            # 已经过期重新投递的租约直接忽略
+            if self._leases.pop(lease_id, None) is not None:
+                self._acked_count += 1
+        return self._counts()
+
+    # 定时把过期的租约重新放回队列
+    async def _sweep(self):
+        interval = min(max(self._lease_timeout / 4, 0.05), 1)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            redelivered = 0
+            while self._leases:
+                lease_id, (expire_at, key, priority, data) = next(iter(self._leases.items()))
+                if expire_at > now:
+                    break
+                del self._leases[lease_id]
+                self._mq.put(data, key, priority)
+                redelivered += 1
+            if redelivered:
+                self._redelivered_count += redelivered
+                self._not_empty.set()
+                logger.info(f'redeliver {redelivered} expired leases')
+
+    def stats(self) -> dict:
+        stats = self._counts()
+        stats.update({
+            "partitions": self._mq.partition_count,
+            "clients": self._clients,
+            "enqueued_count": self._enqueued_count,
+            "duplicate_count": self._duplicate_count,
+            "leased_count": self._leased_count,
+            "acked_count": self._acked_count,
+            "redelivered_count": self._redelivered_count,
+            "dupefilter_size": len(self._df),
+        })
+        return stats
+
+    @classmethod
+    def from_settings(cls, settings: Settings, spider: Spider = None):
+        return cls(host=settings.get("FRONTIER_SERVER_HOST"), port=settings.getint("FRONTIER_SERVER_PORT"),
+                   df=Scheduler._create_df(settings, spider),
+                   lease_timeout=settings.getfloat("FRONTIER_LEASE_TIMEOUT"))
+
+
+class FrontierClient:
+    def __init__(self, host: str, port: int, timeout: float = 30):
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._connect_lock = None
+        # 请求id -> 等待响应的future
+        self._futures = {}
+        self._ids = itertools.count(1)
+
+    async def connect(self):
+        if self._writer is not None:
+            return
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
+            self._reader_task = asyncio.ensure_future(self._read_loop(self._reader))
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                future = self._futures.pop(message.pop("id", None), None)
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(FrontierException(message["error"]))
+                else:
+                    future.set_result(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.info(f'frontier client find one error: \n{traceback.format_exc()}')
+        finally:
+            self._disconnect()
+
+    def _disconnect(self):
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+        futures, self._futures = self._futures, {}
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(ConnectionError("frontier server connection closed"))
+
+    async def call(self, op: str, **kwargs) -> dict:
+        await self.connect()
+        message_id = next(self._ids)
+        future = asyncio.get_event_loop().create_future()
+        self._futures[message_id] = future
+        kwargs.update(op=op, id=message_id)
+        try:
+            write_frame(self._writer, kwargs)
+            await self._writer.drain()
+            return await asyncio.wait_for(future, self._timeout + kwargs.get("wait", 0))
+        finally:
+            self._futures.pop(message_id, None)
+
+    async def enqueue(self, items: List[list]) -> dict:
+        return await self.call("enqueue", items=items)
+
+    async def lease(self, max_count: int, wait: float = 0) -> dict:
+        return await self.call("lease", max=max_count, wait=wait)
+
+    async def ack(self, lease_ids: List[int]) -> dict:
+        return await self.call("ack", ids=lease_ids)
+
+    async def stats(self) -> dict:
+        return await self.call("stats")
+
+    def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        self._disconnect()
+
+
+class RemoteScheduler:
+    def __init__(self, spider: Spider, host: str, port: int, fingerprinter: RequestFingerprinter = None,
+                 lease_size: int = 20, lease_wait: float = 1, flush_interval: float = 0.05,
+                 idle_timeout: float = 5, timeout: float = 30):
+        self._spider = spider
+        self._client = FrontierClient(host, port, timeout=timeout)
+        self._fingerprinter = fingerprinter if fingerprinter is not None else RequestFingerprinter()
+        self._lease_size = max(lease_size, 1)
+        self._lease_wait = lease_wait
+        self._flush_interval = flush_interval
+        self._idle_timeout = idle_timeout
+        # 租用到本地，还没有被工作协程取走的request
+        self._buffer = deque()
+        # request对象 -> 租约id
+        self._lease_ids = {}
+        # 租用到本地还没有处理完毕的request数量
+        self._in_flight = 0
+        # 还没有发送的request和ack
+        self._outgoing = []
+        self._acks = []
+        # 是否已经加入过request，之前调度器为空，引擎会拉取start_requests
+        self._active = False
+        self._released = False
+        self._closed = False
+        self._fill_lock = None
+        self._flush_event = None
+        self._flush_task = None
+        self._idle_since = None
+        # 最近一次响应中服务端排队和租出的request数量
+        self._server_queued = 0
+        self._server_leased = 0
+
+    @classmethod
+    def from_settings(cls, settings: Settings, spider: Spider):
+        host, port = settings.get("FRONTIER_SERVER").rsplit(":", 1)
+        return cls(spider, host=host, port=int(port),
+                   fingerprinter=RequestFingerprinter(include_headers=settings.getlist("FINGERPRINT_HEADERS"),
+                                                      bits=settings.getint("FINGERPRINT_BITS"),
+                                                      cache_size=settings.getint("FINGERPRINT_CACHE_SIZE")),
+                   lease_size=settings.getint("FRONTIER_LEASE_SIZE"),
+                   lease_wait=settings.getfloat("FRONTIER_LEASE_WAIT"),
+                   flush_interval=settings.getfloat("FRONTIER_FLUSH_INTERVAL"),
+                   idle_timeout=settings.getfloat("FRONTIER_IDLE_TIMEOUT"))
+
+    def start(self):
+        self._released = False
+        self._closed = False
+        self._fill_lock = asyncio.Lock()
+        self._flush_event = asyncio.Event()
+        self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    def set_router(self, router):
+        raise FrontierException("RemoteScheduler can not be sharded, the frontier server already partitions by host")
+
+    def has_pending_requests(self) -> bool:
+        # 开始之后，只有确认整个爬取结束才返回False
+        return bool(self._buffer) or (self._active and not self._released)
+
+    def _serialize(self, request: Request) -> list:
+        key = "%s://%s:%d" % request_host_key(request)
+        payload = base64.b64encode(pickle.dumps(request_to_dict(request))).decode("ascii")
+        return [self._fingerprinter(request), key, request.priority, payload, request.dont_filter]
+
+    def enqueue_request(self, request: Request) -> bool:
+        self._outgoing.append(self._serialize(request))
+        self._active = True
+        self._idle_since = None
+        if len(self._outgoing) >= self._lease_size and self._flush_event is not None:
+            self._flush_event.set()
+        return True
+
+    # 去重在服务端进行，返回发送的数量
+    def enqueue_requests(self, requests: Iterable[Request]) -> int:
+        count = 0
+        for request in requests:
+            self.enqueue_request(request)
+            count += 1
+        return count
+
+    # 租约在处理完毕之后才确认
+    def download_done(self, request: Request):
+        pass
+
+    def request_done(self, request: Request, release: bool = True):
+        lease_id = self._lease_ids.pop(id(request), None)
+        if lease_id is None:
+            return
+        self._acks.append(lease_id)
+        self._in_flight -= 1
+
+    # 上限由服务端控制，直接发送
+    async def put_requests(self, requests: Iterable[Request], waiting: Callable[[bool], None] = None) -> int:
+        return self.enqueue_requests(requests)
+
+    async def put_request(self, request: Request, waiting: Callable[[bool], None] = None) -> bool:
+        return self.enqueue_request(request)
+
+    async def wait_below(self, size: int):
+        await self._flush()
+
+    def _update(self, response: dict):
+        self._server_queued = response.get("queued", self._server_queued)
+        self._server_leased = response.get("leased", self._server_leased)
+
+    # 发送缓存的request和ack，发送失败的保留到下一次
+    async def _flush(self):
+        if self._outgoing:
+            items, self._outgoing = self._outgoing, []
+            try:
+                self._update(await self._client.enqueue(items))
+            except Exception:
+                logger.info(f'send requests to frontier server failed: \n{traceback.format_exc()}')
+                self._outgoing = items + self._outgoing
+        if self._acks:
+            lease_ids, self._acks = self._acks, []
+            try:
+                self._update(await self._client.ack(lease_ids))
+            except Exception:
+                logger.info(f'ack requests to frontier server failed: \n{traceback.format_exc()}')
+                self._acks = lease_ids + self._acks
+
+    async def _flush_loop(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self._flush()
+
+    async def next_request(self) -> Optional[Request]:
+        while True:
+            if self._buffer:
+                return self._buffer.popleft()
+            if self._released:
+                return None
+            # 同一时间只有一个协程租用request，其他协程等待租用的结果
+            async with self._fill_lock:
+                if not self._buffer and not self._released:
+                    await self._fill()
+
+    async def _fill(self):
+        # 先发送本地的request和ack，服务端返回的数量才是准确的
+        await self._flush()
+        try:
+            response = await self._client.lease(self._lease_size, wait=self._lease_wait)
+        except Exception:
+            logger.info(f'lease requests from frontier server failed: \n{traceback.format_exc()}')
+            await asyncio.sleep(self._lease_wait)
+            return
+        self._update(response)
+        for lease_id, payload in response.get("items", []):
+            try:
+                request = request_from_dict(self._spider, pickle.loads(base64.b64decode(payload)))
+            except Exception:
+                logger.info(f'load request from frontier server failed: \n{traceback.format_exc()}')
+                self._acks.append(lease_id)
+                continue
+            self._lease_ids[id(request)] = lease_id
+            self._buffer.append(request)
+            self._in_flight += 1
+        if self._buffer:
+            self._idle_since = None
+        else:
+            self._check_idle()
+
+    def _check_idle(self):
+        if self._server_queued or self._server_leased or self._outgoing or self._acks or self._in_flight:
+            self._idle_since = None
+            return
+        now = time.monotonic()
+        if self._idle_since is None:
+            self._idle_since = now
+        elif now - self._idle_since >= self._idle_timeout:
+            logger.info(f'frontier server is empty for {self._idle_timeout}s, release all waiting workers')
+            self.release_waiters()
+
+    def release_waiters(self):
+        self._released = True
+
+    def close(self):
+        self._closed = True
+        asyncio.ensure_future(self._close())
+
+    async def _close(self):
+        # 发送剩余的request和ack，没有处理完的租约由服务端过期之后重新投递
+        await self._flush()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self._client.close()
+
+    def __len__(self):
+        return len(self._buffer) + len(self._outgoing)
+
+    def stats(self) -> dict:
+        return {
+            "frontier_size": len(self._buffer),
+            "frontier_outgoing_size": len(self._outgoing),
+            "frontier_in_flight": self._in_flight,
+            "frontier_server_queued": self._server_queued,
+            "frontier_server_leased": self._server_leased,
+        }
@@ -0,0 +1,231 @@
+# -*- coding:utf-8 -*-
+
+import os
+import time
+import shutil
+import struct
+import threading
+import traceback
+from typing import Iterator, Tuple
+from sprite.utils.log import get_logger
+
+logger = get_logger()
+
+"""
+request的追加写日志
+    文件格式
+        多条记录顺序追加，每一条记录：类型(1字节) + 序号(8字节) + 消息长度(4字节) + 消息body
+        类型 E：request加入队列，body为序列化之后的request
+        类型 D：request处理完毕，body为空
+    回放
+        1.按照写入顺序读取，E记录加入未处理的request，D记录将其移除，剩余的即为未处理的request
+        2.末尾不完整的记录（进程被强制杀死时写了一半）直接截断
+    刷新
+        每隔flush_interval刷新到操作系统，每隔sync_interval调用fsync写入磁盘（机器断电时最多丢失这段时间内的记录）
+    压缩
+        处理完毕的记录数量超过阈值（且多于未处理完毕的数量）之后，在子线程中把还未处理完毕的E记录重写到新的日志文件，
+        重写期间追加的记录在重写完成之后复制到新的日志文件末尾，再替换掉旧的日志文件，不阻塞事件循环
+"""
+
+RECORD_ENQUEUE = b"E"
+RECORD_DONE = b"D"
+
+RECORD_HEADER_FMT = "<cQI"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FMT)
+
+
+def _iter_records(f, end: int = None) -> Iterator[Tuple[bytes, int, bytes]]:
+    # 从文件的当前位置读取到end（为空则读取到末尾），每次yield时文件的位置正好在这条记录的末尾
+    while end is None or f.tell() < end:
+        header = f.read(RECORD_HEADER_SIZE)
+        if len(header) < RECORD_HEADER_SIZE:
+            break
+        record_type, seq, length = struct.unpack(RECORD_HEADER_FMT, header)
+        body = f.read(length)
+        if len(body) < length:
+            break
+        yield record_type, seq, body
+
+
+class RequestJournal:
+    def __init__(self, path: str, flush_interval: float = 0.05, compact_threshold: int = 100000,
+                 sync_interval: float = 1):
+        self._path = path
+        # 两次刷新到文件之间的最大间隔
+        self._flush_interval = flush_interval
+        # 两次fsync之间的最大间隔
+        self._sync_interval = sync_interval
+        # 处理完毕的记录数量超过该值之后压缩日志
+        self._compact_threshold = compact_threshold
+        self._file = None
+        self._next_seq = 0
+        self._live = set()
+        self._dead = 0
+        self._dirty = False
+        self._unsynced = False
+        self._last_flush_time = time.monotonic()
+        self._last_sync_time = time.monotonic()
+        # 正在压缩日志的子线程，压缩开始时日志文件的长度，子线程中的异常
+        self._compactor = None
+        self._compact_offset = 0
+        self._compact_error = None
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    @property
+    def pending(self) -> bool:
+        """
+        是否还有未fsync的记录或者未完成的压缩，需要之后再调用flush
+        """
+        return self._dirty or self._unsynced or self._compactor is not None
+
+    def __len__(self):
+        return len(self._live)
+
+    def open(self) -> Iterator[Tuple[int, bytes]]:
+        """
+        打开日志，回放并返回未处理完毕的(序号, request)，处理完毕的记录超过阈值时在后台压缩日志
+        """
+        records = {}
+        if os.path.exists(self._path):
+            with open(self._path, "rb") as f:
+                end = 0
+                for record_type, seq, body in _iter_records(f):
+                    end = f.tell()
+                    self._next_seq = max(self._next_seq, seq + 1)
+                    if record_type == RECORD_ENQUEUE:
+                        records[seq] = body
+                    elif records.pop(seq, None) is not None:
+                        self._dead += 1
+            if end < os.path.getsize(self._path):
+                logger.info(f'truncate incomplete record at the end of request journal')
+                os.truncate(self._path, end)
+            self._live.update(records)
+            logger.info(f'replay request journal, {len(records)} requests not finished')
+        self._file = open(self._path, "ab")
+        self._maybe_compact()
+        return list(records.items())
+
+    @staticmethod
+    def _write_record(f, record_type: bytes, seq: int, body: bytes = b""):
+        f.write(struct.pack(RECORD_HEADER_FMT, record_type, seq, len(body)))
+        if body:
+            f.write(body)
+
+    def append(self, body: bytes) -> int:
+        seq = self._next_seq
+        self._next_seq += 1
+        self._write_record(self._file, RECORD_ENQUEUE, seq, body)
+        self._live.add(seq)
+        self._written()
+        return seq
+
+    def done(self, seq: int):
+        if seq not in self._live:
+            return
+        self._live.discard(seq)
+        self._write_record(self._file, RECORD_DONE, seq)
+        self._dead += 1
+        self._written()
+        self._maybe_compact()
+
+    def _written(self):
+        self._dirty = True
+        self._unsynced = True
+        if time.monotonic() - self._last_flush_time >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._file is None:
+            return
+        self._finish_compact()
+        if self._dirty:
+            self._file.flush()
+            self._dirty = False
+        self._last_flush_time = time.monotonic()
+        if self._unsynced and self._last_flush_time - self._last_sync_time >= self._sync_interval:
+            self.sync()
+
+    def sync(self):
+        """
+        刷新并fsync到磁盘
+        """
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._dirty = False
+        self._unsynced = False
+        self._last_flush_time = self._last_sync_time = time.monotonic()
+
+    def _maybe_compact(self):
+        if self._compactor is None and self._dead >= self._compact_threshold and self._dead > len(self._live):
+            self.compact(wait=False)
+
+    def compact(self, wait: bool = True):
+        """
+        只保留未处理完毕的E记录，重写日志文件，wait为False时在子线程中重写，之后调用flush时替换旧的日志文件
+        """
+        self._finish_compact(wait=True)
+        self._file.flush()
+        self._dirty = False
+        self._compact_offset = self._file.tell()
+        self._dead = 0
+        self._compactor = threading.Thread(target=self._rewrite, args=(self._compact_offset, set(self._live)),
+                                           name="sprite-journal-compact", daemon=True)
+        self._compactor.start()
+        if wait:
+            self._finish_compact(wait=True)
+
+    def _rewrite(self, offset: int, live: set):
+        # 子线程中运行，只读取压缩开始之前写入的记录
+        try:
+            with open(self._path, "rb") as src, open(self._path + ".tmp", "wb") as f:
+                for record_type, seq, body in _iter_records(src, offset):
+                    if record_type == RECORD_ENQUEUE and seq in live:
+                        self._write_record(f, RECORD_ENQUEUE, seq, body)
+        except Exception:
+            self._compact_error = traceback.format_exc()
+
+    def _finish_compact(self, wait: bool = False):
+        if self._compactor is None or (not wait and self._compactor.is_alive()):
+            return
+        self._compactor.join()
+        self._compactor = None
+        tmp_path = self._path + ".tmp"
+        if self._compact_error is not None:
+            logger.info(f'compact request journal failed: \n{self._compact_error}')
+            self._compact_error = None
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        # 压缩期间追加的记录复制到新的日志文件末尾
+        self._file.flush()
+        with open(self._path, "rb") as src, open(tmp_path, "ab") as f:
+            src.seek(self._compact_offset)
+            shutil.copyfileobj(src, f)
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self._path)
+        self._file = open(self._path, "ab")
+        self._dirty = False
+        self._unsynced = False
+        self._last_flush_time = self._last_sync_time = time.monotonic()
+
+    def close(self):
+        if self._file is None:
+            return
+        self._finish_compact(wait=True)
+        self.sync()
+        self._file.close()
+        self._file = None
+        if not self._live:
+            # 所有的request都已经处理完毕
+            os.remove(self._path)
@@ -203,6 +203,8 @@ class DiskQueue(BackendQueue):
         # 2.初始化写文件句柄、读文件句柄
         self._writer_file_obj = open(self._get_data_file_path(self._writer_file_num), "ab")
         self._reader_file_obj = open(self._get_data_file_path(self._reader_file_num), "rb")
+        # 3.重启时，读文件句柄需要跳转到上次读取的位置
+        self._reader_file_obj.seek(self._reader_file_position)
 
     def _io_loop(self):
         """
@@ -272,7 +274,48 @@ class DiskQueue(BackendQueue):
         return depth
 
     def delete(self):
-        pass
+        """
+        关闭队列，并删除所有的数据文件和元文件
+        """
+        self._lock.acquire()
+        try:
+            if self._running:
+                self._reader_file_obj.close()
+                self._writer_file_obj.close()
+                self._running = False
+                self._running_event.set()
+            for file_num in range(self._reader_file_num, self._writer_file_num + 1):
+                file_path = self._get_data_file_path(file_num)
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            if os.path.exists(self._meta_file_path):
+                os.remove(self._meta_file_path)
+        finally:
+            self._lock.release()
+
+    def iter_messages(self):
+        """
+        按照写入顺序遍历队列中剩余的消息，不消费消息
+        """
+        self._lock.acquire()
+        try:
+            self._is_closed()
+            file_num, position = self._reader_file_num, self._reader_file_position
+            writer_file_num, writer_file_position = self._writer_file_num, self._writer_file_position
+        finally:
+            self._lock.release()
+        while file_num < writer_file_num or (file_num == writer_file_num and position < writer_file_position):
+            with open(self._get_data_file_path(file_num), "rb") as f:
+                f.seek(position)
+                while position < self._max_per_file_size and not (
+                        file_num == writer_file_num and position >= writer_file_position):
+                    message_length = struct.unpack(DEFAULT_DATA_LENGTH_PACK_TEMPLATE,
+                                                   f.read(DEFAULT_DATA_LENGTH_SIZE))[0]
+                    yield f.read(message_length)
+                    position += DEFAULT_DATA_LENGTH_SIZE + message_length
+            if file_num == writer_file_num:
+                break
+            file_num, position = file_num + 1, 0
 
     def close(self):
         self._write_meta_info_to_file(self._meta_file_path)
@@ -324,6 +367,8 @@ class DiskQueue(BackendQueue):
                 self._reader_file_num += 1
                 self._reader_file_position = 0
                 self._reader_file_obj.close()
+                # 已经读取完毕的数据文件直接删除
+                os.remove(self._get_data_file_path(self._reader_file_num - 1))
                 self._reader_file_obj = open(self._get_data_file_path(self._reader_file_num), "rb")
         elif info_type == "write":
             self._writer_file_position += data_length
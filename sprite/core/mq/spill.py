@@ -0,0 +1,171 @@
+# -*- coding:utf-8 -*-
+
+
+import heapq
+import shutil
+import tempfile
+import traceback
+from collections import deque
+from typing import Callable
+from sprite.core.mq.memory import DiskQueue
+from sprite.utils.log import get_logger
+
+logger = get_logger()
+
+"""
+内存 + 磁盘的混合优先队列
+    每一个权重对应一个分段（band），分段由内存中的双端队列（队头）和磁盘队列（队尾）组成
+    写入消息
+        1.内存中的数量或者占用的字节数没有超过限制，并且该分段没有溢出到磁盘的消息，则写入内存
+        2.否则序列化之后写入该分段对应的磁盘队列
+    读取消息
+        1.从权重最小的分段读取
+        2.分段的内存队列为空时，从磁盘中批量读取一批消息补充到内存
+    同一权重先进先出，不同权重按权重从小到大弹出，与 HeapPriorityQueue 保持一致
+"""
+
+
+class _Band:
+    __slots__ = ('memory', 'disk', 'disk_count')
+
+    def __init__(self):
+        self.memory = deque()
+        self.disk = None
+        self.disk_count = 0
+
+
+class SpillQueue:
+    def __init__(self, serialize: Callable, deserialize: Callable, dir_path: str = None, max_memory_count: int = 100000,
+                 max_memory_bytes: int = 0, sizeof: Callable = None, refill_size: int = 1000,
+                 max_per_file_size: int = 64 * 1024 * 1024, max_message_size: int = 16 * 1024 * 1024):
+        # 在指定目录（为空则使用系统临时目录）下创建一个独立的目录保存磁盘队列
+        self._dir_path = tempfile.mkdtemp(prefix="frontier-", dir=dir_path or None)
+        self._serialize = serialize
+        self._deserialize = deserialize
+        # 内存中最多保存的消息数量，0表示不限制
+        self._max_memory_count = max_memory_count
+        # 内存中最多占用的字节数（由sizeof估算），0表示不限制
+        self._max_memory_bytes = max_memory_bytes
+        self._sizeof = sizeof
+        # 每次从磁盘补充到内存的消息数量
+        self._refill_size = max(refill_size, 1)
+        self._max_per_file_size = max_per_file_size
+        self._max_message_size = max_message_size
+
+        self._bands = {}
+        self._heap = []
+        self._count = 0
+        self._memory_count = 0
+        self._memory_bytes = 0
+        self._disk_count = 0
+
+    def _memory_full(self) -> bool:
+        if self._max_memory_count and self._memory_count >= self._max_memory_count:
+            return True
+        if self._max_memory_bytes and self._memory_bytes >= self._max_memory_bytes:
+            return True
+        return False
+
+    def _item_size(self, item) -> int:
+        if self._max_memory_bytes and self._sizeof is not None:
+            return self._sizeof(item)
+        return 0
+
+    def _add_memory(self, band: _Band, item):
+        band.memory.append(item)
+        self._memory_count += 1
+        self._memory_bytes += self._item_size(item)
+
+    def push(self, item, priority: int = 0):  # 压入元素
+        band = self._bands.get(priority)
+        if band is None:
+            band = self._bands[priority] = _Band()
+            heapq.heappush(self._heap, priority)
+        if band.disk_count or self._memory_full():
+            # 内存已满，或者该权重已经有消息溢出到磁盘（保证先进先出），写入磁盘
+            if band.disk is None:
+                band.disk = DiskQueue(self._dir_path, f'p{priority}', max_per_file_size=self._max_per_file_size,
+                                      max_message_size=self._max_message_size)
+            band.disk.put(self._serialize(item))
+            band.disk_count += 1
+            self._disk_count += 1
+        else:
+            self._add_memory(band, item)
+        self._count += 1
+
+    def _refill(self, band: _Band):
+        # 从磁盘批量读取消息补充到内存，至少读取一条
+        size = self._refill_size
+        if self._max_memory_count:
+            size = min(size, self._max_memory_count - self._memory_count)
+        size = min(max(size, 1), band.disk_count)
+        for _ in range(size):
+            data = band.disk.read()
+            band.disk_count -= 1
+            self._disk_count -= 1
+            try:
+                self._add_memory(band, self._deserialize(data))
+            except Exception:
+                # 无法还原的消息直接丢弃
+                self._count -= 1
+                logger.error(f'spill queue drop one message: \n{traceback.format_exc()}')
+
+    def pop(self):  # 弹出元素
+        while self._heap:
+            priority = self._heap[0]
+            band = self._bands[priority]
+            while not band.memory and band.disk_count:
+                self._refill(band)
+            if band.memory:
+                item = band.memory.popleft()
+                self._memory_count -= 1
+                self._memory_bytes -= self._item_size(item)
+                self._count -= 1
+                if not band.memory and not band.disk_count:
+                    self._remove_band(priority)
+                return item, priority
+            # 分段中的消息都无法还原
+            self._remove_band(priority)
+        raise IndexError("pop from an empty queue")  # 优先队列为空
+
+    def _remove_band(self, priority: int):
+        heapq.heappop(self._heap)
+        band = self._bands.pop(priority)
+        if band.disk is not None:
+            band.disk.delete()
+
+    @property
+    def memory_size(self) -> int:
+        return self._memory_count
+
+    @property
+    def disk_size(self) -> int:
+        return self._disk_count
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):  # 按照弹出的顺序遍历，磁盘中的消息会被反序列化
+        for priority in sorted(self._bands.keys()):
+            band = self._bands[priority]
+            for item in band.memory:
+                yield item, priority
+            if band.disk_count:
+                for data in band.disk.iter_messages():
+                    try:
+                        yield self._deserialize(data), priority
+                    except Exception:
+                        logger.error(f'spill queue skip one message: \n{traceback.format_exc()}')
+
+    def __bool__(self):
+        return self._count > 0
+
+    def close(self):
+        # 删除所有的磁盘队列以及队列目录
+        for band in self._bands.values():
+            if band.disk is not None:
+                band.disk.delete()
+        self._bands.clear()
+        self._heap.clear()
+        self._count = self._memory_count = self._memory_bytes = self._disk_count = 0
+        shutil.rmtree(self._dir_path, ignore_errors=True)
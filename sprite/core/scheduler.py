@@ -4,15 +4,25 @@ __date__ = '2019/8/16 19:45'
 
 import os
 import pickle
+import asyncio
 import traceback
+from typing import Optional, Iterable, Callable
+from collections import deque
 from sprite.utils.queues import Queue
 from sprite.utils.http.request import Request
-from sprite.utils.queues import PriorityQueue
+from sprite.utils.queues import PriorityQueue, HeapPriorityQueue, HostQueue
 from sprite.utils.log import get_logger
-from sprite.utils.pybloomfilter import ScalableBloomFilter
-from sprite.utils.request import request_to_dict, request_from_dict
+from sprite.utils.pybloomfilter import ScalableBloomFilter, PersistentScalableBloomFilter, SharedBloomFilter, \
+    HASH_SCHEMES
+from sprite.utils.fingerprintset import FingerprintSet
+from sprite.utils.cuckoofilter import CuckooFilter, TimeBucketedCuckooFilter
+from sprite.utils.request import request_to_dict, request_from_dict, request_host_key, request_size, \
+    RequestFingerprinter
+from sprite.core.mq.spill import SpillQueue
+from sprite.core.journal import RequestJournal
 from sprite.settings import Settings
 from sprite.exceptions import TypeNotSupport, SchedulerEmptyException
+from sprite.const import REQUEST_META_JOURNAL_SEQ
 
 logger = get_logger()
 
@@ -41,83 +51,483 @@ class Slot:
 
 # 调度器
 class Scheduler:
-    def __init__(self, spider: "Spider", df=None, queue=None, long_save: bool = False, job_dir: str = None):
+    def __init__(self, spider: "Spider", df=None, queue=None, long_save: bool = False, job_dir: str = None,
+                 journal_flush_interval: float = 0.05, journal_compact_threshold: int = 100000,
+                 journal_sync_interval: float = 1,
+                 df_checkpoint_interval: float = 60, fingerprinter: RequestFingerprinter = None,
+                 high_water: int = 0, overflow: str = "block"):
         self._spider = spider
-        self._priorityQueue = queue or PriorityQueue()
-        self._df = df or ScalableBloomFilter()
+        self._priorityQueue = queue if queue is not None else PriorityQueue()
+        self._df = df if df is not None else ScalableBloomFilter()
+        # 计算request去重指纹
+        self._fingerprinter = fingerprinter if fingerprinter is not None else RequestFingerprinter()
         self._long_save = long_save
         self._job_dir = job_dir
+        # 等待获取request的协程
+        self._getters = deque()
+        # 等待队列长度降到指定值以下的协程 (size, future)
+        self._space_waiters = deque()
+        # 队列中request数量的上限（0表示不限制），以及超过上限之后的处理方式
+        #   block：put_request(s)挂起产生request的协程，等待队列中空出位置，队列中的request不会超过上限
+        #   drop：丢弃优先级最低的request
+        #   spill：超过上限的request溢出到磁盘（创建队列时处理）
+        if overflow not in ("block", "drop", "spill"):
+            raise ValueError(f'not support frontier overflow: {overflow}')
+        if high_water and overflow == "drop" and not hasattr(self._priorityQueue, "pop_lowest"):
+            raise ValueError(f'{type(self._priorityQueue).__name__} can not drop the lowest priority request')
+        self._high_water = high_water
+        self._overflow = overflow
+        self._dropped_count = 0
+        # 是否已经唤醒所有等待的协程退出
+        self._released = False
+        # 等待队列中的request就绪的定时器
+        self._timer = None
+        # 长期保存时，记录request加入队列和处理完毕的追加写日志
+        self._journal = None
+        self._journal_flush_interval = journal_flush_interval
+        self._journal_compact_threshold = journal_compact_threshold
+        self._journal_sync_interval = journal_sync_interval
+        self._journal_flush_timer = None
+        # 持久化的去重过滤器定时保存的间隔
+        self._df_checkpoint_interval = df_checkpoint_interval
+        self._df_checkpoint_timer = None
+        # 分片运行时，不属于当前分片的request转发给对应的分片
+        self._router = None
+
+    def set_router(self, router: "ShardRouter"):
+        self._router = router
 
     @classmethod
     def from_settings(cls, settings: Settings, spider: "Spider"):
-        initial_capacity = settings.getint("INITIAL_CAPACITY")
-        error_rate = settings.getfloat("ERROR_RATE")
         long_save = settings.getbool("LONG_SAVE")
         job_dir = settings.get("JOB_DIR")
-        obj = cls(spider=spider, df=ScalableBloomFilter(initial_capacity=initial_capacity, error_rate=error_rate),
-                  queue=PriorityQueue(), long_save=long_save, job_dir=job_dir)
+        high_water = settings.getint("FRONTIER_HIGH_WATER")
+        overflow = settings.get("FRONTIER_OVERFLOW", "block")
+        if high_water and overflow == "spill" and settings.get("SCHEDULER_QUEUE", "heap") == "host":
+            logger.info(f'host queue can not spill to disk, use block instead')
+            overflow = "block"
+        queue = cls._create_queue(settings, spider)
+        if high_water and overflow == "drop" and not hasattr(queue, "pop_lowest"):
+            logger.info(f'{type(queue).__name__} can not drop the lowest priority request, use block instead')
+            overflow = "block"
+        obj = cls(spider=spider, df=cls._create_df(settings, spider),
+                  queue=queue, long_save=long_save, job_dir=job_dir,
+                  journal_flush_interval=settings.getfloat("JOURNAL_FLUSH_INTERVAL"),
+                  journal_compact_threshold=settings.getint("JOURNAL_COMPACT_THRESHOLD"),
+                  journal_sync_interval=settings.getfloat("JOURNAL_SYNC_INTERVAL"),
+                  df_checkpoint_interval=settings.getfloat("BLOOM_CHECKPOINT_INTERVAL"),
+                  fingerprinter=RequestFingerprinter(include_headers=settings.getlist("FINGERPRINT_HEADERS"),
+                                                     bits=settings.getint("FINGERPRINT_BITS"),
+                                                     cache_size=settings.getint("FINGERPRINT_CACHE_SIZE")),
+                  high_water=high_water, overflow=overflow)
         return obj
 
+    @staticmethod
+    def _create_df(settings: Settings, spider: "Spider"):
+        initial_capacity = settings.getint("INITIAL_CAPACITY")
+        error_rate = settings.getfloat("ERROR_RATE")
+        job_dir = settings.get("JOB_DIR")
+        persistent = settings.getbool("LONG_SAVE") and job_dir
+        dupefilter = settings.get("DUPEFILTER", "bloom")
+        if dupefilter == "exact":
+            # 精确去重，保存64位指纹的有序数组
+            if persistent:
+                os.makedirs(job_dir, exist_ok=True)
+            return FingerprintSet(path=os.path.join(job_dir, "fingerprints.npy") if persistent else None,
+                                  merge_size=settings.getint("FINGERPRINT_MERGE_SIZE"))
+        elif dupefilter == "cuckoo":
+            # 布谷鸟过滤器，支持删除，设置了过期时间时，url在过期之后可以重新抓取
+            capacity = settings.getint("CUCKOO_CAPACITY")
+            fingerprint_bits = settings.getint("CUCKOO_FINGERPRINT_BITS")
+            ttl = settings.getfloat("DUPEFILTER_TTL")
+            if ttl > 0:
+                return TimeBucketedCuckooFilter(ttl=ttl, capacity=capacity,
+                                                generations=settings.getint("DUPEFILTER_TTL_GENERATIONS"),
+                                                fingerprint_bits=fingerprint_bits)
+            return CuckooFilter(capacity=capacity, fingerprint_bits=fingerprint_bits)
+        hash_scheme = settings.get("BLOOM_HASH_SCHEME", "blake2b")
+        if hash_scheme not in HASH_SCHEMES:
+            raise ValueError(f'not support bloom hash scheme: {hash_scheme}')
+        hash_scheme = HASH_SCHEMES[hash_scheme]
+        if dupefilter == "shared":
+            # 共享内存中的布隆过滤器，同一台机器上的多个进程按名称共享同一个过滤器
+            if persistent:
+                os.makedirs(job_dir, exist_ok=True)
+            return SharedBloomFilter(name=settings.get("SHARED_BLOOM_NAME") or f'sprite-bloom-{spider.name}',
+                                     capacity=settings.getint("SHARED_BLOOM_CAPACITY"), error_rate=error_rate,
+                                     hash_scheme=hash_scheme,
+                                     path=os.path.join(job_dir, "shared_bloomfilter.bin") if persistent else None)
+        elif dupefilter != "bloom":
+            raise ValueError(f'not support dupefilter: {dupefilter}')
+        if persistent:
+            # 长期保存时，过滤器的位数组映射到任务目录下的文件，重启之后可以恢复
+            return PersistentScalableBloomFilter(os.path.join(job_dir, "bloomfilter"),
+                                                 initial_capacity=initial_capacity, error_rate=error_rate,
+                                                 hash_scheme=hash_scheme)
+        return ScalableBloomFilter(initial_capacity=initial_capacity, error_rate=error_rate, hash_scheme=hash_scheme)
+
+    @staticmethod
+    def _create_queue(settings: Settings, spider: "Spider"):
+        # 根据配置选择调度器使用的优先队列
+        queue_type = settings.get("SCHEDULER_QUEUE", "heap")
+        high_water = settings.getint("FRONTIER_HIGH_WATER")
+        spill = high_water > 0 and settings.get("FRONTIER_OVERFLOW", "block") == "spill"
+        if spill and queue_type != "host":
+            # 超过上限的request溢出到磁盘，内存中最多保存上限数量的request
+            queue_type = "disk"
+        if queue_type == "heap":
+            return HeapPriorityQueue()
+        elif queue_type == "priority":
+            return PriorityQueue()
+        elif queue_type == "host":
+            return HostQueue(key=request_host_key, delay=settings.getfloat("HOST_DELAY"),
+                             max_in_flight=settings.getint("HOST_MAX_IN_FLIGHT"))
+        elif queue_type == "disk":
+            frontier_dir = settings.get("FRONTIER_DIR") or settings.get("JOB_DIR") or None
+            if frontier_dir is not None:
+                os.makedirs(frontier_dir, exist_ok=True)
+            return SpillQueue(serialize=lambda request: pickle.dumps(request_to_dict(request)),
+                              deserialize=lambda data: request_from_dict(spider, pickle.loads(data)),
+                              dir_path=frontier_dir,
+                              max_memory_count=high_water if spill else settings.getint("FRONTIER_MEMORY_COUNT"),
+                              max_memory_bytes=settings.getint("FRONTIER_MEMORY_BYTES"),
+                              sizeof=request_size,
+                              refill_size=settings.getint("FRONTIER_REFILL_SIZE"))
+        raise ValueError(f'not support scheduler queue: {queue_type}')
+
     def has_pending_requests(self):
         return len(self._priorityQueue) > 0
 
     # 请求加入队列
     def enqueue_request(self, request: Request) -> bool:
-        request_unique = request.toUniqueStr()
-        if not request.dont_filter and request_unique in self._df:
+        if self._router is not None and not self._router.is_local(request):
+            self._router.forward([request])
+            return True
+        fingerprint = self._fingerprinter(request)
+        # add返回是否已经存在，只计算一次哈希
+        if self._df.add(fingerprint) and not request.dont_filter:
+            return True
+        if not self._make_room(request):
+            return True
+        self._push(request)
+        # 每加入一个request，唤醒一个等待的协程
+        self._wakeup_next()
+        return True
+
+    # 批量加入队列：批量计算指纹、批量去重（同一批中重复的request也会被过滤），返回实际加入队列的数量
+    def enqueue_requests(self, requests: Iterable[Request]) -> int:
+        requests = list(requests)
+        if self._router is not None:
+            requests = self._router.split(requests)
+        if not requests:
+            return 0
+        fingerprints = [self._fingerprinter(request) for request in requests]
+        add_many = getattr(self._df, "add_many", None)
+        if add_many is not None:
+            seen = add_many(fingerprints)
+        else:
+            seen = [self._df.add(fingerprint) for fingerprint in fingerprints]
+        count = 0
+        for request, request_seen in zip(requests, seen):
+            if request_seen and not request.dont_filter:
+                continue
+            if not self._make_room(request):
+                continue
+            self._push(request)
+            count += 1
+        # 加入了多少个request，最多唤醒多少个等待的协程
+        for _ in range(min(count, len(self._getters))):
+            self._wakeup_next()
+        return count
+
+    # 产生request的协程通过这里加入request，block方式下队列满了时挂起等待，每次只加入空出来的位置数量的request，
+    # 一批request也不会让队列超过上限，返回实际加入队列的数量
+    # waiting：开始等待时调用waiting(True)，结束等待时调用waiting(False)
+    async def put_requests(self, requests: Iterable[Request], waiting: Callable[[bool], None] = None) -> int:
+        requests = list(requests)
+        if not self._high_water or self._overflow != "block":
+            return self.enqueue_requests(requests)
+        count = 0
+        while requests:
+            room = self._high_water - len(self._priorityQueue)
+            if self._released:
+                # 正在关闭，不再等待
+                room = len(requests)
+            elif room < min(len(requests), self._high_water):
+                # 等到剩下的request（最多上限数量）都放得下，避免每空出一个位置就唤醒一次
+                if waiting is not None:
+                    waiting(True)
+                try:
+                    await self.wait_below(self._high_water - min(len(requests), self._high_water) + 1)
+                finally:
+                    if waiting is not None:
+                        waiting(False)
+                continue
+            batch, requests = requests[:room], requests[room:]
+            count += self.enqueue_requests(batch)
+        return count
+
+    async def put_request(self, request: Request, waiting: Callable[[bool], None] = None) -> bool:
+        return await self.put_requests([request], waiting) > 0
+
+    # drop方式下队列满了时腾出位置：丢弃优先级比request低的一个request，没有则丢弃request本身，返回request是否可以加入队列
+    def _make_room(self, request: Request) -> bool:
+        if self._overflow != "drop" or not self._high_water or len(self._priorityQueue) < self._high_water:
             return True
-        self._df.add(request_unique)
+        try:
+            dropped, _ = self._priorityQueue.pop_lowest(request.priority)
+        except IndexError:
+            # 队列中没有优先级更低的request，丢弃request本身
+            self._dropped_count += 1
+            return False
+        self._dropped_count += 1
+        # 被丢弃的request视为处理完毕
+        if self._journal is not None:
+            self._journal_done(dropped)
+        return True
+
+    def _push(self, request: Request, seq: int = None):
+        if self._journal is not None:
+            if seq is None:
+                # 使用其他request的meta创建的request，可能带有其他request的序号
+                if request._meta:
+                    request._meta.pop(REQUEST_META_JOURNAL_SEQ, None)
+                try:
+                    seq = self._journal.append(pickle.dumps(request_to_dict(request)))
+                except Exception:
+                    logger.info(f'journal request failed: \n{traceback.format_exc()}')
+                else:
+                    self._schedule_journal_flush()
+            if seq is not None:
+                # 在加入队列之前记录序号，溢出到磁盘的request读回来之后是新的对象，序号跟着meta一起保存
+                request.meta[REQUEST_META_JOURNAL_SEQ] = seq
         self._priorityQueue.push(request, request.priority)
+
+    # request处理完毕（或者被丢弃），在日志中标记，返回是否是日志中的request
+    def _journal_done(self, request: Request) -> bool:
+        seq = request._meta.pop(REQUEST_META_JOURNAL_SEQ, None) if request._meta else None
+        if seq is None:
+            return False
+        self._journal.done(seq)
         return True
 
-    # 取出request
-    def next_request(self) -> Request:
+    def _wakeup_next(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    # 不阻塞的取出request
+    def next_request_nowait(self) -> Request:
         try:
             request, _ = self._priorityQueue.pop()
         except IndexError:
             # 队列为空
             raise SchedulerEmptyException("scheduler is empty")
+        if self._space_waiters:
+            self._wakeup_space_waiters()
         return request
 
+    # 等待队列中的request数量少于size，或者被唤醒退出
+    async def wait_below(self, size: int):
+        while len(self._priorityQueue) >= size and not self._released:
+            waiter = asyncio.get_event_loop().create_future()
+            self._space_waiters.append((size, waiter))
+            try:
+                await waiter
+            except:
+                waiter.cancel()
+                try:
+                    self._space_waiters.remove((size, waiter))
+                except ValueError:
+                    pass
+                raise
+
+    def _wakeup_space_waiters(self):
+        length = len(self._priorityQueue)
+        waiters = self._space_waiters
+        for _ in range(len(waiters)):
+            size, waiter = waiters.popleft()
+            if waiter.done():
+                continue
+            if length < size:
+                waiter.set_result(None)
+            else:
+                waiters.append((size, waiter))
+
+    # 取出request，队列为空时挂起等待，直到加入新的request或者被唤醒退出（返回None）
+    async def next_request(self) -> Optional[Request]:
+        while True:
+            try:
+                request = self.next_request_nowait()
+                # 还有等待的协程，重新设置下一个request就绪的定时器
+                self._arm_timer()
+                return request
+            except SchedulerEmptyException:
+                if self._released:
+                    return None
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            self._arm_timer()
+            try:
+                await getter
+            except:
+                getter.cancel()
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                if self.has_pending_requests() and not getter.cancelled():
+                    # 被唤醒了但是无法处理，唤醒下一个等待的协程
+                    self._wakeup_next()
+                raise
+
+    # request下载完毕，按域名分片的队列释放该域名的并发数，之后执行回调函数（可能挂起等待）时不再占用
+    def download_done(self, request: Request):
+        release = getattr(self._priorityQueue, "release", None)
+        if release is not None:
+            release(request)
+            self._arm_timer()
+
+    # request处理完毕，在日志中标记，没有调用过download_done时（release为True）同时释放该域名的并发数
+    def request_done(self, request: Request, release: bool = True):
+        if release:
+            self.download_done(request)
+        if self._journal is not None and self._journal_done(request):
+            self._schedule_journal_flush()
+
+    # 日志中存在未刷新到文件（或者未fsync、未完成压缩）的记录时，设置定时器在间隔时间之后刷新
+    def _schedule_journal_flush(self):
+        if self._journal_flush_timer is None and self._journal.pending:
+            self._journal_flush_timer = asyncio.get_event_loop().call_later(self._journal_flush_interval,
+                                                                            self._flush_journal)
+
+    def _flush_journal(self):
+        self._journal_flush_timer = None
+        if self._journal is not None:
+            self._journal.flush()
+            self._schedule_journal_flush()
+
+    # 定时保存持久化的去重过滤器
+    def _schedule_df_checkpoint(self):
+        if hasattr(self._df, "checkpoint") and self._df_checkpoint_interval > 0:
+            self._df_checkpoint_timer = asyncio.get_event_loop().call_later(self._df_checkpoint_interval,
+                                                                            self._checkpoint_df)
+
+    def _checkpoint_df(self):
+        self._df_checkpoint_timer = None
+        try:
+            # 先把日志写入磁盘，保证保存的过滤器中的request都已经写入日志
+            if self._journal is not None:
+                self._journal.sync()
+            self._df.checkpoint()
+        except Exception:
+            logger.info(f'checkpoint bloomfilter failed: \n{traceback.format_exc()}')
+        self._schedule_df_checkpoint()
+
+    # 队列中存在未就绪的request时，设置定时器在其就绪时唤醒一个等待的协程
+    def _arm_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._getters:
+            return
+        ready_in = getattr(self._priorityQueue, "ready_in", None)
+        delay = ready_in() if ready_in is not None else None
+        if delay is not None:
+            self._timer = asyncio.get_event_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._wakeup_next()
+
+    # 唤醒所有等待request的协程，之后队列为空时next_request直接返回None
+    def release_waiters(self):
+        self._released = True
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+        while self._space_waiters:
+            _, waiter = self._space_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
     def __len__(self):
         return len(self._priorityQueue)
 
+    def stats(self) -> dict:
+        stats = {"frontier_size": len(self._priorityQueue)}
+        for name in ("memory_size", "disk_size"):
+            if hasattr(self._priorityQueue, name):
+                stats[f'frontier_{name}'] = getattr(self._priorityQueue, name)
+        if self._high_water:
+            stats["frontier_high_water"] = self._high_water
+            stats["frontier_dropped_count"] = self._dropped_count
+        stats["dupefilter_size"] = len(self._df)
+        for name in ("fill_ratio", "false_positive_rate", "memory_size", "rejected_count"):
+            if hasattr(self._df, name):
+                stats[f'dupefilter_{name}'] = getattr(self._df, name)
+        return stats
+
     def close(self):
         try:
-            self._save_requests()
+            self._close_journal()
         except:
             logger.info(
                 f'close scheduler, find one error: \n{traceback.format_exc()}')
+        if self._df_checkpoint_timer is not None:
+            self._df_checkpoint_timer.cancel()
+            self._df_checkpoint_timer = None
+        close_df = getattr(self._df, "close", None)
+        if close_df is not None:
+            try:
+                close_df()
+            except Exception:
+                logger.info(
+                    f'close bloomfilter, find one error: \n{traceback.format_exc()}')
+        close = getattr(self._priorityQueue, "close", None)
+        if close is not None:
+            close()
 
     def start(self):
+        self._released = False
         try:
             self._load_requests()
         except:
             logger.info(
                 f'start scheduler, find one error: \n{traceback.format_exc()}')
+        self._schedule_df_checkpoint()
 
-    def _save_requests(self):
-        if self._long_save and self._job_dir is not None and os.path.exists(
-                self._job_dir) and self.has_pending_requests():
-            logger.info(f'save request')
-            requests = []
-            while True:
-                try:
-                    request = self.next_request()
-                except SchedulerEmptyException:
-                    break
+    def _close_journal(self):
+        if self._journal_flush_timer is not None:
+            self._journal_flush_timer.cancel()
+            self._journal_flush_timer = None
+        if self._journal is not None:
+            logger.info(f'close request journal, {len(self._journal)} requests not finished')
+            self._journal.close()
+            self._journal = None
+
+    def _load_requests(self):
+        if self._long_save and self._job_dir:
+            os.makedirs(self._job_dir, exist_ok=True)
+            # 1.回放日志中未处理完毕的request
+            self._journal = RequestJournal(os.path.join(self._job_dir, "requests.journal"),
+                                           flush_interval=self._journal_flush_interval,
+                                           compact_threshold=self._journal_compact_threshold,
+                                           sync_interval=self._journal_sync_interval)
+            for seq, data in self._journal.open():
                 try:
-                    requests.append(request_to_dict(request))
-                except TypeNotSupport:
+                    request = request_from_dict(self._spider, pickle.loads(data))
+                except Exception:
                     logger.info(
                         f'find one error: \n{traceback.format_exc()}')
-
-            requests_file_path = os.path.join(self._job_dir, "requests.pickle")
-            with open(requests_file_path, "wb") as f:
-                pickle.dump(requests, f)
-
-    def _load_requests(self):
-        if self._long_save and self._job_dir is not None:
+                    self._journal.done(seq)
+                    continue
+                self._df.add(self._fingerprinter(request))
+                self._push(request, seq)
+            # 2.兼容旧版本关闭时保存的requests缓存
             requests_file_path = os.path.join(self._job_dir, "requests.pickle")
             if os.path.exists(requests_file_path):
                 logger.info(f'load request')
@@ -0,0 +1,308 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+import time
+import zlib
+import asyncio
+import threading
+import traceback
+import multiprocessing
+from queue import Empty
+from typing import List
+from sprite.settings import Settings
+from sprite.spider import Spider
+from sprite.middlewaremanager import MiddlewareManager
+from sprite.utils.http.request import Request
+from sprite.utils.request import request_host_key, request_to_dict, request_from_dict
+from sprite.utils.coroutinePool import coroutine_pool
+from sprite.utils.log import get_logger
+from sprite.const import *
+
+logger = get_logger()
+
+"""
+多进程分片爬取
+    1.父进程fork出N个分片进程，每个分片进程有自己的协程池（事件循环）、Engine、调度器、下载器
+    2.request按 (scheme, host, port) 的哈希分配到分片，同一个域名的request只在一个分片中去重、限速、复用连接
+      不属于当前分片的request序列化之后（回调函数按名称对应爬虫的方法）通过对应分片的收件队列转发过去
+    3.只有0号分片执行start_requests
+    4.结束判断：所有分片共享一个锁保护的计数
+        已经转发还没有被接收的request数量，以及每个分片是否空闲（调度器为空且没有正在处理的request）
+        所有分片都空闲并且没有正在转发的request时，所有分片的工作协程退出
+    5.分片进程定时把统计信息发送给父进程，父进程汇总之后通过Crawler.get_crawler_stats（RPC）查询
+"""
+
+# 取最大值的统计项
+_MAX_KEYS = {"elapsed_time"}
+# 取平均值的统计项
+_MEAN_KEYS = {"latency", "error_rate", "dupefilter_fill_ratio", "dupefilter_false_positive_rate"}
+
+
+def shard_index(request: Request, shards: int) -> int:
+    scheme, host, port = request_host_key(request)
+    return zlib.crc32(f'{scheme}://{host}:{port}'.encode("utf-8")) % shards
+
+
+# 汇总所有分片的统计信息：数值求和（耗时取最大值，比例取平均值）
+def merge_shard_stats(shard_stats: List[dict]) -> dict:
+    stats = {}
+    counts = {}
+    for one in shard_stats:
+        for key, value in one.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if key in _MAX_KEYS:
+                stats[key] = max(stats.get(key, value), value)
+            else:
+                stats[key] = stats.get(key, 0) + value
+                counts[key] = counts.get(key, 0) + 1
+    for key in _MEAN_KEYS:
+        if key in stats:
+            stats[key] /= counts[key]
+    return stats
+
+
+class ShardRouter:
+    def __init__(self, index: int, shards: int, spider: Spider, inboxes: list, lock, outstanding, idle,
+                 stop_event, stats_queue, poll_interval: float = 0.01, stats_interval: float = 1):
+        self.index = index
+        self.shards = shards
+        self._spider = spider
+        # 每个分片的收件队列
+        self._inboxes = inboxes
+        # 保护 outstanding 和 idle 的进程锁
+        self._lock = lock
+        # 已经转发还没有被接收的request数量
+        self._outstanding = outstanding
+        # 每个分片是否空闲
+        self._idle = idle
+        self._stop_event = stop_event
+        self._stats_queue = stats_queue
+        self._poll_interval = poll_interval
+        self._stats_interval = stats_interval
+        self._forwarded_count = 0
+        self._received_count = 0
+
+    def is_local(self, request: Request) -> bool:
+        return shard_index(request, self.shards) == self.index
+
+    # 把不属于当前分片的request转发出去，返回属于当前分片的request
+    def split(self, requests: List[Request]) -> List[Request]:
+        local = []
+        remote = []
+        for request in requests:
+            if self.is_local(request):
+                local.append(request)
+            else:
+                remote.append(request)
+        if remote:
+            self.forward(remote)
+        return local
+
+    def forward(self, requests: List[Request]):
+        batches = {}
+        for request in requests:
+            batches.setdefault(shard_index(request, self.shards), []).append(request_to_dict(request))
+        with self._lock:
+            self._outstanding.value += len(requests)
+        for index, batch in batches.items():
+            self._inboxes[index].put(batch)
+        self._forwarded_count += len(requests)
+
+    def set_idle(self):
+        with self._lock:
+            self._idle[self.index] = 1
+
+    def all_idle(self) -> bool:
+        with self._lock:
+            return self._outstanding.value == 0 and all(self._idle)
+
+    # 取出收件队列中所有的request，取出之前先标记当前分片不空闲
+    def _receive(self) -> List[Request]:
+        requests = []
+        inbox = self._inboxes[self.index]
+        while True:
+            try:
+                batch = inbox.get_nowait()
+            except Empty:
+                break
+            with self._lock:
+                self._idle[self.index] = 0
+                self._outstanding.value -= len(batch)
+            requests.extend(request_from_dict(self._spider, d) for d in batch)
+        self._received_count += len(requests)
+        return requests
+
+    # 在分片的事件循环中运行：接收转发过来的request，判断所有分片是否都处理完毕，定时发送统计信息
+    async def run(self, engine: "Engine"):
+        last_stats_time = 0
+        while not engine.is_stopped():
+            if self._stop_event.is_set() and engine.is_running():
+                engine.close()
+            requests = self._receive()
+            if requests:
+                engine.enqueue_forwarded(requests)
+            elif engine.is_local_idle() and self.all_idle():
+                # 所有分片都处理完毕，唤醒工作协程退出
+                engine.release_workers()
+            if time.time() - last_stats_time >= self._stats_interval:
+                last_stats_time = time.time()
+                self.report(engine)
+            await asyncio.sleep(self._poll_interval)
+
+    def report(self, engine: "Engine", final: bool = False):
+        stats = engine.get_crawl_stats()
+        stats["shard_forwarded_count"] = self._forwarded_count
+        stats["shard_received_count"] = self._received_count
+        self._stats_queue.put((self.index, stats, final))
+
+
+def _shard_settings(settings: Settings, index: int) -> Settings:
+    settings = settings.copy()
+    settings.frozen = False
+    # 每个分片使用各自的目录保存队列、日志和过滤器
+    for name in ("JOB_DIR", "FRONTIER_DIR"):
+        path = settings.get(name)
+        if path:
+            settings.set(name, os.path.join(path, f'shard-{index}'))
+    settings.freeze()
+    return settings
+
+
+def _run_shard(index: int, spider: Spider, middlewareManager: MiddlewareManager, settings: Settings, kwargs: dict):
+    from sprite.core.engine import Engine
+    pool = coroutine_pool
+    # fork出来的进程中没有运行事件循环的线程，重新初始化协程池
+    pool.reset_after_fork()
+    pool.start()
+    engine = None
+    router = None
+    try:
+        engine = Engine.from_settings(settings=_shard_settings(settings, index), spider=spider,
+                                      middlewareManager=middlewareManager, coroutine_pool=pool)
+        router = ShardRouter(index=index, spider=spider, **kwargs)
+        engine.set_router(router)
+        engine.start()
+        while not (engine.is_stopped() and engine._state_signal.is_set()):
+            time.sleep(THREAD_SLEEP_TIME * 10)
+    except Exception:
+        logger.error(f'shard {index} find one error: \n{traceback.format_exc()}')
+    finally:
+        if router is not None and engine is not None:
+            router.report(engine, final=True)
+        # 等待统计信息发送完毕，engine已经关闭，协程池的事件循环线程不是守护线程，分片进程直接退出
+        kwargs["stats_queue"].close()
+        kwargs["stats_queue"].join_thread()
+        os._exit(0)
+
+
+# 在父进程中管理所有的分片进程，接口与Engine一致，由Crawler使用
+class ShardManager:
+    def __init__(self, spider: Spider, middlewareManager: MiddlewareManager, settings: Settings, shards: int):
+        self._spider = spider
+        self._middlewareManager = middlewareManager
+        self._settings = settings
+        self._shards = shards
+        self._processes = []
+        self._stop_event = None
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._collector = None
+        self._state = ENGINE_STATE_STOPPED
+        self._state_lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._state_lock:
+            return self._state
+
+    def start(self) -> bool:
+        if self.state != ENGINE_STATE_STOPPED:
+            return False
+        # 分片进程需要继承爬虫实例、中间件和回调函数，只能使用fork
+        ctx = multiprocessing.get_context("fork")
+        self._stop_event = ctx.Event()
+        stats_queue = ctx.Queue()
+        kwargs = {
+            "shards": self._shards,
+            "inboxes": [ctx.Queue() for _ in range(self._shards)],
+            "lock": ctx.Lock(),
+            "outstanding": ctx.Value("q", 0, lock=False),
+            # 只有0号分片有start_requests，其他分片一开始就是空闲的
+            "idle": ctx.Array("b", [0] + [1] * (self._shards - 1), lock=False),
+            "stop_event": self._stop_event,
+            "stats_queue": stats_queue,
+            "poll_interval": self._settings.getfloat("SHARD_POLL_INTERVAL"),
+            "stats_interval": self._settings.getfloat("SHARD_STATS_INTERVAL"),
+        }
+        with self._state_lock:
+            self._state = ENGINE_STATE_RUNNING
+        with self._stats_lock:
+            self._stats = {}
+        self._processes = []
+        for index in range(self._shards):
+            process = ctx.Process(target=_run_shard, name=f'sprite-shard-{index}',
+                                  args=(index, self._spider, self._middlewareManager, self._settings, kwargs))
+            process.start()
+            self._processes.append(process)
+        self._collector = threading.Thread(target=self._collect_stats, args=(stats_queue,), daemon=True)
+        self._collector.start()
+        logger.info(f'启动{self._shards}个分片进程')
+        return True
+
+    # 接收分片进程发送的统计信息，所有分片进程退出之后结束
+    def _collect_stats(self, stats_queue):
+        while True:
+            try:
+                index, stats, _ = stats_queue.get(timeout=0.1)
+                with self._stats_lock:
+                    self._stats[index] = stats
+                continue
+            except Empty:
+                pass
+            if not any(process.is_alive() for process in self._processes):
+                break
+        # 进程退出之前发送的统计信息
+        while True:
+            try:
+                index, stats, _ = stats_queue.get(timeout=0.1)
+            except Empty:
+                break
+            with self._stats_lock:
+                self._stats[index] = stats
+        for process in self._processes:
+            process.join()
+        with self._state_lock:
+            self._state = ENGINE_STATE_STOPPED
+        logger.info(f'所有分片进程已经退出')
+
+    def close(self) -> bool:
+        if self.state != ENGINE_STATE_RUNNING:
+            return False
+        with self._state_lock:
+            self._state = ENGINE_STATE_STOPPING
+        self._stop_event.set()
+        return True
+
+    def is_running(self) -> bool:
+        return self.state == ENGINE_STATE_RUNNING
+
+    def is_stopped(self) -> bool:
+        return self.state == ENGINE_STATE_STOPPED
+
+    def is_to_close(self) -> bool:
+        return self.is_running()
+
+    def join(self):
+        if self._collector is not None:
+            self._collector.join()
+
+    # 汇总的统计信息，shard_stats中是每个分片的统计信息
+    def get_crawl_stats(self) -> dict:
+        with self._stats_lock:
+            shard_stats = [self._stats[index] for index in sorted(self._stats)]
+        stats = merge_shard_stats(shard_stats)
+        stats["shards"] = self._shards
+        stats["shard_stats"] = shard_stats
+        return stats
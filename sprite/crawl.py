@@ -18,6 +18,7 @@ from sprite.exceptions import UniqueCrawlerNameException
 from sprite.middlewaremanager import MiddlewareManager
 from sprite.spider import Spider
 from sprite.core.engine import Engine
+from sprite.core.shard import ShardManager
 from sprite.const import *
 
 logger = get_logger()
@@ -41,6 +42,12 @@ class Crawler:
         assert isinstance(self._coroutine_pool, PyCoroutinePool), "coroutine_pool must PyCoroutinePool instance"
         self._settings.freeze()
         set_logger(self._settings)
+        shards = self._settings.getint("CRAWLER_SHARDS")
+        if shards > 1:
+            # 分片运行，由分片管理器fork出多个进程，每个进程运行一个engine
+            self._engine = ShardManager(spider=self._spider, middlewareManager=self._middlewareManager,
+                                        settings=self._settings, shards=shards)
+            return
         self._engine = Engine.from_settings(
             settings=self._settings, spider=self._spider,
             middlewareManager=self._middlewareManager,
@@ -77,6 +84,11 @@ class Crawler:
     def get_crawler_state(self):
         return transformation_state_to_str(self._engine.state)
 
+    def get_crawler_stats(self) -> dict:
+        if not self._engine:
+            return {}
+        return self._engine.get_crawl_stats()
+
     def set_coroutine_pool(self, coroutine_pool: 'PyCoroutinePool'):
         self._coroutine_pool = coroutine_pool
 
@@ -233,6 +245,7 @@ class CrawlerRunner(metaclass=SingletonMetaClass):
         self._rpc_server.register_function(self._get_all_crawler_name, "get_all_crawler_name")
         self._rpc_server.register_function(self._get_running_crawler_name, "get_running_crawler_name")
         self._rpc_server.register_function(self._get_crawler_state, "get_crawler_state")
+        self._rpc_server.register_function(self._get_crawler_stats, "get_crawler_stats")
         self._rpc_server.register_function(self._get_coroutine_pool_state, "get_coroutine_pool_state")
         self._rpc_server.register_function(self._stop_server, "stop_server")
         self._rpc_server.register_function(self._reload_crawler, "reload_crawler")
@@ -338,6 +351,14 @@ class CrawlerRunner(metaclass=SingletonMetaClass):
             result = Result("failed", data="not fund this crawler")
         return result.serialize()
 
+    def _get_crawler_stats(self, crawler_name: str) -> str:
+        crawler = self.__crawlers__.get(crawler_name, None)
+        if crawler:
+            result = Result("ok", data=crawler.get_crawler_stats())
+        else:
+            result = Result("failed", data="not fund this crawler")
+        return result.serialize()
+
     def _get_running_crawler_name(self) -> str:
         running_crawler = []
         for crawler in self.__crawlers__.values():
@@ -376,7 +397,9 @@ class CrawlerRunner(metaclass=SingletonMetaClass):
         self.__coroutine_pool__.reset(
             max_coroutine_amount=self._settings.getint("MAX_COROUTINE_AMOUNT"),
             max_coroutineIdle_time=self._settings.getint("MAX_COROUTINE_IDLE_TIME"),
-            most_stop=self._settings.getbool("MOST_STOP")
+            most_stop=self._settings.getbool("MOST_STOP"),
+            max_control_coroutine_amount=self._settings.getint("MAX_CONTROL_COROUTINE_AMOUNT"),
+            force_stop_timeout=self._settings.getfloat("FORCE_STOP_TIMEOUT")
         )
 
     @classmethod
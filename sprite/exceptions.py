@@ -31,3 +31,6 @@ class SchedulerEmptyException(Exception): pass
 
 
 class UniqueCrawlerNameException(Exception): pass
+
+
+class FrontierException(Exception): pass
@@ -17,6 +17,71 @@ WORKER_NUM = 3
 # engine是否在完成工作后自动退出
 ENGINE_MOST_STOP = True
 
+# 回调函数产生的request缓存到该数量之后批量去重、批量加入调度器（回调结束时也会加入）
+ENQUEUE_BATCH_SIZE = 100
+# 调度器中的request少于该数量时才继续从start_requests中拉取，start_requests按需拉取，不会一次全部加载到内存
+START_REQUESTS_LOW_WATER = 1000
+
+# 是否开启自适应并发（AIMD），开启之后以WORKER_NUM为初始并发数，根据吞吐量、耗时和失败率在运行中调整工作协程和下载的并发数
+CONCURRENCY_ADAPTIVE = False
+# 自适应并发的最小并发数
+CONCURRENCY_MIN = 1
+# 自适应并发的最大并发数
+CONCURRENCY_MAX = 64
+# 吞吐量没有下降且耗时没有明显增加时，每个统计周期增加的并发数
+CONCURRENCY_INCREASE = 1
+# 出现超时、限流状态码或者失败率过高时，并发数乘以该系数
+CONCURRENCY_DECREASE = 0.5
+# 统计周期（秒）
+CONCURRENCY_ADJUST_INTERVAL = 5
+# 一个统计周期内的失败率超过该值时减小并发数
+CONCURRENCY_ERROR_THRESHOLD = 0.1
+# 正在下载的请求超过该耗时（秒）还没有返回时当作被限流，为0时使用CONCURRENCY_ADJUST_INTERVAL
+CONCURRENCY_LATENCY_TARGET = 0
+# 被当作服务端限流的响应状态码
+CONCURRENCY_THROTTLE_STATUS = [429, 503]
+
+# 引擎模式
+#   inline：每个工作协程下载之后直接执行回调函数和管道
+#   staged：下载协程把response放入有界的解析队列，解析协程从队列中取出response执行回调函数和管道，两个阶段的并发数分别设置
+ENGINE_MODE = "inline"
+# staged模式下载协程的数量，为0时使用WORKER_NUM（开启自适应并发时使用CONCURRENCY_MAX，由目标并发数控制）
+DOWNLOAD_WORKER_NUM = 0
+# staged模式解析协程的数量
+PARSE_WORKER_NUM = 3
+# staged模式解析队列的长度上限，队列满了之后下载协程挂起等待
+PARSE_QUEUE_SIZE = 100
+
+# CPU密集型的回调函数（@cpu_bound装饰、Spider.cpu_bound = True 或者 request.meta["cpu_bound"]）的执行器，不阻塞事件循环
+#   process：进程池，response以及回调产生的Request、Item序列化之后在进程之间传递，回调函数对爬虫实例的修改不会同步回主进程
+#   thread：线程池，不需要序列化，适合解析时会释放GIL的库
+CPU_BOUND_EXECUTOR = "process"
+# 执行器的进程（线程）数量，为0时使用cpu核数
+CPU_BOUND_WORKERS = 0
+
+# 分片进程的数量，大于1时Crawler fork出多个进程，request按域名的哈希分配到各个分片，每个分片有独立的engine和事件循环
+CRAWLER_SHARDS = 1
+# 分片进程检查收件队列（其他分片转发过来的request）的间隔（秒）
+SHARD_POLL_INTERVAL = 0.01
+# 分片进程向父进程发送统计信息的间隔（秒）
+SHARD_STATS_INTERVAL = 1
+
+# frontier服务的地址（host:port），设置之后引擎使用RemoteScheduler，多个节点共享同一个frontier服务中的队列和去重过滤器
+FRONTIER_SERVER = ""
+# frontier服务监听的地址和端口（启动frontier服务时使用）
+FRONTIER_SERVER_HOST = "127.0.0.1"
+FRONTIER_SERVER_PORT = 8090
+# 租出的request超过该时间（秒）没有ack则重新投递
+FRONTIER_LEASE_TIMEOUT = 60
+# 每次从frontier服务租用的request数量
+FRONTIER_LEASE_SIZE = 20
+# frontier服务为空时，租用请求最多等待的时间（秒）
+FRONTIER_LEASE_WAIT = 1
+# 批量发送新的request和ack的间隔（秒）
+FRONTIER_FLUSH_INTERVAL = 0.05
+# frontier服务中没有排队和租出的request持续该时间（秒）之后，认为整个爬取结束
+FRONTIER_IDLE_TIMEOUT = 5
+
 # 记录日志的文件的path，如果为空则，不保存日志。直接输出
 LOG_FILE_PATH = ""
 
@@ -54,20 +119,80 @@ DELAY = 1
 LIMITS = None
 
 # schedule
+# 调度器使用的优先队列，heap：基于堆的优先队列，priority：基于字典排序的优先队列，
+# host：按照域名分片的队列（此时DELAY不再生效，由HOST_DELAY控制每一个域名的请求间隔），
+# disk：内存 + 磁盘的混合队列，内存中的request超过限制之后溢出到磁盘
+SCHEDULER_QUEUE = "heap"
+# 同一域名两次请求之间的间隔时间（SCHEDULER_QUEUE为host时生效）
+HOST_DELAY = 1
+# 同一域名同时处理中的最大请求数量，0表示不限制（SCHEDULER_QUEUE为host时生效）
+HOST_MAX_IN_FLIGHT = 1
+# 内存中最多保存的request数量，0表示不限制（SCHEDULER_QUEUE为disk时生效）
+FRONTIER_MEMORY_COUNT = 100000
+# 内存中的request最多占用的字节数（估算值），0表示不限制（SCHEDULER_QUEUE为disk时生效）
+FRONTIER_MEMORY_BYTES = 0
+# 每次从磁盘补充到内存的request数量（SCHEDULER_QUEUE为disk时生效）
+FRONTIER_REFILL_SIZE = 1000
+# 溢出到磁盘的request保存的目录，为空则使用JOB_DIR，JOB_DIR也为空则使用系统临时目录
+FRONTIER_DIR = ""
+# 调度器中request数量的上限，0表示不限制
+FRONTIER_HIGH_WATER = 0
+# 超过上限之后的处理方式，block：挂起产生request的回调函数，直到调度器中空出位置，调度器中的request不会超过上限
+# （所有的工作协程都被挂起时临时启动工作协程消耗request，每个页面都产生大量新request时挂起的回调函数会越来越多，此时应使用drop或者spill）
+# drop：丢弃优先级最低（priority最大）的request（SCHEDULER_QUEUE为disk时不支持，使用block），spill：超过上限的request溢出到磁盘（SCHEDULER_QUEUE为host时不支持，使用block）
+FRONTIER_OVERFLOW = "block"
 # 布隆过滤器的容量
 INITIAL_CAPACITY = 100000
 # 布隆过滤器的错误率
 ERROR_RATE = 0.001
-# 队列中的请求是否长期保存
+# 队列中的请求是否长期保存，长期保存时request加入队列和处理完毕都会追加写入JOB_DIR下的日志中，重启之后回放
 LONG_SAVE = False
 # 队列中的请求若长期保存的话，需指定保存的目录
 JOB_DIR = ""
+# 日志两次刷新到文件之间的最大间隔（秒），进程崩溃时最多丢失这段时间内的记录
+JOURNAL_FLUSH_INTERVAL = 0.05
+# 日志两次调用fsync写入磁盘之间的最大间隔（秒），机器断电时最多丢失这段时间内的记录
+JOURNAL_SYNC_INTERVAL = 1
+# 日志中处理完毕的记录数量超过该值（且多于未处理完毕的数量）时在后台线程中压缩日志
+JOURNAL_COMPACT_THRESHOLD = 100000
+# 长期保存时，布隆过滤器保存到JOB_DIR下的间隔（秒），位数组通过mmap映射到文件，每次只写回修改过的页
+BLOOM_CHECKPOINT_INTERVAL = 60
+# 布隆过滤器的哈希方式，blake2b：只依赖标准库，xxhash、mmh3：速度更快，需要安装对应的包
+# 长期保存（或者共享内存）的过滤器记录了创建时的哈希方式，其他机器读取时也需要安装对应的包
+BLOOM_HASH_SCHEME = "blake2b"
+# request去重指纹的位数，64或者128
+FINGERPRINT_BITS = 64
+# 参与计算request去重指纹的请求头，为空则不包含请求头
+FINGERPRINT_HEADERS = []
+# 缓存最近计算过的request指纹的数量，0表示不缓存
+FINGERPRINT_CACHE_SIZE = 10000
+# 去重方式，bloom：布隆过滤器（存在误判），exact：64位指纹的有序数组精确去重（需要安装numpy，128位的指纹只保留低64位）
+DUPEFILTER = "bloom"
+# 精确去重时，插入缓冲区中的指纹数量超过该值之后合并到有序数组
+FINGERPRINT_MERGE_SIZE = 65536
+# 布谷鸟过滤器去重（DUPEFILTER = "cuckoo"）时的容量，超过容量之后新的request当作已经抓取过被过滤（设置了过期时间时最旧的一代提前过期）
+CUCKOO_CAPACITY = 1000000
+# 布谷鸟过滤器的指纹位数，8、16或者32，位数越多误判率越低
+CUCKOO_FINGERPRINT_BITS = 16
+# 布谷鸟过滤器去重时url的过期时间（秒），过期之后可以重新抓取，0表示永不过期
+DUPEFILTER_TTL = 0
+# 过期时间分成多少代，每一代是一个独立的布谷鸟过滤器，整代过期
+DUPEFILTER_TTL_GENERATIONS = 4
+# 共享内存布隆过滤器去重（DUPEFILTER = "shared"）时共享内存的名称，为空则使用 sprite-bloom-爬虫名称
+# 共享内存在进程退出之后仍然保留（之后启动的进程继续使用），需要清空时调用 SharedBloomFilter.unlink
+SHARED_BLOOM_NAME = ""
+# 共享内存布隆过滤器的容量，创建之后不能扩容
+SHARED_BLOOM_CAPACITY = 10000000
 
 # PyCoroutinePool
 # 协程池中最大运行的协程数量
 MAX_COROUTINE_AMOUNT = 256 * 1024
 # 协程的空闲时间
 MAX_COROUTINE_IDLE_TIME = 10
+# control通道（引擎的启动、关闭、状态检测等控制任务）预留的协程数量，不占用MAX_COROUTINE_AMOUNT
+MAX_CONTROL_COROUTINE_AMOUNT = 64
+# 强制关闭协程池（以及软关闭超时之后）取消所有任务的截止时间
+FORCE_STOP_TIMEOUT = 5
 # 每一个协程运行完毕之后是否立即退出，
 MOST_STOP = True
 
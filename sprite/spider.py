@@ -9,6 +9,8 @@ class Spider:
     name: str = "sprite"
     start_requests: list = None
     metadata: dict = {}
+    # 为True时所有的回调函数都在进程池（线程池）中执行
+    cpu_bound: bool = False
 
     def __init__(self):
         self.logger = get_logger()
@@ -2,14 +2,17 @@
 __author__ = 'liyong'
 __date__ = '2019/7/3 19:28'
 
-from typing import Coroutine, Callable, Union
+from typing import Coroutine, Callable, Union, Iterable, List, Optional
 import time
 import asyncio
 import threading
+import weakref
+from collections import deque
 from asyncio import AbstractEventLoop
 from threading import Thread, Event
 from asyncio import Queue
-from asyncio.locks import Lock
+from concurrent.futures import Future, InvalidStateError
+from concurrent.futures._base import PENDING, RUNNING, CANCELLED, CANCELLED_AND_NOTIFIED, FINISHED
 import traceback
 from sprite.const import COROUTINE_SLEEP_TIME, THREAD_SLEEP_TIME
 from sprite.settings import Settings
@@ -21,15 +24,54 @@ logger = get_logger()
 
 """
 协程池
+    所有协程共享一个任务队列（run queue），空闲的协程阻塞在队列上等待任务
+    1.提交任务：任务放入共享队列，由某一个空闲的协程取走执行，O(1)，不需要选择协程，也不需要加锁
+      排队的任务多于空闲的协程、且协程数量没有达到上限时，创建新的协程
+    2.达到协程数量上限之后，任务在共享队列中排队，先空闲下来的协程先取走，不会出现任务排在忙碌的协程后面而其他协程空闲的情况
+    3.回收：每个回收周期内一直空闲的协程数量（空闲协程数减去排队任务数的最小值），周期结束时放入同样数量的停止信号
+    4.跨线程提交：其他线程提交的任务先放入线程安全的待提交队列，只有队列从空变成非空时才唤醒一次事件循环，
+      事件循环一次取出所有待提交的任务，一批任务只有一次call_soon_threadsafe（一次self-pipe写入）
+      事件循环线程中提交的任务直接放入共享队列
+    5.任务句柄：go()返回TaskHandle（concurrent.futures.Future的子类），共享队列中放的就是句柄，不再为每个任务额外创建future和task
+        其他线程中：result()、exception()、add_done_callback()、concurrent.futures.wait()
+        事件循环中：await handle，等待的协程被取消时任务也会被取消
+        cancel()：和Future.cancel()一样，只能取消还没有开始执行的任务（排队中的任务直接丢弃），正在执行的任务返回False
+        interrupt()：请求取消正在执行的任务，取消执行它的协程，在任务的await处抛出CancelledError，
+            只是一个请求，任务吞掉CancelledError时句柄仍然得到任务的结果，以cancelled()为准
+        任务中抛出的CancelledError只结束这个任务，只有协程本身被取消（协程池关闭）时协程才退出，
+            python3.11之前没有Task.cancelling()，分辨不出CancelledError的来源，按照协程池是否正在取消协程判断
+        timeout：从提交开始计时的截止时间，超时还没有开始执行的任务直接丢弃，正在执行的任务被取消，句柄的异常为TimeoutError
+    6.通道：control和bulk两个通道，各自有独立的任务队列、协程和协程数量上限
+        control：引擎的启动、关闭、状态检测等控制任务，协程数量上限单独预留，不会排在大量的爬取任务后面
+        bulk：爬取任务（默认）
+        其他线程提交时，control通道的任务先放入各自的队列
+    7.关闭：协程池记录自己创建的每一个协程，以及协程正在执行的任务属于哪个任务组
+        每个协程就是它所执行任务的取消范围，取消协程就取消了任务，任务中的finally和async with会正常执行
+        stop()：停止信号排在已经提交的任务之后，等待协程执行完队列中的任务后退出，超时之后按照force_stop的顺序取消
+        force_stop()：丢弃排队中的任务，按照任务组的顺序取消正在执行的任务：引擎的工作协程、下载任务、后台任务，
+            每一组取消之后执行该组注册的关闭回调（例如关闭下载器的所有连接），最后取消事件循环中剩下的所有task
+            每一步的等待都有截止时间，任务吞掉了CancelledError也不会卡住关闭流程
+        截止时间之后仍然没有结束的task属于上一次运行，重新start之后仍然留在事件循环中，
+            之后的关闭流程只再取消一次，不再等待它们，不会让每一次关闭都等满截止时间
 """
 
 # 默认最大协程数量
 Defaultmax_coroutine_amount = 256 * 1024
 # 默认每一个协程的空闲时间
 Defaultmax_coroutineIdle_time = 10
+# 默认control通道最大协程数量
+Defaultmax_control_coroutine_amount = 64
+# 默认强制关闭的截止时间
+Defaultforce_stop_timeout = 5
+
+# 关闭时按照这个顺序取消任务组
+COROUTINE_GROUPS = (COROUTINE_GROUP_WORKER, COROUTINE_GROUP_DOWNLOAD, COROUTINE_GROUP_HOUSEKEEPING)
 
 StopSignal = -1
 
+# 保护所有任务句柄状态的锁，concurrent.futures.wait会同时获取多个句柄的Condition，需要可重入
+_handleLock = threading.RLock()
+
 
 class NotTooMangStartCorroutineException(Exception):
     pass
@@ -47,24 +89,164 @@ class NotReSetCoriutinePoolException(Exception):
     pass
 
 
-class TaskQueue:
-    def __init__(self):
-        self._lastUseTime = time.time()
-        # 协程的队列
-        self._queue = Queue()
+class TaskHandle(Future):
+    """
+    go()返回的任务句柄，可以在其他线程中当作concurrent.futures.Future使用，也可以在事件循环中await
+    """
+
+    # 开始执行之后才会用到的属性
+    _worker = None
+    _timer = None
+    _cancel_requested = False
+    _timed_out = False
+    # 为了取消任务而取消执行它的协程的次数
+    _worker_cancels = 0
+
+    def __init__(self, pool: "PyCoroutinePool", task: Coroutine, deadline: Optional[float] = None,
+                 lane: "TaskQueue" = None, group: int = COROUTINE_GROUP_WORKER):
+        # 不调用Future.__init__，只有其他线程等待结果时才创建Condition
+        self._state = PENDING
+        self._result = None
+        self._exception = None
+        self._waiters = []
+        self._done_callbacks = []
+        self._pool = pool
+        self._task = task
+        # 截止时间（事件循环的时间）
+        self._deadline = deadline
+        # 所属的通道，为None时使用bulk通道
+        self._lane = lane
+        # 所属的任务组，决定关闭时的取消顺序
+        self._group = group
+
+    # 所有句柄的Condition共用一把锁，状态的修改都在这把锁内进行
+    @property
+    def _condition(self) -> threading.Condition:
+        condition = self.__dict__.get("_cond")
+        if condition is None:
+            condition = self.__dict__.setdefault("_cond", threading.Condition(_handleLock))
+        return condition
+
+    # 唤醒等待的线程，需要持有 _handleLock
+    def _notify(self):
+        condition = self.__dict__.get("_cond")
+        if condition is not None:
+            condition.notify_all()
+
+    def set_running_or_notify_cancel(self) -> bool:
+        with _handleLock:
+            if self._state == CANCELLED:
+                self._state = CANCELLED_AND_NOTIFIED
+                for waiter in self._waiters:
+                    waiter.add_cancelled(self)
+                return False
+            elif self._state == PENDING:
+                self._state = RUNNING
+                return True
+        raise RuntimeError(f'Future in unexpected state: {self._state}')
+
+    def set_result(self, result):
+        with _handleLock:
+            if self._state in (CANCELLED, CANCELLED_AND_NOTIFIED, FINISHED):
+                raise InvalidStateError(f'{self._state}: {self!r}')
+            self._result = result
+            self._state = FINISHED
+            for waiter in self._waiters:
+                waiter.add_result(self)
+            self._notify()
+        self._invoke_callbacks()
+
+    def set_exception(self, exception: BaseException):
+        with _handleLock:
+            if self._state in (CANCELLED, CANCELLED_AND_NOTIFIED, FINISHED):
+                raise InvalidStateError(f'{self._state}: {self!r}')
+            self._exception = exception
+            self._state = FINISHED
+            for waiter in self._waiters:
+                waiter.add_exception(self)
+            self._notify()
+        self._invoke_callbacks()
+
+    def interrupt(self) -> bool:
+        """
+        请求取消正在执行的任务，还没有开始执行的任务等同于cancel()
+        返回True只表示发出了取消请求，任务是否被取消以cancelled()为准
+        """
+        if self.cancel():
+            return True
+        if self.done():
+            return False
+        # 正在执行，在事件循环中取消执行它的协程
+        self._pool._callInLoop(self._cancelRunning)
+        return True
+
+    def _cancelRunning(self):
+        if self._worker is not None and not self._cancel_requested:
+            self._cancel_requested = True
+            self._cancelWorker()
+
+    def _expire(self):
+        self._timer = None
+        if self._worker is not None:
+            self._timed_out = True
+            self._cancelWorker()
+
+    # 取消执行任务的协程，只是为了取消这个任务，任务结束之后协程继续工作
+    def _cancelWorker(self):
+        self._worker_cancels += 1
+        self._worker.cancel()
+
+    # 开始执行之后被取消
+    def _setCancelled(self):
+        with _handleLock:
+            if self._state == CANCELLED_AND_NOTIFIED:
+                return
+            self._state = CANCELLED_AND_NOTIFIED
+            for waiter in self._waiters:
+                waiter.add_cancelled(self)
+            self._notify()
+        self._invoke_callbacks()
+
+    def __await__(self):
+        try:
+            return (yield from asyncio.wrap_future(self).__await__())
+        except asyncio.CancelledError:
+            # 等待的协程被取消，正在执行的任务也取消（排队中的任务wrap_future已经调用了cancel）
+            self.interrupt()
+            raise
 
-    async def addTask(self, task: Coroutine):
-        await self._queue.put(task)
 
-    async def getTask(self) -> Coroutine:
-        return await self._queue.get()
+class TaskQueue:
+    """
+    一个通道：通道内所有协程共享的任务队列，以及该通道的协程数量
+    """
 
-    def updateTime(self):
-        self._lastUseTime = time.time()
+    def __init__(self, name: str):
+        self.name = name
+        # 通道内所有协程共享的任务队列
+        self._queue = Queue()
+        # 通道内所有的协程，以及协程正在执行的任务句柄（空闲时为None）
+        self.workers = {}
+        # 其他线程提交、还没有放入队列的任务
+        self.pending = deque()
+        self.coroutineCount = 0
+        # 阻塞在任务队列上的协程数量
+        self.idleCount = 0
+        # 当前回收周期内空闲协程数减去排队任务数的最小值，即整个周期都空闲的协程数量
+        self.minIdleCount = 0
+
+    def addTask(self, task: Union[TaskHandle, int]):
+        self._queue.put_nowait(task)
+
+    async def getTask(self) -> Union[TaskHandle, int]:
+        return await self._queue.get()
 
-    @property
-    def lastUseTime(self) -> float:
-        return self._lastUseTime
+    # 取出所有排队的任务
+    def takeAll(self) -> List[Union[TaskHandle, int]]:
+        tasks = []
+        while not self._queue.empty():
+            tasks.append(self._queue.get_nowait())
+        return tasks
 
     def __len__(self):
         return self._queue.qsize()
@@ -73,19 +255,38 @@ class TaskQueue:
 class PyCoroutinePool(metaclass=SingletonMetaClass):
     def __init__(self, max_coroutine_amount: int = Defaultmax_coroutine_amount,
                  max_coroutineIdle_time: int = Defaultmax_coroutineIdle_time,
-                 most_stop: bool = False, loop: AbstractEventLoop = None):
+                 most_stop: bool = False, loop: AbstractEventLoop = None,
+                 max_control_coroutine_amount: int = Defaultmax_control_coroutine_amount,
+                 force_stop_timeout: float = Defaultforce_stop_timeout):
         self._max_coroutine_amount = max_coroutine_amount
         self._max_coroutineIdle_time = max_coroutineIdle_time
+        # control通道预留的协程数量，不占用max_coroutine_amount
+        self._max_control_coroutine_amount = max_control_coroutine_amount
+        self._force_stop_timeout = force_stop_timeout
         self._most_stop = most_stop
-        self._lock = Lock()
-        self._ready = []
+        # bulk通道和control通道
+        self._run_queue = None
+        self._control_queue = None
         self._loop = loop or asyncio.get_event_loop()
 
         self._state_signal = None
         self._state = COROUTINE_POOL_STATE_STOPPED
         self._state_lock = threading.Lock()
 
-        self._coroutineCount = 0
+        # 是否已经唤醒事件循环取出待提交的任务
+        self._drainScheduled = False
+        self._pendingLock = threading.Lock()
+        # 运行事件循环的线程
+        self._loopThreadId = None
+        # 正在执行的关闭流程
+        self._shutdownTask = None
+        self._daemonTask = None
+        # 关闭流程是否已经开始取消协程
+        self._cancellingWorkers = False
+        # 之前的关闭流程中超过截止时间仍然没有结束的task
+        self._abandonedTasks = weakref.WeakSet()
+        # 每个任务组取消之后执行的关闭回调
+        self._closeCallbacks = {group: [] for group in COROUTINE_GROUPS}
 
     def reset(self, **kwargs):
         if self.is_running() or self._is_stopping():
@@ -95,9 +296,31 @@ class PyCoroutinePool(metaclass=SingletonMetaClass):
         self._max_coroutineIdle_time = kwargs.get("max_coroutineIdle_time") if kwargs.get("max_coroutineIdle_time",
                                                                                           None) else Defaultmax_coroutineIdle_time
         self._most_stop = kwargs.get("most_stop") if kwargs.get("most_stop", None) else False
+        self._max_control_coroutine_amount = kwargs.get("max_control_coroutine_amount") if kwargs.get(
+            "max_control_coroutine_amount", None) else Defaultmax_control_coroutine_amount
+        self._force_stop_timeout = kwargs.get("force_stop_timeout") if kwargs.get(
+            "force_stop_timeout", None) else Defaultforce_stop_timeout
 
         self._loop = kwargs.get("loop") if kwargs.get("loop", None) else asyncio.get_event_loop()
 
+    # fork出来的子进程中没有运行事件循环的子线程，锁的状态也可能不一致，重新初始化之后才能start
+    def reset_after_fork(self):
+        self._state_lock = threading.Lock()
+        self._state = COROUTINE_POOL_STATE_STOPPED
+        self._state_signal = None
+        self._run_queue = None
+        self._control_queue = None
+        self._drainScheduled = False
+        self._pendingLock = threading.Lock()
+        self._loopThreadId = None
+        self._shutdownTask = None
+        self._daemonTask = None
+        self._cancellingWorkers = False
+        self._abandonedTasks = weakref.WeakSet()
+        self._closeCallbacks = {group: [] for group in COROUTINE_GROUPS}
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+
     @property
     def state(self):
         with self._state_lock:
@@ -131,58 +354,146 @@ class PyCoroutinePool(metaclass=SingletonMetaClass):
     def is_stopped(self, waiting: bool = False) -> bool:
         return self._is_stopped(waiting)
 
-    # 强制停止协程池,暂时不可用
-    def force_stop(self):
-        # if self._stopEvent is None:
-        #     raise NotStartCoroutineException("协程池还未开启")
-        # if self._stopEvent.is_set():
-        #     logger.error("已经启动stop流程了，不用再发起了！！")
-        #     return
-        # self._stopEvent.set()
-        # asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self._loop)
-        # self._stopEventLoopSignal.wait()
-        # self._loop.close()
-        pass
-
-    # 软关闭协程池
-    def stop(self):
+    # 强制停止协程池：按照任务组的顺序取消所有任务，最多等待timeout秒，返回协程池是否已经停止
+    def force_stop(self, timeout: Optional[float] = None) -> bool:
+        with self._state_lock:
+            if self._state == COROUTINE_POOL_STATE_STOPPED:
+                raise NotStartCoroutineException("协程池不在运行状态")
+            self._state = COROUTINE_POOL_STATE_STOPPING
+        timeout = self._force_stop_timeout if timeout is None else timeout
+        self._callInLoop(lambda: self._startShutdown(timeout, graceful=False))
+        if threading.get_ident() == self._loopThreadId:
+            # 在事件循环中调用时不能阻塞等待
+            return False
+        # 事件循环被同步代码阻塞时，关闭流程也无法执行，最多多等待一个截止时间
+        self._state_signal.wait(timeout * 2)
+        return self._is_stopped()
+
+    # 软关闭协程池：等待已经提交的任务执行完毕，timeout秒之后还没有执行完的任务按照force_stop的顺序取消
+    def stop(self, timeout: Optional[float] = None):
         if not self.is_running():
             raise NotStartCoroutineException("协程池不在运行状态")
         with self._state_lock:
             self._state = COROUTINE_POOL_STATE_STOPPING
-        asyncio.run_coroutine_threadsafe(self._stop(), self._loop)
-        asyncio.run_coroutine_threadsafe(self._stop_on_wait(), self._loop)
-
-    async def _stop(self):
-        async with self._lock:
+        timeout = self._force_stop_timeout if timeout is None else timeout
+        self._callInLoop(lambda: self._startShutdown(timeout, graceful=True))
+
+    # 在事件循环中启动关闭流程，强制关闭可以打断正在等待的软关闭
+    def _startShutdown(self, timeout: float, graceful: bool):
+        if self._shutdownTask is not None and not self._shutdownTask.done():
+            if graceful:
+                return
+            self._shutdownTask.cancel()
+        self._shutdownTask = self._loop.create_task(self._shutdown(self._loop.time() + timeout, graceful))
+
+    def _remaining(self, deadline: float) -> float:
+        return max(deadline - self._loop.time(), 0)
+
+    def _workers(self) -> List[asyncio.Task]:
+        return [worker for queue in (self._control_queue, self._run_queue) for worker in queue.workers]
+
+    async def _shutdown(self, deadline: float, graceful: bool):
+        # 其他线程在关闭之前提交的任务
+        self._drain()
+        if graceful:
             # 对于已经完成任务的协程，进行退出
             self._most_stop = True
-            for taskQueue in self._ready:
-                # 没有完成的协程，提前发出通知，完成后，需要退出
-                await taskQueue.addTask(StopSignal)
-
-    async def _stop_on_wait(self):
-        await self._cancel_tasks()
+            # 停止信号排在已经提交的任务之后，每个协程取到一个停止信号之后退出
+            for queue in (self._control_queue, self._run_queue):
+                for _ in range(queue.coroutineCount):
+                    queue.addTask(StopSignal)
+            workers = self._workers()
+            if workers:
+                await asyncio.wait(workers, timeout=self._remaining(deadline))
+            # 超时之后剩下的任务强制取消
+            deadline = self._loop.time() + self._force_stop_timeout
+        self._most_stop = True
+        self._discardQueued()
+        await self._cancel_groups(deadline)
+        await self._cancel_tasks(deadline)
+        self._abandon()
         self._loop.stop()
         logger.info(f'协程池关闭')
         with self._state_lock:
             self._state = COROUTINE_POOL_STATE_STOPPED
             self._state_signal.set()
 
-    # 取消任务
-    async def _cancel_tasks(self):
-        tasks = []
-        # 获取所有在事情循环中的协程
-        for task in asyncio.Task.all_tasks():
-            if not task.current_task() and not task.cancelled():
-                # 取消协程
-                tasks.append(task.cancel())
-        await asyncio.gather(*tasks, return_exceptions=True)
+    # 丢弃所有还没有开始执行的任务
+    def _discardQueued(self):
+        for queue in (self._control_queue, self._run_queue):
+            handles = list(queue.pending) + queue.takeAll()
+            queue.pending.clear()
+            for handle in handles:
+                if handle is StopSignal:
+                    continue
+                task, handle._task = handle._task, None
+                task.close()
+                if handle.cancel():
+                    handle.set_running_or_notify_cancel()
+
+    # 按照任务组的顺序取消正在执行的任务，每一组取消之后执行该组的关闭回调
+    async def _cancel_groups(self, deadline: float):
+        self._cancellingWorkers = True
+        for group in COROUTINE_GROUPS:
+            workers = [worker for queue in (self._control_queue, self._run_queue)
+                       for worker, handle in queue.workers.items()
+                       if handle is not None and handle._group == group]
+            for worker in workers:
+                worker.cancel()
+            if workers:
+                await asyncio.wait(workers, timeout=self._remaining(deadline))
+            callbacks, self._closeCallbacks[group] = self._closeCallbacks[group], []
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.error(f'find one error: \n{traceback.format_exc()}')
+        # 空闲的协程
+        workers = self._workers()
+        for worker in workers:
+            worker.cancel()
+        if workers:
+            await asyncio.wait(workers, timeout=self._remaining(deadline))
+
+    # 取消事件循环中剩下的所有task（守护协程，以及不是由协程池创建的task）
+    async def _cancel_tasks(self, deadline: float):
+        current = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks(self._loop) if task is not current]
+        for task in tasks:
+            task.cancel()
+        # 之前的关闭流程已经放弃的task只取消，不等待
+        tasks = [task for task in tasks if task not in self._abandonedTasks]
+        if tasks:
+            await asyncio.wait(tasks, timeout=self._remaining(deadline))
+
+    # 放弃截止时间之后仍然没有结束的task，它们会留在事件循环中
+    def _abandon(self):
+        current = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks(self._loop)
+                 if task is not current and task not in self._abandonedTasks]
+        if tasks:
+            logger.error(f'{len(tasks)} tasks are still running after force stop timeout, abandon them: {tasks}')
+            self._abandonedTasks.update(tasks)
+
+    # 注册关闭回调，在事件循环中执行：协程池关闭时该任务组的任务取消之后调用
+    def add_close_callback(self, callback: Callable, group: int = COROUTINE_GROUP_HOUSEKEEPING):
+        self._closeCallbacks[group].append(callback)
+
+    def remove_close_callback(self, callback: Callable, group: int = COROUTINE_GROUP_HOUSEKEEPING):
+        try:
+            self._closeCallbacks[group].remove(callback)
+        except ValueError:
+            pass
 
     # 开始运行协程池，进行一些初始化工作
     def start(self, loop: AbstractEventLoop = None):
         if self.is_running() or self._is_stopping():
             raise NotTooMangStartCorroutineException("协程池已经开启或者还未关闭")
+        # 先创建通道，状态变成运行之后其他线程就可以提交任务
+        self._run_queue = TaskQueue(COROUTINE_LANE_BULK)
+        self._control_queue = TaskQueue(COROUTINE_LANE_CONTROL)
+        self._shutdownTask = None
+        self._cancellingWorkers = False
         with self._state_lock:
             self._state = COROUTINE_POOL_STATE_RUNNING
             self._state_signal = Event()
@@ -195,115 +506,236 @@ class PyCoroutinePool(metaclass=SingletonMetaClass):
         run_loop_thread = Thread(target=self._start_subthread_loop, args=(self._loop,))  # 在子线程运行事件循环
         # 开启子线程的协程时间循环
         run_loop_thread.start()
-        asyncio.run_coroutine_threadsafe(self._daemon(), self._loop)
+        self._loop.call_soon_threadsafe(self._startDaemon)
+
+    def _startDaemon(self):
+        self._daemonTask = self._loop.create_task(self._daemon())
 
     def _start_subthread_loop(self, loop):
+        self._loopThreadId = threading.get_ident()
         asyncio.set_event_loop(loop)
         # 阻塞着一直运行事件循环，直到被调用stop    loop.stop()
         loop.run_forever()
 
-    async def _clean(self):
-        current_time = time.time()
-        async with self._lock:
-            for task_queue in self._ready:
-                if self._is_clear(task_queue, current_time):
-                    # 释放协程
-                    await task_queue.addTask(StopSignal)
-
-    def _is_clear(self, task_queue: TaskQueue, current_time: float = None) -> bool:
-        if current_time is None:
-            current_time = time.time()
-        if len(task_queue) == 0:
-            if current_time - task_queue.lastUseTime > self._max_coroutineIdle_time:
-                return True
-        return False
+    # 释放整个回收周期内一直空闲的协程
+    def _clean(self, queue: TaskQueue):
+        idle = min(queue.minIdleCount, queue.idleCount - len(queue))
+        for _ in range(max(idle, 0)):
+            queue.addTask(StopSignal)
+        queue.minIdleCount = queue.idleCount
 
     async def _daemon(self):
         # 协程进行守护工作
+        lanes = (self._control_queue, self._run_queue)
+        for queue in lanes:
+            queue.minIdleCount = queue.idleCount
         while self.is_running():
-            await self._clean()
             await asyncio.sleep(self._max_coroutineIdle_time)
-
-    # 添加任务执行
-    def go(self, task: Coroutine) -> bool:
+            for queue in lanes:
+                self._clean(queue)
+
+    def _getLane(self, lane: str) -> TaskQueue:
+        if lane == COROUTINE_LANE_BULK:
+            return self._run_queue
+        elif lane == COROUTINE_LANE_CONTROL:
+            return self._control_queue
+        raise ValueError(f'unknown coroutine lane: {lane}')
+
+    @staticmethod
+    def _defaultGroup(lane: str) -> int:
+        if lane == COROUTINE_LANE_CONTROL:
+            return COROUTINE_GROUP_HOUSEKEEPING
+        return COROUTINE_GROUP_WORKER
+
+    # 添加任务执行，返回任务句柄，协程池不在运行状态时返回None
+    # group默认由通道决定：bulk通道是工作协程，control通道是后台任务
+    def go(self, task: Coroutine, timeout: Optional[float] = None,
+           lane: str = COROUTINE_LANE_BULK, group: Optional[int] = None) -> Optional[TaskHandle]:
         assert isinstance(task, Coroutine), "只能添加python协程实例"
         if not self.is_running():
             logger.error("协程池不在运行状态，无法提交任务！！")
-            return False
-        try:
-            asyncio.run_coroutine_threadsafe(self._goCoroutine(task), self._loop)
-            return True
-        except NotManyCoroutineException as e:
-            logger.error(e)
-            return False
-
-    async def _goCoroutine(self, task: Coroutine):
-        taskQueue = await self._getIdleCoroutine()
-        if taskQueue is None:
-            raise NotManyCoroutineException("没有正在运行的协程")
-        await taskQueue.addTask(task)
-
-    # 获取空闲协程，不存在就新创建一个
-    async def _getIdleCoroutine(self) -> TaskQueue:
+            task.close()
+            return None
+        queue = self._getLane(lane)
+        group = self._defaultGroup(lane) if group is None else group
+        handle = TaskHandle(self, task, None if timeout is None else self._loop.time() + timeout, queue, group)
+        if threading.get_ident() == self._loopThreadId:
+            # 在事件循环线程中直接提交
+            self._submit(handle)
+        else:
+            queue.pending.append(handle)
+            self._scheduleDrain()
+        return handle
+
+    # 批量添加任务，其他线程提交时整批只唤醒一次事件循环，返回任务句柄的列表
+    def go_many(self, tasks: Iterable[Coroutine], timeout: Optional[float] = None,
+                lane: str = COROUTINE_LANE_BULK, group: Optional[int] = None) -> List[TaskHandle]:
+        tasks = list(tasks)
+        for task in tasks:
+            assert isinstance(task, Coroutine), "只能添加python协程实例"
+        if not self.is_running():
+            logger.error("协程池不在运行状态，无法提交任务！！")
+            for task in tasks:
+                task.close()
+            return []
+        queue = self._getLane(lane)
+        group = self._defaultGroup(lane) if group is None else group
+        deadline = None if timeout is None else self._loop.time() + timeout
+        handles = [TaskHandle(self, task, deadline, queue, group) for task in tasks]
+        if threading.get_ident() == self._loopThreadId:
+            for handle in handles:
+                self._submit(handle)
+        elif handles:
+            queue.pending.extend(handles)
+            self._scheduleDrain()
+        return handles
+
+    # 在事件循环线程中执行
+    def _callInLoop(self, callback: Callable):
+        if threading.get_ident() == self._loopThreadId:
+            callback()
+        else:
+            self._loop.call_soon_threadsafe(callback)
+
+    def _scheduleDrain(self):
+        with self._pendingLock:
+            if self._drainScheduled:
+                # 事件循环已经被唤醒，还没有取出的任务会一起取出
+                return
+            self._drainScheduled = True
+        self._loop.call_soon_threadsafe(self._drain)
+
+    # 在事件循环中取出所有待提交的任务
+    def _drain(self):
+        # 先清除标记再取，取的过程中新提交的任务要么这次被取出，要么再唤醒一次
+        with self._pendingLock:
+            self._drainScheduled = False
+        # 先取control通道的任务
+        for queue in (self._control_queue, self._run_queue):
+            pending = queue.pending
+            while pending:
+                self._submit(pending.popleft())
+
+    # 在事件循环中提交任务
+    def _submit(self, task: TaskHandle):
         """
-        协程未达到最大值之前，不断创建新的协程
-        达到最大值之后，就取最可能空闲的协程来执行
-        :return:
+        任务放入共享队列，空闲的协程不够执行排队的任务、且协程数量没有达到上限时，创建新的协程
+        达到上限之后，任务排队等待先空闲下来的协程
         """
-        taskQueue = None
-        createCoroutine = False
-        async with self._lock:
-            if self._coroutineCount < self._max_coroutine_amount:
-                createCoroutine = True
-                taskQueue = TaskQueue()
-                self._ready.append(taskQueue)
-            else:
-                # 按照队列长度从小到大排序
-                self._ready = sorted(self._ready, key=lambda x: len(x))
-                taskQueue = self._ready[0]
-            if createCoroutine:
-                # 新创建协程
-                asyncio.run_coroutine_threadsafe(self._executeTask(taskQueue), self._loop)
-                self._coroutineCount += 1
-        return taskQueue
-
-    async def _executeTask(self, taskQueue: TaskQueue):
-        while True:
-            # 阻塞等待任务
-            task = await taskQueue.getTask()
-            if task == StopSignal:
-                # 接收到停止信号
-                break
-            # 执行任务
-            try:
-                await task
-            except:
-                logger.error(f'find one error: {traceback.format_exc()}')
-            # 更新任务完成时间
-            taskQueue.updateTime()
-            # 每一个协程完成任务后，是否需要停止这个协程
-            if len(taskQueue) == 0 and await self._isRelease():
-                # 停掉目前的协程
-                break
-        async with self._lock:
-            # 去除无效任务队列
-            self._ready.remove(taskQueue)
-            self._coroutineCount -= 1
-
-    async def _isRelease(self) -> bool:
-        async with self._lock:
-            if self._most_stop:
-                return True
-            return False
+        queue = task._lane if task._lane is not None else self._run_queue
+        queue.addTask(task)
+        idle = queue.idleCount - len(queue)
+        if queue is self._control_queue:
+            limit = self._max_control_coroutine_amount
+        else:
+            limit = self._max_coroutine_amount
+        if idle < 0 and queue.coroutineCount < limit:
+            # 新创建协程
+            worker = self._loop.create_task(self._executeTask(queue))
+            queue.workers[worker] = None
+            queue.coroutineCount += 1
+            idle += 1
+        if idle < queue.minIdleCount:
+            queue.minIdleCount = idle
+
+    async def _executeTask(self, queue: TaskQueue):
+        worker = asyncio.current_task()
+        try:
+            while True:
+                # 阻塞等待任务
+                queue.idleCount += 1
+                try:
+                    handle = await queue.getTask()
+                finally:
+                    queue.idleCount -= 1
+                if handle is StopSignal:
+                    # 接收到停止信号
+                    break
+                task, handle._task = handle._task, None
+                if not handle.set_running_or_notify_cancel():
+                    # 开始执行之前已经被取消
+                    task.close()
+                    continue
+                if handle._deadline is not None:
+                    if self._loop.time() >= handle._deadline:
+                        # 排队的时候已经超时
+                        task.close()
+                        handle.set_exception(TimeoutError("task timeout before start"))
+                        continue
+                    handle._timer = self._loop.call_at(handle._deadline, handle._expire)
+                handle._worker = worker
+                queue.workers[worker] = handle
+                # 直接在当前协程中执行任务，不为每个任务创建task
+                try:
+                    result = await task
+                except asyncio.CancelledError:
+                    if handle._timed_out:
+                        handle.set_exception(TimeoutError("task timeout"))
+                    else:
+                        handle._setCancelled()
+                    if self._workerCancelled(worker, handle):
+                        # 执行任务的协程本身被取消（协程池关闭）
+                        raise
+                except GeneratorExit:
+                    # 被放弃的协程随着事件循环一起被回收，不能继续执行
+                    raise
+                except BaseException as e:
+                    logger.error(f'find one error: {traceback.format_exc()}')
+                    handle.set_exception(e)
+                else:
+                    handle.set_result(result)
+                finally:
+                    handle._worker = None
+                    queue.workers[worker] = None
+                    if handle._timer is not None:
+                        handle._timer.cancel()
+                        handle._timer = None
+                    # 取消的只是任务，执行任务的协程继续工作
+                    uncancel = getattr(worker, "uncancel", None)
+                    if uncancel is not None:
+                        for _ in range(min(handle._worker_cancels, worker.cancelling())):
+                            uncancel()
+                # 每一个协程完成任务后，是否需要停止这个协程
+                if len(queue) == 0 and self._most_stop:
+                    # 停掉目前的协程
+                    break
+        finally:
+            queue.coroutineCount -= 1
+            queue.workers.pop(worker, None)
+
+    # 任务结束于CancelledError时，执行任务的协程本身是否也被取消了
+    def _workerCancelled(self, worker: asyncio.Task, handle: TaskHandle) -> bool:
+        cancelling = getattr(worker, "cancelling", None)
+        if cancelling is not None:
+            # 除了为取消任务发出的取消请求之外，协程还收到了其他的取消请求
+            return cancelling() > handle._worker_cancels
+        # python3.11之前：只有协程池关闭时才会取消协程，其他的CancelledError都来自任务本身
+        return self._cancellingWorkers
+
+    def stats(self) -> dict:
+        stats = {}
+        for prefix, queue in (("", self._run_queue), ("control_", self._control_queue)):
+            if queue is None:
+                continue
+            stats.update({
+                f'{prefix}coroutine_count': queue.coroutineCount,
+                f'{prefix}idle_coroutine_count': queue.idleCount,
+                f'{prefix}queued_task_count': len(queue),
+            })
+        return stats
 
     @classmethod
     def from_setting(cls, settings: Settings):
         max_coroutine_amount = settings.getint("max_coroutine_amount")
         max_coroutineIdle_time = settings.getint("max_coroutineIdle_time")
         most_stop = settings.getbool("most_stop")
+        max_control_coroutine_amount = settings.getint("MAX_CONTROL_COROUTINE_AMOUNT")
+        force_stop_timeout = settings.getfloat("FORCE_STOP_TIMEOUT")
         obj = cls(max_coroutine_amount=max_coroutine_amount,
                   max_coroutineIdle_time=max_coroutineIdle_time,
-                  most_stop=most_stop)
+                  most_stop=most_stop,
+                  max_control_coroutine_amount=max_control_coroutine_amount,
+                  force_stop_timeout=force_stop_timeout)
         return obj
 
     @property
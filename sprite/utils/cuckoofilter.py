@@ -0,0 +1,262 @@
+# -*- coding:utf-8 -*-
+
+
+import time
+import random
+from array import array
+from collections import deque
+from sprite.utils.pybloomfilter import hash_pair
+from sprite.utils.log import get_logger
+
+logger = get_logger()
+
+"""
+布谷鸟过滤器
+    1.每个key计算出一个指纹（非0）和两个候选桶：i1 = h1 % 桶数，i2 = i1 ^ hash(指纹)，两个桶可以互相推导
+    2.加入时放入两个候选桶中任意一个空位，都没有空位时随机踢出一个指纹，把它放到它的另一个候选桶，最多踢max_kicks次
+    3.查询时检查两个候选桶中是否存在该指纹
+    4.删除时从候选桶中删除一个该指纹
+    5.过滤器满了之后（有无处存放的指纹）不再接受新的key，新的key当作已经存在，只在第一次时记录日志
+    与布隆过滤器相比支持删除，误判率只与指纹的位数和装载率有关
+
+按时间分代的布谷鸟过滤器
+    把ttl时间分成多个时间段，每个时间段一个布谷鸟过滤器（一代），加入的key放入当前这一代
+    结束时间超过ttl的一代整个丢弃，其中的key可以重新加入（即url在ttl到ttl+一个时间段之后可以重新抓取）
+    最多同时存在 generations+1 代，内存占用是固定的
+"""
+
+_TYPE_CODES = {8: 'B', 16: 'H', 32: 'L'}
+MASK64 = (1 << 64) - 1
+
+
+class CuckooFilter:
+    def __init__(self, capacity: int, bucket_size: int = 4, fingerprint_bits: int = 16, max_kicks: int = 500):
+        if fingerprint_bits not in _TYPE_CODES:
+            raise ValueError(f'fingerprint bits must be one of {sorted(_TYPE_CODES)}, got {fingerprint_bits}')
+        if not capacity > 0:
+            raise ValueError("Capacity must be > 0")
+        self.capacity = capacity
+        self.bucket_size = bucket_size
+        self.fingerprint_bits = fingerprint_bits
+        self.max_kicks = max_kicks
+        # 桶的数量取2的幂，保证 i1 ^ hash(指纹) 仍然是合法的桶
+        num_buckets = 1
+        while num_buckets * bucket_size * 0.95 < capacity:
+            num_buckets <<= 1
+        self.num_buckets = num_buckets
+        self._slots = array(_TYPE_CODES[fingerprint_bits], bytes(num_buckets * bucket_size *
+                                                               array(_TYPE_CODES[fingerprint_bits]).itemsize))
+        self._fingerprint_mask = (1 << fingerprint_bits) - 1
+        # 踢出失败时无处存放的指纹
+        self._victim = None
+        self.count = 0
+        # 过滤器满了之后被拒绝（当作已经存在）的key的数量
+        self.rejected_count = 0
+
+    def _hash(self, key):
+        h1, h2 = hash_pair(key)
+        fingerprint = (h2 & self._fingerprint_mask) or 1
+        return fingerprint, h1 & (self.num_buckets - 1)
+
+    def _alt_index(self, index: int, fingerprint: int) -> int:
+        return (index ^ ((fingerprint * 0x5bd1e995) & MASK64)) & (self.num_buckets - 1)
+
+    def _find(self, index: int, fingerprint: int) -> int:
+        start = index * self.bucket_size
+        slots = self._slots
+        for slot in range(start, start + self.bucket_size):
+            if slots[slot] == fingerprint:
+                return slot
+        return -1
+
+    def _insert_into(self, index: int, fingerprint: int) -> bool:
+        slot = self._find(index, 0)
+        if slot < 0:
+            return False
+        self._slots[slot] = fingerprint
+        return True
+
+    def __contains__(self, key) -> bool:
+        fingerprint, i1 = self._hash(key)
+        i2 = self._alt_index(i1, fingerprint)
+        if self._find(i1, fingerprint) >= 0 or self._find(i2, fingerprint) >= 0:
+            return True
+        return self._victim is not None and self._victim[0] == fingerprint and self._victim[1] in (i1, i2)
+
+    @property
+    def is_full(self) -> bool:
+        return self._victim is not None
+
+    def add(self, key) -> bool:
+        """
+        加入一个key，返回加入之前是否已经存在，过滤器已满时新的key无法加入，当作已经存在返回True
+        """
+        if key in self:
+            return True
+        if self._victim is not None:
+            if not self.rejected_count:
+                logger.warning(f'cuckoo filter is full with {self.count} keys (capacity {self.capacity}), '
+                               f'new keys are treated as seen')
+            self.rejected_count += 1
+            return True
+        fingerprint, i1 = self._hash(key)
+        i2 = self._alt_index(i1, fingerprint)
+        if self._insert_into(i1, fingerprint) or self._insert_into(i2, fingerprint):
+            self.count += 1
+            return False
+        # 两个候选桶都满了，随机踢出一个指纹
+        index = random.choice((i1, i2))
+        for _ in range(self.max_kicks):
+            slot = index * self.bucket_size + random.randrange(self.bucket_size)
+            fingerprint, self._slots[slot] = self._slots[slot], fingerprint
+            index = self._alt_index(index, fingerprint)
+            if self._insert_into(index, fingerprint):
+                self.count += 1
+                return False
+        # 最后被踢出的指纹保存下来，之后不再接受新的key
+        self._victim = (fingerprint, index)
+        self.count += 1
+        return False
+
+    def remove(self, key) -> bool:
+        """
+        删除一个key，返回是否删除成功，只能删除确定加入过的key，否则可能删除其他key的指纹
+        """
+        fingerprint, i1 = self._hash(key)
+        i2 = self._alt_index(i1, fingerprint)
+        for index in (i1, i2):
+            slot = self._find(index, fingerprint)
+            if slot >= 0:
+                self._slots[slot] = 0
+                self.count -= 1
+                if self._victim is not None:
+                    # 空出了位置，把踢出的指纹重新放回去
+                    victim, self._victim = self._victim, None
+                    self.count -= 1
+                    self._reinsert(*victim)
+                return True
+        if self._victim is not None and self._victim[0] == fingerprint and self._victim[1] in (i1, i2):
+            self._victim = None
+            self.count -= 1
+            return True
+        return False
+
+    def _reinsert(self, fingerprint: int, index: int):
+        for _ in range(self.max_kicks):
+            if self._insert_into(index, fingerprint):
+                self.count += 1
+                return
+            slot = index * self.bucket_size + random.randrange(self.bucket_size)
+            fingerprint, self._slots[slot] = self._slots[slot], fingerprint
+            index = self._alt_index(index, fingerprint)
+        self._victim = (fingerprint, index)
+        self.count += 1
+
+    @property
+    def size(self) -> int:
+        # 指纹槽位的总数
+        return self.num_buckets * self.bucket_size
+
+    @property
+    def fill_ratio(self) -> float:
+        return self.count / self.size
+
+    @property
+    def false_positive_rate(self) -> float:
+        # 查询时比较两个桶中的已用槽位，每次比较误判的概率为 1/2^f
+        compared = 2 * self.bucket_size * self.fill_ratio
+        return 1.0 - (1.0 - 2.0 ** -self.fingerprint_bits) ** compared
+
+    @property
+    def memory_size(self) -> int:
+        return self._slots.itemsize * len(self._slots)
+
+    def __len__(self):
+        return self.count
+
+
+class TimeBucketedCuckooFilter:
+    def __init__(self, ttl: float, capacity: int, generations: int = 4, bucket_size: int = 4,
+                 fingerprint_bits: int = 16, max_kicks: int = 500):
+        # key加入之后经过ttl秒过期，可以重新加入
+        self.ttl = ttl
+        self._generations = max(generations, 1)
+        # 每一代覆盖的时间
+        self._span = ttl / self._generations
+        # 每一代的容量，所有代的总容量为capacity
+        self._generation_capacity = max(capacity // self._generations, 1)
+        self._bucket_size = bucket_size
+        self._fingerprint_bits = fingerprint_bits
+        self._max_kicks = max_kicks
+        # (开始时间, 过滤器)，最新的一代在最后
+        self._filters = deque()
+        self._rotate(time.monotonic())
+
+    def _new_filter(self) -> CuckooFilter:
+        return CuckooFilter(self._generation_capacity, bucket_size=self._bucket_size,
+                            fingerprint_bits=self._fingerprint_bits, max_kicks=self._max_kicks)
+
+    def _rotate(self, now: float):
+        self._filters.append((now, self._new_filter()))
+        # 当前这一代提前写满时，最旧的一代会提前过期
+        while len(self._filters) > self._generations + 1:
+            self._filters.popleft()
+
+    def _expire(self):
+        now = time.monotonic()
+        # 丢弃结束时间在ttl之前的代，当前这一代超过时间段之后开始新的一代
+        while self._filters and now - self._filters[0][0] >= self.ttl + self._span:
+            self._filters.popleft()
+        if not self._filters or now - self._filters[-1][0] >= self._span:
+            self._rotate(now)
+
+    def __contains__(self, key) -> bool:
+        self._expire()
+        for _, f in reversed(self._filters):
+            if key in f:
+                return True
+        return False
+
+    def add(self, key) -> bool:
+        if key in self:
+            return True
+        current = self._filters[-1][1]
+        if current.is_full:
+            # 当前这一代已满，提前开始新的一代，最旧的一代会提前过期
+            logger.info(f'cuckoo filter generation is full, expire the oldest generation early')
+            self._rotate(time.monotonic())
+            current = self._filters[-1][1]
+        return current.add(key)
+
+    def remove(self, key) -> bool:
+        for _, f in reversed(self._filters):
+            if key in f:
+                return f.remove(key)
+        return False
+
+    @property
+    def count(self) -> int:
+        return len(self)
+
+    @property
+    def rejected_count(self) -> int:
+        return sum(f.rejected_count for _, f in self._filters)
+
+    @property
+    def fill_ratio(self) -> float:
+        return len(self) / sum(f.size for _, f in self._filters)
+
+    @property
+    def false_positive_rate(self) -> float:
+        # 查询时依次检查每一代，任意一代误判即误判
+        rate = 1.0
+        for _, f in self._filters:
+            rate *= 1.0 - f.false_positive_rate
+        return 1.0 - rate
+
+    @property
+    def memory_size(self) -> int:
+        return sum(f.memory_size for _, f in self._filters)
+
+    def __len__(self):
+        return sum(f.count for _, f in self._filters)
@@ -0,0 +1,158 @@
+# -*- coding:utf-8 -*-
+
+
+import os
+from typing import Iterable, List
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+精确去重的64位指纹集合
+    1.新加入的指纹先放入一个小的插入缓冲区（set）
+    2.缓冲区的数量达到merge_size之后，排序成一个有序的uint64数组（run），加入run的列表
+    3.run的列表从大到小排列，最后一个run的长度达到前一个的一半时，两者拼接之后归并（np.concatenate + 稳定排序，线性时间），
+      和二进制计数器的进位一样，run的数量是O(log n)，每个指纹平均被复制O(log n)次，不会每次合并都复制整个数组
+    4.查询时先查缓冲区，再在每一个run中二分查找
+    指定path时，checkpoint（以及close）把所有的run合并成一个，保存为.npy文件并通过mmap映射，写入新的文件之后替换旧的文件，
+    加入指纹时只在内存中合并，不会重写文件，checkpoint时没有新的指纹则不写文件
+"""
+
+MASK64 = (1 << 64) - 1
+
+
+class FingerprintSet:
+    def __init__(self, path: str = None, merge_size: int = 65536):
+        if np is None:
+            raise ImportError("FingerprintSet requires numpy")
+        # 有序数组保存的文件，为空则只保存在内存中
+        self._path = path
+        self._merge_size = max(merge_size, 1)
+        self._buffer = set()
+        # 有序数组的列表，从大到小，每一个都大于后一个的两倍
+        self._runs = []
+        # 上一次保存之后是否加入了新的指纹
+        self._dirty = False
+        if path is not None and os.path.exists(path):
+            self._runs.append(np.load(path, mmap_mode="r"))
+
+    @staticmethod
+    def _key(key: int) -> int:
+        # 128位的指纹只保留低64位
+        if not isinstance(key, int):
+            raise TypeError(f'fingerprint must be an int, got {type(key).__name__}')
+        return key & MASK64
+
+    def _in_runs(self, key: int) -> bool:
+        value = np.uint64(key)
+        for run in self._runs:
+            index = int(np.searchsorted(run, value))
+            if index < len(run) and run[index] == value:
+                return True
+        return False
+
+    def __contains__(self, key: int) -> bool:
+        key = self._key(key)
+        return key in self._buffer or self._in_runs(key)
+
+    def add(self, key: int) -> bool:
+        """
+        加入一个指纹，返回加入之前是否已经存在
+        """
+        key = self._key(key)
+        if key in self._buffer or self._in_runs(key):
+            return True
+        self._buffer.add(key)
+        self._maybe_merge()
+        return False
+
+    def _contains_runs_many(self, values) -> "np.ndarray":
+        found = np.zeros(len(values), dtype=bool)
+        for run in self._runs:
+            index = np.searchsorted(run, values)
+            hit = index < len(run)
+            hit[hit] = run[index[hit]] == values[hit]
+            found |= hit
+        return found
+
+    def contains_many(self, keys: Iterable[int]) -> List[bool]:
+        keys = [self._key(key) for key in keys]
+        found = self._contains_runs_many(np.array(keys, dtype=np.uint64))
+        buffer = self._buffer
+        return [bool(f) or key in buffer for key, f in zip(keys, found)]
+
+    def add_many(self, keys: Iterable[int]) -> List[bool]:
+        """
+        批量加入指纹，返回每一个指纹加入之前是否已经存在（与按顺序调用add的结果一致）
+        """
+        keys = [self._key(key) for key in keys]
+        found = self._contains_runs_many(np.array(keys, dtype=np.uint64))
+        buffer = self._buffer
+        result = []
+        for key, f in zip(keys, found):
+            if f or key in buffer:
+                result.append(True)
+            else:
+                buffer.add(key)
+                result.append(False)
+        self._maybe_merge()
+        return result
+
+    def _maybe_merge(self):
+        if len(self._buffer) >= self._merge_size:
+            self._flush_buffer()
+
+    @staticmethod
+    def _merge_runs(left, right) -> "np.ndarray":
+        # 不同的run中没有重复的指纹，拼接之后的稳定排序（timsort）识别出两段有序的部分，只需要线性时间归并
+        merged = np.concatenate((left, right))
+        merged.sort(kind="stable")
+        return merged
+
+    def _flush_buffer(self):
+        # 把插入缓冲区排序成一个run，和前面长度相近的run逐级归并
+        if not self._buffer:
+            return
+        run = np.fromiter(self._buffer, dtype=np.uint64, count=len(self._buffer))
+        run.sort()
+        self._buffer.clear()
+        self._runs.append(run)
+        self._dirty = True
+        while len(self._runs) > 1 and len(self._runs[-2]) <= 2 * len(self._runs[-1]):
+            right = self._runs.pop()
+            self._runs.append(self._merge_runs(self._runs.pop(), right))
+
+    def merge(self):
+        """
+        把插入缓冲区和所有的run合并成一个有序数组，指定了path并且加入了新的指纹时写入文件
+        """
+        self._flush_buffer()
+        while len(self._runs) > 1:
+            right = self._runs.pop()
+            self._runs.append(self._merge_runs(self._runs.pop(), right))
+        if self._path is not None and self._dirty:
+            merged = self._runs[0]
+            tmp_path = self._path + ".tmp.npy"
+            out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint64, shape=merged.shape)
+            out[:] = merged
+            out.flush()
+            del out, merged
+            self._runs = []
+            os.replace(tmp_path, self._path)
+            self._runs = [np.load(self._path, mmap_mode="r")]
+        self._dirty = False
+
+    def checkpoint(self):
+        self.merge()
+
+    def close(self):
+        self.merge()
+
+    @property
+    def count(self) -> int:
+        return len(self)
+
+    def __len__(self):
+        return sum(len(run) for run in self._runs) + len(self._buffer)
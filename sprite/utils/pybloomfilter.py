@@ -2,12 +2,44 @@
 
 __date__ = '2019/8/6 19:46'
 
+import os
 import math
+import mmap
 import hashlib
+import logging
+import tempfile
+import threading
 import bitarray
 from io import BytesIO
-from struct import unpack, pack, calcsize
+from struct import unpack, pack, calcsize, unpack_from, pack_into
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import mmh3
+except ImportError:
+    mmh3 = None
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = resource_tracker = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# the logger of sprite, without importing the package
+logger = logging.getLogger('sprite')
 
 __version__ = '2.0'
 __author__  = "Jay Baird <jay.baird@me.com>, Bob Ippolito <bob@redivi.com>,\
@@ -65,10 +97,184 @@ def make_hashfuncs(num_slices, num_bits):
     return _make_hashfuncs
 
 
+# hash schemes, stored with every filter so that files written with one
+# scheme are always read back with the same one
+HASH_SALTED = 0   # make_hashfuncs, salted md5/sha digests (legacy)
+HASH_BLAKE2B = 1  # double hashing over blake2b(digest_size=16)
+HASH_XXH128 = 2   # double hashing over xxhash xxh3_128
+HASH_MMH3 = 3     # double hashing over mmh3 hash128
+
+MASK64 = (1 << 64) - 1
+
+
+def _blake2b_digest(key):
+    return hashlib.blake2b(key, digest_size=16).digest()
+
+
+# names of the hash schemes, e.g. for the BLOOM_HASH_SCHEME setting
+HASH_SCHEMES = {
+    'salted': HASH_SALTED,
+    'blake2b': HASH_BLAKE2B,
+    'xxhash': HASH_XXH128,
+    'mmh3': HASH_MMH3,
+}
+
+# blake2b only needs the standard library, so a filter written on one host
+# can always be read back on another. xxhash and mmh3 are faster but must
+# be asked for explicitly.
+DEFAULT_HASH_SCHEME = HASH_BLAKE2B
+
+
+def _digest_func(hash_scheme):
+    """Return a function mapping key bytes to a 16 bytes digest."""
+    if hash_scheme == HASH_BLAKE2B:
+        return _blake2b_digest
+    if hash_scheme == HASH_XXH128:
+        if xxhash is None:
+            raise ImportError('hash scheme HASH_XXH128 needs the xxhash '
+                              'package (pip install xxhash)')
+        return getattr(xxhash, 'xxh3_128_digest', None) or xxhash.xxh128_digest
+    if hash_scheme == HASH_MMH3:
+        if mmh3 is None:
+            raise ImportError('hash scheme HASH_MMH3 needs the mmh3 '
+                              'package (pip install mmh3)')
+        return mmh3.hash_bytes
+    raise ValueError('unknown hash scheme %r' % (hash_scheme,))
+
+
+def _key_bytes(key):
+    if isinstance(key, str):
+        return key.encode('utf-8')
+    if isinstance(key, int) and 0 <= key < (1 << 128):
+        # fixed size fingerprints, e.g. sprite.utils.request.request_fingerprint
+        return key.to_bytes(16, 'little')
+    return str(key).encode('utf-8')
+
+
+def hash_pair(key, hash_scheme=DEFAULT_HASH_SCHEME):
+    """Split one 128 bits hash of `key' into two 64 bits halves."""
+    return unpack('<QQ', _digest_func(hash_scheme)(_key_bytes(key)))
+
+
+def hash_pairs(keys, hash_scheme=DEFAULT_HASH_SCHEME):
+    """hash_pair for a batch of keys, returned as a (n, 2) uint64 array."""
+    digest = _digest_func(hash_scheme)
+    data = b''.join([digest(_key_bytes(key)) for key in keys])
+    return np.frombuffer(data, dtype='<u8').reshape(-1, 2)
+
+
+def make_double_hashfuncs(num_slices, num_bits, hash_scheme=DEFAULT_HASH_SCHEME):
+    """Kirsch-Mitzenmacher double hashing: the i-th index is derived from
+    the two halves of a single 128 bits hash as (h1 + i * h2) mod num_bits,
+    with the sum taken modulo 2 ** 64 so that the vectorized NumPy version
+    gives the same indexes."""
+    digest = _digest_func(hash_scheme)
+    slices = range(num_slices)
+    def _make_hashfuncs(key):
+        h1, h2 = unpack('<QQ', digest(_key_bytes(key)))
+        return [((h1 + i * h2) & MASK64) % num_bits for i in slices]
+
+    return _make_hashfuncs
+
+
+def _make_hashes(num_slices, num_bits, hash_scheme):
+    if hash_scheme == HASH_SALTED:
+        return make_hashfuncs(num_slices, num_bits)
+    return make_double_hashfuncs(num_slices, num_bits, hash_scheme)
+
+
+def _unique_mask(pairs):
+    """True for the first occurrence of every hash pair of a batch."""
+    mask = np.zeros(len(pairs), dtype=bool)
+    if len(pairs):
+        _, first = np.unique(np.ascontiguousarray(pairs).view('V16').ravel(),
+                             return_index=True)
+        mask[first] = True
+    return mask
+
+
+class BufferBitArray(object):
+    """A little-endian bit array over a writable buffer (mmap, shared
+    memory...), exposing the parts of the bitarray API the filters use."""
+
+    def __init__(self, buffer, length):
+        self._buf = buffer
+        self._length = length
+
+    def __getitem__(self, index):
+        return bool(self._buf[index >> 3] & (1 << (index & 7)))
+
+    def __setitem__(self, index, value):
+        if value:
+            self._buf[index >> 3] |= 1 << (index & 7)
+        else:
+            self._buf[index >> 3] &= ~(1 << (index & 7)) & 0xff
+
+    def __len__(self):
+        return self._length
+
+    def length(self):
+        return self._length
+
+    def setall(self, value):
+        self._buf[:] = (b'\xff' if value else b'\x00') * len(self._buf)
+
+    def tobytes(self):
+        return bytes(self._buf)
+
+    def tofile(self, f):
+        f.write(self.tobytes())
+
+    def copy(self):
+        bits = bitarray.bitarray(endian='little')
+        bits.frombytes(self.tobytes())
+        del bits[self._length:]
+        return bits
+
+    def buffer(self):
+        return self._buf
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MmapBitArray(BufferBitArray):
+    """A bit array stored in the file `path' and accessed through mmap, so
+    the bits are never read into memory as a whole and `flush' only writes
+    back the dirty pages."""
+
+    def __init__(self, path, length):
+        self.path = path
+        nbytes = max((length + 7) // 8, 1)
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        if os.path.getsize(path) < nbytes:
+            self._file.truncate(nbytes)
+        self._mmap = mmap.mmap(self._file.fileno(), nbytes)
+        super(MmapBitArray, self).__init__(self._mmap, length)
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        if not self._mmap.closed:
+            self._mmap.flush()
+            self._mmap.close()
+            self._file.close()
+
+
 class BloomFilter(object):
     FILE_FMT = b'<dQQQQ'
-
-    def __init__(self, capacity, error_rate=0.001):
+    # Files of filters not using HASH_SALTED start with this magic followed
+    # by the hash scheme. Read as the error_rate of the legacy header it is
+    # a NaN, so it can never be mistaken for a legacy file.
+    FILE_MAGIC = b'SPBF\x01\x00\xf8\xff'
+    SCHEME_FMT = b'<B'
+
+    def __init__(self, capacity, error_rate=0.001, bits=None,
+                 hash_scheme=DEFAULT_HASH_SCHEME):
         """Implements a space-efficient probabilistic data structure
 
         capacity
@@ -79,6 +285,13 @@ class BloomFilter(object):
             the error_rate of the filter returning false positives. This
             determines the filters capacity. Inserting more than capacity
             elements greatly increases the chance of false positives.
+        bits
+            a factory called with the number of bits to build the
+            underlying bit array (e.g. a MmapBitArray), defaults to an
+            in-memory bitarray
+        hash_scheme
+            how the indexes of a key are hashed, HASH_SALTED for the legacy
+            salted digests, the double hashing schemes are much faster
 
         >>> b = BloomFilter(capacity=100000, error_rate=0.001)
         >>> b.add("test")
@@ -91,6 +304,17 @@ class BloomFilter(object):
             raise ValueError("Error_Rate must be between 0 and 1.")
         if not capacity > 0:
             raise ValueError("Capacity must be > 0")
+        num_slices, bits_per_slice = self._dimensions(capacity, error_rate)
+        self._setup(error_rate, num_slices, bits_per_slice, capacity, 0,
+                    hash_scheme)
+        if bits is not None:
+            self.bitarray = bits(self.num_bits)
+        else:
+            self.bitarray = bitarray.bitarray(self.num_bits, endian='little')
+            self.bitarray.setall(False)
+
+    @staticmethod
+    def _dimensions(capacity, error_rate):
         # given M = num_bits, k = num_slices, P = error_rate, n = capacity
         #       k = log2(1/P)
         # solving for m = bits_per_slice
@@ -101,18 +325,20 @@ class BloomFilter(object):
         bits_per_slice = int(math.ceil(
             (capacity * abs(math.log(error_rate))) /
             (num_slices * (math.log(2) ** 2))))
-        self._setup(error_rate, num_slices, bits_per_slice, capacity, 0)
-        self.bitarray = bitarray.bitarray(self.num_bits, endian='little')
-        self.bitarray.setall(False)
+        return num_slices, bits_per_slice
 
-    def _setup(self, error_rate, num_slices, bits_per_slice, capacity, count):
+    def _setup(self, error_rate, num_slices, bits_per_slice, capacity, count,
+               hash_scheme=HASH_SALTED):
         self.error_rate = error_rate
         self.num_slices = num_slices
         self.bits_per_slice = bits_per_slice
         self.capacity = capacity
         self.num_bits = num_slices * bits_per_slice
-        self.count = count
-        self.make_hashes = make_hashfuncs(self.num_slices, self.bits_per_slice)
+        if count is not None:
+            self.count = count
+        self.hash_scheme = hash_scheme
+        self.make_hashes = _make_hashes(self.num_slices, self.bits_per_slice,
+                                        hash_scheme)
 
     def __contains__(self, key):
         """Tests a key's membership in this bloom filter.
@@ -155,8 +381,7 @@ class BloomFilter(object):
         bits_per_slice = self.bits_per_slice
         hashes = self.make_hashes(key)
         found_all_bits = True
-        if self.count > self.capacity:
-            raise IndexError("BloomFilter is at capacity")
+        self._check_capacity()
         offset = 0
         for k in hashes:
             if not skip_check and found_all_bits and not bitarray[offset + k]:
@@ -173,10 +398,111 @@ class BloomFilter(object):
         else:
             return True
 
+    def _check_capacity(self):
+        if self.count > self.capacity:
+            raise IndexError("BloomFilter is at capacity")
+
+    def _bit_view(self):
+        """A writable uint8 NumPy view over the bits, or None if the bit
+        array does not expose its buffer."""
+        if np is None or self.hash_scheme == HASH_SALTED:
+            return None
+        buffer = getattr(self.bitarray, 'buffer', None)
+        try:
+            view = np.frombuffer(buffer() if buffer is not None
+                                 else self.bitarray, dtype=np.uint8)
+        except (TypeError, ValueError, BufferError):
+            return None
+        return view if view.flags.writeable else None
+
+    def _contains_pair(self, h1, h2):
+        bits_per_slice = self.bits_per_slice
+        bitarray = self.bitarray
+        offset = 0
+        for i in range(self.num_slices):
+            if not bitarray[offset + ((h1 + i * h2) & MASK64) % bits_per_slice]:
+                return False
+            offset += bits_per_slice
+        return True
+
+    def _add_pair(self, h1, h2):
+        bits_per_slice = self.bits_per_slice
+        bitarray = self.bitarray
+        offset = 0
+        for i in range(self.num_slices):
+            bitarray[offset + ((h1 + i * h2) & MASK64) % bits_per_slice] = True
+            offset += bits_per_slice
+
+    def _positions(self, pairs):
+        """The bit indexes of every hash pair, one row per key."""
+        steps = np.arange(self.num_slices, dtype=np.uint64)
+        bits_per_slice = np.uint64(self.bits_per_slice)
+        h1 = pairs[:, 0:1]
+        h2 = pairs[:, 1:2]
+        return (h1 + steps * h2) % bits_per_slice + steps * bits_per_slice
+
+    def _contains_pairs(self, pairs, view):
+        positions = self._positions(pairs)
+        bits = (view[positions >> np.uint64(3)] >> (positions & np.uint64(7))
+                .astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    def _add_pairs(self, pairs, view):
+        positions = self._positions(pairs).ravel()
+        masks = np.left_shift(1, (positions & np.uint64(7)).astype(np.uint8)) \
+            .astype(np.uint8)
+        np.bitwise_or.at(view, positions >> np.uint64(3), masks)
+
+    def contains_many(self, keys):
+        """Tests the membership of a batch of keys, returns a list of bools.
+        The keys are hashed and tested at once when NumPy is available.
+
+        >>> b = BloomFilter(capacity=100)
+        >>> b.add("hello")
+        False
+        >>> b.contains_many(["hello", "world"])
+        [True, False]
+
+        """
+        keys = list(keys)
+        view = self._bit_view()
+        if view is None:
+            return [key in self for key in keys]
+        if not keys:
+            return []
+        return self._contains_pairs(
+            hash_pairs(keys, self.hash_scheme), view).tolist()
+
+    def add_many(self, keys, skip_check=False):
+        """Adds a batch of keys, returns for every key whether it already
+        existed, like calling `add' for each key in order (except that keys
+        of the batch cannot be false positives of each other).
+
+        >>> b = BloomFilter(capacity=100)
+        >>> b.add_many(["hello", "world", "hello"])
+        [False, False, True]
+
+        """
+        keys = list(keys)
+        view = self._bit_view()
+        if view is None:
+            return [self.add(key, skip_check) for key in keys]
+        if not keys:
+            return []
+        self._check_capacity()
+        pairs = hash_pairs(keys, self.hash_scheme)
+        new = _unique_mask(pairs)
+        if not skip_check:
+            new &= ~self._contains_pairs(pairs, view)
+        self._add_pairs(pairs[new], view)
+        self.count += int(new.sum())
+        return (~new).tolist()
+
     def copy(self):
         """Return a copy of this bloom filter.
         """
-        new_filter = BloomFilter(self.capacity, self.error_rate)
+        new_filter = BloomFilter(self.capacity, self.error_rate,
+                                 hash_scheme=self.hash_scheme)
         new_filter.bitarray = self.bitarray.copy()
         return new_filter
 
@@ -208,12 +534,33 @@ have equal capacity and error rate")
     def __and__(self, other):
         return self.intersection(other)
 
+    def _write_header(self, f):
+        if self.hash_scheme != HASH_SALTED:
+            f.write(self.FILE_MAGIC)
+            f.write(pack(self.SCHEME_FMT, self.hash_scheme))
+        f.write(pack(self.FILE_FMT, self.error_rate, self.num_slices,
+                     self.bits_per_slice, self.capacity, self.count))
+
+    @classmethod
+    def _read_header(cls, f):
+        """Read the header written by `_write_header', returns the
+        arguments of `_setup' and the length of the header."""
+        headerlen = calcsize(cls.FILE_FMT)
+        data = f.read(len(cls.FILE_MAGIC))
+        if data == cls.FILE_MAGIC:
+            scheme_len = calcsize(cls.SCHEME_FMT)
+            hash_scheme, = unpack(cls.SCHEME_FMT, f.read(scheme_len))
+            args = unpack(cls.FILE_FMT, f.read(headerlen))
+            return args + (hash_scheme,), len(data) + scheme_len + headerlen
+        # legacy header, the magic was the beginning of it
+        args = unpack(cls.FILE_FMT, data + f.read(headerlen - len(data)))
+        return args + (HASH_SALTED,), headerlen
+
     def tofile(self, f):
         """Write the bloom filter to file object `f'. Underlying bits
         are written as machine values. This is much more space
         efficient than pickling the object."""
-        f.write(pack(self.FILE_FMT, self.error_rate, self.num_slices,
-                     self.bits_per_slice, self.capacity, self.count))
+        self._write_header(f)
         (f.write(self.bitarray.tobytes()) if is_string_io(f)
          else self.bitarray.tofile(f))
 
@@ -221,13 +568,12 @@ have equal capacity and error rate")
     def fromfile(cls, f, n=-1):
         """Read a bloom filter from file-object `f' serialized with
         ``BloomFilter.tofile''. If `n' > 0 read only so many bytes."""
-        headerlen = calcsize(cls.FILE_FMT)
-
-        if 0 < n < headerlen:
+        if 0 < n < calcsize(cls.FILE_FMT):
             raise ValueError('n too small!')
 
         filter = cls(1)  # Bogus instantiation, we will `_setup'.
-        filter._setup(*unpack(cls.FILE_FMT, f.read(headerlen)))
+        args, headerlen = cls._read_header(f)
+        filter._setup(*args)
         filter.bitarray = bitarray.bitarray(endian='little')
         if n > 0:
             (filter.bitarray.frombytes(f.read(n-headerlen)) if is_string_io(f)
@@ -249,7 +595,226 @@ have equal capacity and error rate")
 
     def __setstate__(self, d):
         self.__dict__.update(d)
-        self.make_hashes = make_hashfuncs(self.num_slices, self.bits_per_slice)
+        self.hash_scheme = d.get('hash_scheme', HASH_SALTED)
+        self.make_hashes = _make_hashes(self.num_slices, self.bits_per_slice,
+                                        self.hash_scheme)
+
+
+class _InterProcessLock(object):
+    """An exclusive flock on `path' (where fcntl exists) plus a thread lock,
+    since flock does not exclude threads sharing the same file."""
+
+    def __init__(self, path):
+        self._thread_lock = threading.Lock()
+        self._file = open(path, 'a+b') if fcntl is not None else None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _open_shared_memory(name, create=False, size=0):
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    # The segment is shared by unrelated processes, do not let the resource
+    # tracker of whichever process exits first unlink it.
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+class SharedBloomFilter(BloomFilter):
+    # header of the shared memory segment, the bits start at BITS_OFFSET
+    HEADER_FMT = b'<8sdQQQB'
+    HEADER_MAGIC = b'SPSHMBF1'
+    COUNT_OFFSET = 48
+    BITS_OFFSET = 64
+
+    def __init__(self, name, capacity=None, error_rate=0.001,
+                 hash_scheme=DEFAULT_HASH_SCHEME, path=None):
+        """A BloomFilter whose bits live in the shared memory segment
+        `name', so several processes of one host share one filter.
+
+        The first process creates the segment (from the checkpoint `path'
+        if it exists, otherwise empty with `capacity' and `error_rate'),
+        the others attach to it by name. `add' is an atomic test-and-set
+        across processes. The segment outlives the processes, `unlink'
+        removes it.
+
+        >>> b = SharedBloomFilter('doctest-bloom', capacity=100)
+        >>> b.add("hello")
+        False
+        >>> with SharedBloomFilter('doctest-bloom') as other:
+        ...     other.add("hello")
+        True
+        >>> b.unlink()
+
+        """
+        if shared_memory is None:
+            raise ImportError("SharedBloomFilter requires "
+                              "multiprocessing.shared_memory (python 3.8+)")
+        self.name = name
+        self.path = path
+        self._capacity_warned = False
+        self._lock = _InterProcessLock(
+            os.path.join(tempfile.gettempdir(), '%s.lock' % name))
+        with self._lock:
+            try:
+                self._shm = _open_shared_memory(name)
+            except FileNotFoundError:
+                self._shm = self._create(capacity, error_rate, hash_scheme)
+        self._attach()
+
+    def _create(self, capacity, error_rate, hash_scheme):
+        source = None
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                source = BloomFilter.fromfile(f)
+            args = (source.error_rate, source.num_slices,
+                    source.bits_per_slice, source.capacity, source.count,
+                    source.hash_scheme)
+        else:
+            if capacity is None:
+                raise FileNotFoundError(
+                    'shared bloom filter %r does not exist' % self.name)
+            if not (0 < error_rate < 1):
+                raise ValueError("Error_Rate must be between 0 and 1.")
+            num_slices, bits_per_slice = self._dimensions(capacity, error_rate)
+            args = (error_rate, num_slices, bits_per_slice, capacity, 0,
+                    hash_scheme)
+        error_rate, num_slices, bits_per_slice, capacity, count, hash_scheme = args
+        nbytes = (num_slices * bits_per_slice + 7) // 8
+        shm = _open_shared_memory(self.name, create=True,
+                                  size=self.BITS_OFFSET + nbytes)
+        pack_into(self.HEADER_FMT, shm.buf, 0, self.HEADER_MAGIC, error_rate,
+                  num_slices, bits_per_slice, capacity, hash_scheme)
+        pack_into(b'<Q', shm.buf, self.COUNT_OFFSET, count)
+        if source is not None:
+            data = source.bitarray.tobytes()
+            shm.buf[self.BITS_OFFSET:self.BITS_OFFSET + len(data)] = data
+        return shm
+
+    def _attach(self):
+        magic, error_rate, num_slices, bits_per_slice, capacity, hash_scheme = \
+            unpack_from(self.HEADER_FMT, self._shm.buf, 0)
+        if magic != self.HEADER_MAGIC:
+            raise ValueError('%r is not a shared bloom filter' % self.name)
+        # only read the header, the count in the segment may be changing
+        # under other processes and is not written back
+        self._setup(error_rate, num_slices, bits_per_slice, capacity,
+                    None, hash_scheme)
+        nbytes = (self.num_bits + 7) // 8
+        self.bitarray = BufferBitArray(
+            self._shm.buf[self.BITS_OFFSET:self.BITS_OFFSET + nbytes],
+            self.num_bits)
+
+    @property
+    def count(self):
+        if self._shm is None:
+            # detached, the count at the time of `close'
+            return self._closed_count
+        return unpack_from(b'<Q', self._shm.buf, self.COUNT_OFFSET)[0]
+
+    @count.setter
+    def count(self, value):
+        pack_into(b'<Q', self._shm.buf, self.COUNT_OFFSET, value)
+
+    def _check_capacity(self):
+        """The segment cannot grow, past the capacity keys are still added
+        and only the false positive rate rises, warn about it once."""
+        if self.count > self.capacity and not self._capacity_warned:
+            self._capacity_warned = True
+            logger.warning('shared bloom filter %r is over its capacity %d, '
+                           'the false positive rate will rise above %s'
+                           % (self.name, self.capacity, self.error_rate))
+
+    def add(self, key, skip_check=False):
+        with self._lock:
+            return super(SharedBloomFilter, self).add(key, skip_check)
+
+    def add_many(self, keys, skip_check=False):
+        with self._lock:
+            return super(SharedBloomFilter, self).add_many(keys, skip_check)
+
+    @classmethod
+    def fromfile(cls, f, n=-1, name=None):
+        """Read a filter written by ``BloomFilter.tofile'' into the new
+        shared memory segment `name'."""
+        source = BloomFilter.fromfile(f, n)
+        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+            source.tofile(tmp)
+        try:
+            return cls(name, path=tmp.name)
+        finally:
+            os.remove(tmp.name)
+
+    def checkpoint(self):
+        """Write the filter to `path' with ``tofile'', atomically."""
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'wb') as f:
+                self.tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _detach(self):
+        """Release the view of the bits, then close the segment (which
+        cannot be closed while the view exists)."""
+        if self._shm is None:
+            return
+        self._closed_count = self.count
+        self.bitarray.buffer().release()
+        self._shm.close()
+        self._shm = None
+
+    def close(self):
+        """Checkpoint and detach from the shared memory segment."""
+        if self._shm is None:
+            return
+        self.checkpoint()
+        self._detach()
+        self._lock.close()
+
+    def unlink(self):
+        """Detach and remove the shared memory segment."""
+        shm = shared_memory.SharedMemory(name=self.name)
+        self._detach()
+        shm.unlink()
+        shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        # detach without checkpointing, before the segment is garbage
+        # collected with the view of the bits still exported
+        if getattr(self, '_shm', None) is not None:
+            self._detach()
+
+    def __getstate__(self):
+        return {'name': self.name, 'path': self.path}
+
+    def __setstate__(self, d):
+        self.__init__(d['name'], path=d['path'])
 
 
 class ScalableBloomFilter(object):
@@ -258,7 +823,7 @@ class ScalableBloomFilter(object):
     FILE_FMT = '<idQd'
 
     def __init__(self, initial_capacity=100, error_rate=0.001,
-                 mode=SMALL_SET_GROWTH):
+                 mode=SMALL_SET_GROWTH, hash_scheme=DEFAULT_HASH_SCHEME):
         """Implements a space-efficient probabilistic data structure that
         grows as more items are added while maintaining a steady false
         positive rate
@@ -274,6 +839,8 @@ class ScalableBloomFilter(object):
             ScalableBloomFilter.LARGE_SET_GROWTH. SMALL_SET_GROWTH is slower
             but uses less memory. LARGE_SET_GROWTH is faster but consumes
             memory faster.
+        hash_scheme
+            the hash scheme of the filters added from now on
 
         >>> b = ScalableBloomFilter(initial_capacity=512, error_rate=0.001, \
                                     mode=ScalableBloomFilter.SMALL_SET_GROWTH)
@@ -289,7 +856,12 @@ class ScalableBloomFilter(object):
         """
         if not error_rate or error_rate < 0:
             raise ValueError("Error_Rate must be a decimal less than 0.")
+        if hash_scheme != HASH_SALTED:
+            # the filters are added lazily, fail now when the package of
+            # the hash scheme is missing rather than on the first add
+            _digest_func(hash_scheme)
         self._setup(mode, 0.9, initial_capacity, error_rate)
+        self.hash_scheme = hash_scheme
         self.filters = []
 
     def _setup(self, mode, ratio, initial_capacity, error_rate):
@@ -309,6 +881,13 @@ class ScalableBloomFilter(object):
         True
 
         """
+        if self._same_scheme():
+            # hash the key once and test every filter with the same pair
+            h1, h2 = hash_pair(key, self.hash_scheme)
+            for f in reversed(self.filters):
+                if f._contains_pair(h1, h2):
+                    return True
+            return False
         for f in reversed(self.filters):
             if key in f:
                 return True
@@ -327,22 +906,104 @@ class ScalableBloomFilter(object):
         True
 
         """
+        if self._same_scheme():
+            h1, h2 = hash_pair(key, self.hash_scheme)
+            for f in reversed(self.filters):
+                if f._contains_pair(h1, h2):
+                    return True
+            filter = self._current_filter()
+            filter._add_pair(h1, h2)
+            filter.count += 1
+            return False
         if key in self:
             return True
+        self._current_filter().add(key, skip_check=True)
+        return False
+
+    def _current_filter(self):
+        """The filter new keys are added to, grows a new one when the last
+        filter is at capacity."""
         if not self.filters:
-            filter = BloomFilter(
+            filter = self._new_filter(
                 capacity=self.initial_capacity,
                 error_rate=self.error_rate * (1.0 - self.ratio))
             self.filters.append(filter)
         else:
             filter = self.filters[-1]
             if filter.count >= filter.capacity:
-                filter = BloomFilter(
+                filter = self._new_filter(
                     capacity=filter.capacity * self.scale,
                     error_rate=filter.error_rate * self.ratio)
                 self.filters.append(filter)
-        filter.add(key, skip_check=True)
-        return False
+        return filter
+
+    def _new_filter(self, capacity, error_rate):
+        return BloomFilter(capacity=capacity, error_rate=error_rate,
+                           hash_scheme=self.hash_scheme)
+
+    def _same_scheme(self):
+        """Whether every filter uses this filter's double hashing scheme, so
+        a key can be hashed once and tested against all of them."""
+        if self.hash_scheme == HASH_SALTED:
+            return False
+        for f in self.filters:
+            if f.hash_scheme != self.hash_scheme:
+                return False
+        return True
+
+    def _pair_view(self):
+        """True-ish when the NumPy batch path is usable for every filter."""
+        if np is None or not self._same_scheme():
+            return None
+        for f in self.filters:
+            if f._bit_view() is None:
+                return None
+        return True
+
+    def contains_many(self, keys):
+        """Tests the membership of a batch of keys, returns a list of bools.
+
+        >>> b = ScalableBloomFilter(initial_capacity=100, error_rate=0.001)
+        >>> b.add("hello")
+        False
+        >>> b.contains_many(["hello", "world"])
+        [True, False]
+
+        """
+        keys = list(keys)
+        if not keys or self._pair_view() is None:
+            return [key in self for key in keys]
+        pairs = hash_pairs(keys, self.hash_scheme)
+        found = np.zeros(len(keys), dtype=bool)
+        for f in reversed(self.filters):
+            found |= f._contains_pairs(pairs, f._bit_view())
+        return found.tolist()
+
+    def add_many(self, keys):
+        """Adds a batch of keys, returns for every key whether it already
+        existed, like calling `add' for each key in order (except that keys
+        of the batch cannot be false positives of each other).
+
+        >>> b = ScalableBloomFilter(initial_capacity=100, error_rate=0.001)
+        >>> b.add_many(["hello", "world", "hello"])
+        [False, False, True]
+
+        """
+        keys = list(keys)
+        if not keys or self._pair_view() is None:
+            return [self.add(key) for key in keys]
+        pairs = hash_pairs(keys, self.hash_scheme)
+        new = _unique_mask(pairs)
+        for f in reversed(self.filters):
+            new &= ~f._contains_pairs(pairs, f._bit_view())
+        index = np.flatnonzero(new)
+        while len(index):
+            filter = self._current_filter()
+            room = max(filter.capacity - filter.count, 1)
+            filter._add_pairs(pairs[index[:room]], filter._bit_view())
+            filter.count += len(index[:room])
+            index = index[room:]
+        return (~new).tolist()
 
     @property
     def capacity(self):
@@ -399,7 +1060,71 @@ class ScalableBloomFilter(object):
         return sum(f.count for f in self.filters)
 
 
+class PersistentScalableBloomFilter(ScalableBloomFilter):
+    META_FILE = 'bloomfilter.meta'
+    BITS_FILE = 'bloomfilter.%d.bits'
 
+    def __init__(self, dir_path, initial_capacity=100, error_rate=0.001,
+                 mode=ScalableBloomFilter.SMALL_SET_GROWTH,
+                 hash_scheme=DEFAULT_HASH_SCHEME):
+        """A ScalableBloomFilter whose bit arrays live in files under
+        `dir_path' and are memory-mapped instead of read into memory.
 
+        The parameters and counts of the filters are kept in a small meta
+        file. `checkpoint' flushes the dirty pages of the bit arrays and
+        rewrites the meta file, so its cost does not grow with the size
+        of the filter. Reopening the same directory restores the filter
+        from the last checkpoint.
+        """
+        super(PersistentScalableBloomFilter, self).__init__(
+            initial_capacity=initial_capacity, error_rate=error_rate, mode=mode,
+            hash_scheme=hash_scheme)
+        self.dir_path = dir_path
+        os.makedirs(dir_path, exist_ok=True)
+        meta_path = os.path.join(dir_path, self.META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'rb') as f:
+                self._load_meta(f)
+
+    def _bits_path(self, index):
+        return os.path.join(self.dir_path, self.BITS_FILE % index)
+
+    def _load_meta(self, f):
+        self._setup(*unpack(self.FILE_FMT, f.read(calcsize(self.FILE_FMT))))
+        nfilters, = unpack(b'<l', f.read(calcsize(b'<l')))
+        for index in range(nfilters):
+            filter = BloomFilter(1)  # Bogus instantiation, we will `_setup'.
+            args, _ = BloomFilter._read_header(f)
+            filter._setup(*args)
+            filter.bitarray = MmapBitArray(self._bits_path(index), filter.num_bits)
+            self.filters.append(filter)
 
-
+    def _new_filter(self, capacity, error_rate):
+        path = self._bits_path(len(self.filters))
+        if os.path.exists(path):
+            # left over by a filter added after the last checkpoint
+            os.remove(path)
+        return BloomFilter(capacity=capacity, error_rate=error_rate,
+                           bits=lambda num_bits: MmapBitArray(path, num_bits),
+                           hash_scheme=self.hash_scheme)
+
+    def checkpoint(self):
+        """Flush the bit arrays and atomically rewrite the meta file."""
+        for filter in self.filters:
+            filter.bitarray.flush()
+        meta_path = os.path.join(self.dir_path, self.META_FILE)
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(pack(self.FILE_FMT, self.scale, self.ratio,
+                         self.initial_capacity, self.error_rate))
+            f.write(pack(b'<l', len(self.filters)))
+            for filter in self.filters:
+                filter._write_header(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, meta_path)
+
+    def close(self):
+        self.checkpoint()
+        for filter in self.filters:
+            filter.bitarray.close()
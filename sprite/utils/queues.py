@@ -2,7 +2,11 @@
 __author__ = 'liyong'
 __date__ = '2019/8/16 19:58'
 
+import time
+import heapq
+import itertools
 import collections
+from typing import Callable
 from collections import defaultdict, deque
 from itertools import chain
 from asyncio import coroutine, events, locks, QueueEmpty, QueueFull
@@ -54,6 +58,26 @@ class PriorityQueue:
                     return t
         raise IndexError("pop from an empty queue")  # 优先队列为空
 
+    def pop_lowest(self, priority: int):
+        # 弹出优先级最低（权重最大）的元素中最后加入的一个，只有其权重大于priority时才弹出，否则抛出IndexError
+        if self.positems:
+            items, lowest = self.positems, max(self.positems)
+        elif self.pzero:
+            items, lowest = None, 0
+        elif self.negitems:
+            items, lowest = self.negitems, max(self.negitems)
+        else:
+            raise IndexError("pop from an empty queue")
+        if lowest <= priority:
+            raise IndexError("no item with a lower priority")
+        if items is None:
+            return self.pzero.popleft(), 0
+        deq = items[lowest]
+        item = deq.popleft()
+        if not deq:
+            del items[lowest]
+        return item, lowest
+
     def __len__(self):
         total = sum(len(v) for v in self.negitems.values()) + \
                 len(self.pzero) + \
@@ -74,6 +98,192 @@ class PriorityQueue:
         return bool(self.negitems or self.pzero or self.positems)
 
 
+# 基于堆实现的优先队列
+# 堆中只保存出现过的权重，每个权重对应一个双端队列，同时维护一个计数器
+# push/pop 的复杂度为 O(log P)（P为不同权重的数量），len 的复杂度为 O(1)
+# 弹出顺序与 PriorityQueue 保持一致：权重从小到大，同一权重先进先出
+class HeapPriorityQueue:
+    def __init__(self):
+        self._heap = []
+        self._queues = {}
+        self._count = 0
+
+    def push(self, item, priority: int = 0):  # 压入元素
+        queue = self._queues.get(priority)
+        if queue is None:
+            # 新出现的权重，压入堆中
+            queue = self._queues[priority] = deque()
+            heapq.heappush(self._heap, priority)
+        queue.append(item)
+        self._count += 1
+
+    def pop(self):  # 弹出元素
+        if not self._heap:
+            raise IndexError("pop from an empty queue")  # 优先队列为空
+        priority = self._heap[0]
+        queue = self._queues[priority]
+        item = queue.popleft()
+        if not queue:
+            # 该权重下的队列为空后，从堆中移除
+            heapq.heappop(self._heap)
+            del self._queues[priority]
+        self._count -= 1
+        return item, priority
+
+    def pop_lowest(self, priority: int):
+        # 弹出优先级最低（权重最大）的元素中最后加入的一个，只有其权重大于priority时才弹出，否则抛出IndexError
+        if not self._queues:
+            raise IndexError("pop from an empty queue")
+        lowest = max(self._queues)
+        if lowest <= priority:
+            raise IndexError("no item with a lower priority")
+        queue = self._queues[lowest]
+        item = queue.pop()
+        if not queue:
+            del self._queues[lowest]
+            self._heap.remove(lowest)
+            heapq.heapify(self._heap)
+        self._count -= 1
+        return item, lowest
+
+    def lowest_priority(self):
+        # 优先级最低（权重最大）的元素的权重，队列为空时返回None
+        if not self._queues:
+            return None
+        return max(self._queues)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):  # 按照弹出的顺序遍历
+        return ((item, priority)
+                for priority in sorted(self._queues.keys())
+                for item in self._queues[priority])
+
+    def __bool__(self):
+        return self._count > 0
+
+
+class _HostSlot:
+    __slots__ = ('queue', 'ready_time', 'in_flight', 'scheduled')
+
+    def __init__(self):
+        self.queue = HeapPriorityQueue()
+        # 该域名下一次允许抓取的时间
+        self.ready_time = 0.0
+        # 该域名正在处理中的数量
+        self.in_flight = 0
+        # 是否已经在就绪堆中
+        self.scheduled = False
+
+
+# 按照域名分片的优先队列
+# 每一个域名对应一个 HeapPriorityQueue，同时维护一个按照域名下一次允许抓取时间排序的最小堆
+# pop 只会弹出已经就绪的域名下的元素，弹出之后该域名需要间隔 delay 秒才能再次弹出，
+# 并且同一域名正在处理中的数量不超过 max_in_flight（为0则不限制），处理完成之后需调用 release
+class HostQueue:
+    def __init__(self, key: Callable, delay: float = 0, max_in_flight: int = 0):
+        self._key = key
+        self._delay = delay
+        self._max_in_flight = max_in_flight
+        self._hosts = {}
+        # 就绪堆：(允许抓取的时间, 序号, 域名)
+        self._ready = []
+        # 队列为空且没有处理中的域名：(过期时间, 域名)，过期之后清理掉
+        self._expiring = []
+        self._seq = itertools.count()
+        self._count = 0
+
+    def _schedule(self, key, slot: _HostSlot):
+        if slot.scheduled or not slot.queue:
+            return
+        if self._max_in_flight and slot.in_flight >= self._max_in_flight:
+            # 达到并发上限，等待release之后再加入就绪堆
+            return
+        slot.scheduled = True
+        heapq.heappush(self._ready, (slot.ready_time, next(self._seq), key))
+
+    def _clean(self, now: float):
+        # 清理已经过了间隔时间的空闲域名
+        while self._expiring and self._expiring[0][0] <= now:
+            _, key = heapq.heappop(self._expiring)
+            slot = self._hosts.get(key)
+            if slot is not None and not slot.queue and not slot.in_flight and slot.ready_time <= now:
+                del self._hosts[key]
+
+    def push(self, item, priority: int = 0):  # 压入元素
+        key = self._key(item)
+        slot = self._hosts.get(key)
+        if slot is None:
+            slot = self._hosts[key] = _HostSlot()
+        slot.queue.push(item, priority)
+        self._count += 1
+        self._schedule(key, slot)
+
+    def pop(self):  # 弹出一个已经就绪的域名下的元素
+        now = time.monotonic()
+        self._clean(now)
+        if not self._ready or self._ready[0][0] > now:
+            raise IndexError("no ready item in queue")
+        _, _, key = heapq.heappop(self._ready)
+        slot = self._hosts[key]
+        slot.scheduled = False
+        item, priority = slot.queue.pop()
+        self._count -= 1
+        slot.in_flight += 1
+        slot.ready_time = now + self._delay
+        self._schedule(key, slot)
+        return item, priority
+
+    def release(self, item):  # 元素处理完毕
+        key = self._key(item)
+        slot = self._hosts.get(key)
+        if slot is None or slot.in_flight <= 0:
+            return
+        slot.in_flight -= 1
+        self._schedule(key, slot)
+        if not slot.queue and not slot.in_flight:
+            heapq.heappush(self._expiring, (slot.ready_time, key))
+
+    def pop_lowest(self, priority: int):
+        # 在所有域名中弹出优先级最低（权重最大）的元素，只有其权重大于priority时才弹出，否则抛出IndexError
+        # 需要遍历所有的域名，只在队列满了需要丢弃request时使用
+        lowest, lowest_key = None, None
+        for key, slot in self._hosts.items():
+            slot_lowest = slot.queue.lowest_priority()
+            if slot_lowest is not None and (lowest is None or slot_lowest > lowest):
+                lowest, lowest_key = slot_lowest, key
+        if lowest is None:
+            raise IndexError("pop from an empty queue")
+        slot = self._hosts[lowest_key]
+        item, lowest = slot.queue.pop_lowest(priority)
+        self._count -= 1
+        if not slot.queue:
+            if slot.scheduled:
+                # 域名下没有元素了，从就绪堆中移除
+                self._ready = [entry for entry in self._ready if entry[2] != lowest_key]
+                heapq.heapify(self._ready)
+                slot.scheduled = False
+            if not slot.in_flight:
+                heapq.heappush(self._expiring, (slot.ready_time, lowest_key))
+        return item, lowest
+
+    def ready_in(self):
+        """
+        距离下一个域名就绪的秒数，没有可以调度的域名时返回None
+        """
+        if not self._ready:
+            return None
+        return max(self._ready[0][0] - time.monotonic(), 0)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return (item for slot in list(self._hosts.values()) for item in slot.queue)
+
+    def __bool__(self):
+        return self._count > 0
 
 
 class Queue:
@@ -3,9 +3,14 @@ __author__ = 'liyong'
 __date__ = '2019-08-17 22:00'
 
 import time
-from typing import Dict, Callable
+import hashlib
+from functools import lru_cache
+from typing import Dict, Callable, Tuple, Iterable, Optional
+from urllib.parse import urlsplit, urlunsplit
 from collections import deque
+from w3lib.url import canonicalize_url
 from sprite.utils.http.request import Request
+from sprite.utils.http.response import Response
 from sprite.exceptions import TypeNotSupport
 
 
@@ -22,6 +27,8 @@ def request_to_dict(request: Request) -> Dict:
         '_encoding': request._encoding,
         'priority': request.priority,
         'dont_filter': request.dont_filter,
+        'query': request.query,
+        'formdata': request.formdata,
     }
 
     return d
@@ -39,7 +46,125 @@ def request_from_dict(spider:"Spider", d: Dict) -> Request:
         meta=d['meta'],
         encoding=d['_encoding'],
         priority=d['priority'],
-        dont_filter=d['dont_filter'])
+        dont_filter=d['dont_filter'],
+        query=d.get('query') or None,
+        formdata=d.get('formdata') or None)
+
+def response_to_dict(response: Response) -> Dict:
+    if not isinstance(response, Response):
+        raise TypeNotSupport("不能转换类型非Response的实例为字典！")
+    return {
+        'url': response.url,
+        'status': response.status,
+        'headers': dict(response.headers),
+        'body': response.body,
+        'request': request_to_dict(response.request) if response.request is not None else None,
+        'error': response.error,
+    }
+
+
+def response_from_dict(spider: "Spider", d: Dict) -> Response:
+    if not isinstance(d, Dict):
+        raise TypeNotSupport("不能转换类型非字典对象为Response实例")
+    return Response(
+        url=d['url'],
+        status=d['status'],
+        headers=d['headers'],
+        body=d['body'],
+        request=request_from_dict(spider, d['request']) if d['request'] is not None else None,
+        error=d.get('error'))
+
+
+# 估算request在内存中占用的字节数
+def request_size(request: Request) -> int:
+    size = 512 + len(request.url)
+    for key, value in request.headers.items():
+        size += len(key) + len(value)
+    if request._query:
+        size += len(str(request._query))
+    if request._formdata:
+        size += len(str(request._formdata))
+    if request._meta:
+        size += len(str(request._meta))
+    return size
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+# 获取request对应的域名标识 (scheme, host, port)
+def request_host_key(request: Request) -> Tuple[str, str, int]:
+    parts = urlsplit(request.url)
+    scheme = parts.scheme.lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    return scheme, (parts.hostname or ""), port or DEFAULT_PORTS.get(scheme, 0)
+
+
+# 规范化url：查询参数排序、去掉锚点、统一百分号编码的大小写、域名小写、去掉默认端口
+def canonical_url(url: str) -> str:
+    url = canonicalize_url(url)
+    parts = urlsplit(url)
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is not None and port == DEFAULT_PORTS.get(parts.scheme):
+        netloc = parts.netloc.rsplit(":", 1)[0]
+        url = urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment))
+    return url
+
+
+def _freeze(data) -> Tuple:
+    # 把query、formdata转换为可哈希、与顺序无关的元组
+    if not data:
+        return ()
+    return tuple(sorted((str(key), str(value)) for key, value in data.items()))
+
+
+class RequestFingerprinter:
+    """
+    计算request的指纹：规范化之后的url、method、query、formdata以及指定的请求头，
+    经过blake2b哈希得到64位或者128位的整数，用于去重
+    """
+
+    def __init__(self, include_headers: Optional[Iterable[str]] = None, bits: int = 64, cache_size: int = 10000):
+        if bits not in (64, 128):
+            raise ValueError(f'fingerprint bits must be 64 or 128, got {bits}')
+        self._include_headers = tuple(sorted(header.lower() for header in include_headers or ()))
+        self._digest_size = bits // 8
+        # 热点url的指纹缓存
+        self._fingerprint = lru_cache(maxsize=cache_size)(self._compute) if cache_size else self._compute
+
+    def __call__(self, request: Request) -> int:
+        headers = ()
+        if self._include_headers:
+            request_headers = {str(key).lower(): str(value) for key, value in request.headers.items()}
+            headers = tuple((header, request_headers.get(header, "")) for header in self._include_headers)
+        formdata = _freeze(request._formdata) if request.method != "GET" else ()
+        return self._fingerprint(request.method, request.url, _freeze(request._query), formdata, headers)
+
+    def _compute(self, method: str, url: str, query: Tuple, formdata: Tuple, headers: Tuple) -> int:
+        h = hashlib.blake2b(digest_size=self._digest_size)
+        for part in (method, canonical_url(url), repr(query), repr(formdata), repr(headers)):
+            h.update(part.encode("utf-8"))
+            h.update(b"\x00")
+        return int.from_bytes(h.digest(), "little")
+
+    def cache_info(self):
+        cache_info = getattr(self._fingerprint, "cache_info", None)
+        return cache_info() if cache_info is not None else None
+
+
+_default_fingerprinter = RequestFingerprinter()
+
+
+# 使用默认配置（64位、不包含请求头）计算request的指纹
+def request_fingerprint(request: Request) -> int:
+    return _default_fingerprinter(request)
+
 
 def _get_method(obj, method_name: str) -> Callable:
     try: